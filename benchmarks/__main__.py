@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import make_library
+
+SIZES = (10, 1000)
+# Counts that describe a run rather than measure it
+COUNTS = ('runs', 'files')
+
+
+def parse_args() -> argparse.Namespace:
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='Headless benchmarks of rendering, scanning and playback control')
+    parser.add_argument('--sizes', type=lambda text: [int(size) for size in text.split(',')], default=list(SIZES),
+                        help='comma separated library sizes to generate (default: 10,1000, e.g. 10,1000,100000)')
+    parser.add_argument('--runs', type=int, default=50, help='timed repetitions of every operation (default: 50)')
+    parser.add_argument('--output', '-o', help='file to write the JSON results to (default: stdout)')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON results of an earlier run to compare against')
+    return parser.parse_args()
+
+
+def flatten(results: dict, prefix: str = '') -> dict:
+    """Flattens nested results into dotted metric names"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and key not in COUNTS:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(baseline: dict, results: dict, stream: object = sys.stderr) -> None:
+    """Prints every metric next to its baseline value with the relative change"""
+    before = flatten(baseline.get('libraries', {}))
+    after = flatten(results['libraries'])
+    width = max((len(name) for name in after), default=0)
+    for name, value in after.items():
+        if name in before and before[name]:
+            change = (value - before[name]) / before[name] * 100
+            stream.write(f'{name:<{width}}  {before[name]:12.3f}  {value:12.3f}  {change:+7.1f}%\n')
+
+
+def run() -> None:
+    """Runs every benchmark against synthetic libraries and reports the results as JSON"""
+    args = parse_args()
+    # Audio goes nowhere and caches go to a scratch directory, so runs do not depend on the machine's state
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    with tempfile.TemporaryDirectory(prefix='casp-bench-') as scratch:
+        os.environ['XDG_CACHE_HOME'] = os.path.join(scratch, 'cache')
+        from benchmarks import suite
+
+        results = {'python': sys.version.split()[0], 'platform': sys.platform, 'runs': args.runs,
+                   'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'libraries': {}}
+        for size in args.sizes:
+            root = os.path.join(scratch, f'library-{size}')
+            started = time.perf_counter()
+            files = make_library(root, size)
+            sys.stderr.write(f'{size} files generated in {time.perf_counter() - started:.1f}s\n')
+            results['libraries'][str(size)] = {
+                'scan': suite.bench_scan(root, args.runs),
+                'render': suite.bench_render(sorted(files), args.runs),
+                'select': suite.bench_select(sorted(files), args.runs),
+                'switch': suite.bench_switch(root, sorted(files), args.runs),
+            }
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,136 @@
+import io
+import os
+import statistics
+import time
+from typing import Callable
+
+from blessed import Terminal, keyboard
+
+from casp.FileHandling import FileHandler
+from casp.music import MusicEventHandler, ensure_mixer
+from casp.MusicTerminal import MusicTerminal
+from casp.tracks import TrackOptions, TrackTable
+from casp.Widgets import Option, ProgressBarWidget, SelectWidget
+
+WIDTH = 120
+HEIGHT = 40
+
+
+def summarize(samples: list[float]) -> dict:
+    """Reduces a list of timings in seconds to milliseconds statistics"""
+    ordered = sorted(samples)
+    return {'runs': len(ordered),
+            'mean_ms': statistics.fmean(ordered) * 1000,
+            'p50_ms': ordered[len(ordered) // 2] * 1000,
+            'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+            'max_ms': ordered[-1] * 1000}
+
+
+def timed(action: Callable[[], object], runs: int) -> list[float]:
+    """Times runs calls of action"""
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        action()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def terminal() -> Terminal:
+    """Makes a styled terminal of a fixed size that writes into memory"""
+    os.environ['LINES'] = str(HEIGHT)
+    os.environ['COLUMNS'] = str(WIDTH)
+    return Terminal(kind='xterm-256color', stream=io.StringIO(), force_styling=True)
+
+
+def keystroke(name: str) -> keyboard.Keystroke:
+    """Makes the keystroke blessed would report for a named key"""
+    codes = {value: key for key, value in keyboard.get_keyboard_codes().items()}
+    return keyboard.Keystroke('', code=codes[name], name=name)
+
+
+def build_ui(term: Terminal, files: list[str]) -> tuple[MusicTerminal, SelectWidget, ProgressBarWidget]:
+    """Lays out a music menu, progress bar and controls the way casp.main does"""
+    m = MusicTerminal(term)
+    menu = SelectWidget(TrackOptions(TrackTable(files)), terminal=term, viewport=term.height - 11)
+    menu.name = 'filename'
+    m.layout.place(menu, lambda height, width, extent: (4, int(width / 2 - extent[1] / 2)))
+    progressbar = ProgressBarWidget('progressbar', term.width - 12, terminal=term)
+    m.layout.place(progressbar, lambda height, width, extent: (height - 6, 2))
+    controls = SelectWidget([Option([" play "], "play"), Option([" pause "], "pause"), Option([" >>| "], "next")],
+                            layout="Horizontal", terminal=term)
+    controls.name = 'controls'
+    m.layout.place(controls, lambda height, width, extent: (height - 2, 2))
+    m.add_widget(menu)
+    m.add_widget(progressbar)
+    m.add_widget(controls)
+    return m, menu, progressbar
+
+
+def bench_render(files: list[str], runs: int) -> dict:
+    """Times full frames: the first paint, an idle frame, a progress tick and a menu move"""
+    term = terminal()
+    m, menu, progressbar = build_ui(term, files)
+    started = time.perf_counter()
+    m.render()
+    first = {'ms': (time.perf_counter() - started) * 1000, 'bytes': m.screen.frame_bytes}
+
+    results = {'first_frame': first}
+    down, up = keystroke('KEY_DOWN'), keystroke('KEY_UP')
+    steps = iter(range(1 << 30))
+
+    def tick() -> None:
+        progressbar.update({'progress': next(steps) % 100})
+        m.render()
+
+    def move() -> None:
+        menu.update(down if next(steps) % 2 else up)
+        m.render()
+
+    for name, action in (('idle_frame', m.render), ('progress_frame', tick), ('navigate_frame', move)):
+        before = m.screen.total_bytes
+        results[name] = summarize(timed(action, runs))
+        results[name]['bytes'] = (m.screen.total_bytes - before) / runs
+    return results
+
+
+def bench_select(files: list[str], runs: int) -> dict:
+    """Times the music menu building its lines from scratch, as after every change"""
+    term = terminal()
+    menu = SelectWidget(TrackOptions(TrackTable(files)), terminal=term, viewport=HEIGHT - 11)
+
+    def render() -> None:
+        menu.invalidate()
+        menu.lines()
+
+    started = time.perf_counter()
+    render()
+    results = {'first_ms': (time.perf_counter() - started) * 1000}
+    results.update(summarize(timed(render, runs)))
+    return results
+
+
+def bench_scan(root: str, runs: int) -> dict:
+    """Times the library scan with no index on disk, then the rescans of later launches"""
+    started = time.perf_counter()
+    fh = FileHandler(root)
+    results = {'files': len(fh.files), 'cold_ms': (time.perf_counter() - started) * 1000}
+    fh.library.save()
+    results['warm'] = summarize(timed(lambda: FileHandler(root), runs))
+    return results
+
+
+def bench_switch(root: str, files: list[str], runs: int) -> dict:
+    """Times the play, next and previous commands, which load a song into the mixer"""
+    music_event = MusicEventHandler(root, progress_bar=ProgressBarWidget('progressbar', 10, terminal=terminal()))
+    started = time.perf_counter()
+    ensure_mixer()
+    results = {'mixer_init_ms': (time.perf_counter() - started) * 1000}
+    started = time.perf_counter()
+    music_event.update({'filename': files[0], 'controls': 'play'})
+    results['first_play_ms'] = (time.perf_counter() - started) * 1000
+    for command in ('next', 'previous'):
+        event = {'filename': files[0], 'controls': command}
+        results[command] = summarize(timed(lambda: music_event.update(event), runs))
+    music_event.musicplayer.stop()
+    return results
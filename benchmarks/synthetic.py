@@ -0,0 +1,27 @@
+import os
+import struct
+
+FILES_PER_DIR = 200
+
+
+def wav_bytes(seconds: float = 0.05, rate: int = 8000) -> bytes:
+    """Builds a small mono 8 bit WAV file of silence"""
+    frames = int(seconds * rate)
+    data = b'\x80' * frames
+    fmt = struct.pack('<HHIIHH', 1, 1, rate, rate, 1, 8)
+    return b'RIFF' + struct.pack('<I', 36 + len(data)) + b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt \
+        + b'data' + struct.pack('<I', len(data)) + data
+
+
+def make_library(root: str, count: int, seconds: float = 0.05) -> list[str]:
+    """Writes count WAV files under root, FILES_PER_DIR to a directory, and returns their relative paths"""
+    payload = wav_bytes(seconds)
+    paths = []
+    for i in range(count):
+        directory = f'disc{i // FILES_PER_DIR:04d}'
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+        path = os.path.join(directory, f'track{i:06d}.wav')
+        with open(os.path.join(root, path), 'wb') as f:
+            f.write(payload)
+        paths.append(path)
+    return paths
@@ -1,5 +1,9 @@
-from os import getcwd, listdir
-from os.path import isdir, isfile, join, splitext
+from os import getcwd
+from os.path import isdir
+
+from casp.library import LibraryIndex
+from casp.tracks import TrackTable
+from casp.watcher import LibraryWatcher
 
 valid_file_extensions = [".mp3", ".wav", ".ogg", ".flac"]
 
@@ -13,20 +17,19 @@ class FileHandler:
         else:
             self.working_directory = getcwd()
 
-        self.files = []
+        self.files = TrackTable()
         self.amt_of_files = 0
+        self.library = LibraryIndex(self.working_directory, valid_file_extensions)
+        self.watcher = None
 
         if isdir(self.working_directory):
             self.get_files()
 
     def get_files(self) -> None:
-        """Gets files in the current working directory and returns it as a list of files names"""
-        self.files = []
-        for file in listdir(self.working_directory):
-            if isfile(join(self.working_directory, file)):
-                ext = splitext(file)[1]
-                if ext in valid_file_extensions:
-                    self.files.append(file)
+        """Gets files under the current working directory from the library index into a table of relative paths"""
+        self.library.scan()
+        self.files = TrackTable()
+        self.files.extend(self.library.listing())
         self.amt_of_files = len(self.files)
         return
 
@@ -34,11 +37,26 @@ class FileHandler:
         """Sets current working directory and gets files within"""
         if isdir(new_directory):
             self.working_directory = new_directory
+            self.library = LibraryIndex(self.working_directory, valid_file_extensions)
+            if self.watcher is not None:
+                self.watcher.stop()
+                self.watcher = None
             self.get_files()
         else:
             print("Not a valid working directory")
         return
 
+    def watch(self) -> LibraryWatcher:
+        """Starts following changes to the files on a background thread"""
+        if self.watcher is None:
+            self.watcher = LibraryWatcher(self.library)
+            self.watcher.start()
+        return self.watcher
+
+    def changes(self) -> list[tuple]:
+        """Gets the files that were added, removed, renamed or rewritten since the last call"""
+        return self.watcher.drain() if self.watcher else []
+
     def update(self, events: list) -> None:
-        """Update function to update from events"""
-        print(events)
+        """Update function to update from events, file changes come from the watcher instead"""
+        return
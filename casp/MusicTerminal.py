@@ -1,19 +1,25 @@
 import os
 import signal
+import sys
+from typing import Callable
 
 import blessed
 from blessed import Terminal, keyboard
 
-from casp import render
-from casp.Widgets import Widget
+from casp import metrics, render
+from casp.layout import Layout
+from casp.scheduler import Scheduler
+from casp.screen import ScreenBuffer
+from casp.Widgets import StatsWidget, Widget
 
 CODES = keyboard.get_keyboard_codes()
+STATS_REFRESH = 0.5
 
 
 class MusicTerminal:
     """Main class for terminal rendering and control"""
 
-    def __init__(self, terminal: Terminal):
+    def __init__(self, terminal: Terminal, tick_rate: float = 10):
         self.widgets = []
         self.passive_widgets = []
         self.small_window_widget = None
@@ -22,78 +28,193 @@ class MusicTerminal:
         self.widgetfocus = 0
         self.min_win_size = (0, 0)
         self.miniwindow = False
+        self.tick_rate = tick_rate
+        self.render_pending = False
+        self.resize_pending = False
+        self.screen_stale = True
+        self.layout = Layout(terminal.height, terminal.width)
+        self.scheduler = Scheduler()
+        self.scheduler.add_after_dispatch(self.apply_resize)
+        self.scheduler.add_after_dispatch(self.render_if_pending)
         if os.name != 'nt':
+            self.scheduler.enable_wake()
             signal.signal(signal.SIGWINCH, self.on_resize)
-        self.dummypublishers = []
-        self.styles = render.Render()
+        self.styles = render.Render(terminal.width, terminal.height, skin='dark', terminal=terminal)
+        self.screen = ScreenBuffer(terminal)
         self.skin_type = 'dark'
+        self.input_started = None
+        self.stats_timer = None
+        self.stats_widget = StatsWidget('stats', metrics.overlay_lines, terminal)
+        self.stats_widget.position = (2, 0)
+        self.overlays = [self.stats_widget]
+        self.key_handlers = {}
 
     def on_resize(self, *args) -> None:
-        """Executes when windows size changes"""
-        if self.term.height > self.minimum_window_size()[0]:
+        """Signal handler for window size changes, which only flags the resize and wakes the loop"""
+        self.resize_pending = True
+        self.scheduler.wake()
+
+    def apply_resize(self) -> None:
+        """Lays out once for the size the terminal has now, however many resizes arrived since the last frame"""
+        if not self.resize_pending:
+            return
+        self.resize_pending = False
+        if not self.layout.resize(self.term.height, self.term.width):
+            return
+        self.invalidate()
+        if self.layout.height > self.minimum_window_size()[0]:
             self.miniwindow = False
             for subscribers in self.event_subscribers:
-                subscribers.update({'width_window': self.term.width})
-            self.render()
+                subscribers.update({'width_window': self.layout.width})
         else:
             self.miniwindow = True
-            self.render()
+        self.request_render()
 
-    def run(self) -> None:
+    def run(self, on_first_paint: Callable[[], None] = None) -> None:
         """Runs the app"""
         self.min_win_size = self.minimum_window_size()
         self.render()
+        if on_first_paint:
+            on_first_paint()
         with self.term.cbreak():
-            # print(term.clear())
-            val = ""
-            while val.lower() != "q":
-                for pub in self.dummypublishers:
-                    if pub.run():
-                        self.render()
-
-                val = self.term.inkey(timeout=3)
-
-                # check for pressed values
-                if val:
-                    if val.is_sequence:
-                        self.notifywidget(val)
-                        self.render()
-                        if CODES[val.code] == 'KEY_ENTER':
-                            if self.miniwindow:
-                                events = {w.name: w.choice() for w in self.widgets}
-                                events[self.small_window_widget.name] = self.small_window_widget.choice()
-                                self.push_events(events)
-                            else:
-                                self.push_events({w.name: w.choice() for w in self.widgets})
-                        if CODES[val.code] == 'KEY_TAB':
-                            self.widgetfocus = (self.widgetfocus + 1) % len(self.widgets)
+            if os.name != 'nt' and sys.stdin.isatty():
+                self.scheduler.add_reader(sys.stdin.fileno(), self.on_input)
+            else:
+                self.scheduler.call_every(1 / self.tick_rate, self.on_input)
+            self.scheduler.run()
+
+    def on_input(self) -> None:
+        """Handles every keystroke that is waiting on stdin, merging runs of up and down into one move
+
+        A held arrow key can queue hundreds of keystrokes, which then cost one move and one frame.
+        """
+        if self.input_started is None:
+            self.input_started = metrics.start()
+        delta = 0
+        val = self.term.inkey(timeout=0)
+        while val:
+            step = self.focused_widget().key_delta(val)
+            if step:
+                delta += step
+            else:
+                self.move_focused(delta)
+                delta = 0
+                self.on_key(val)
+            val = self.term.inkey(timeout=0)
+        self.move_focused(delta)
+
+    def move_focused(self, delta: int) -> None:
+        """Moves the choice of the focused widget by a merged run of arrow keys"""
+        if delta:
+            self.focused_widget().move(delta)
+            self.request_render()
+
+    def on_key(self, val: blessed.keyboard.Keystroke) -> None:
+        """Handles a single keystroke"""
+        if CODES.get(val.code) == 'KEY_F2':
+            self.cycle_skin()
+            self.request_render()
+        elif CODES.get(val.code) == 'KEY_F3':
+            self.toggle_stats()
+            self.request_render()
+        elif CODES.get(val.code) in self.key_handlers:
+            self.key_handlers[CODES.get(val.code)]()
+            self.request_render()
+        elif val.lower() == "q" and not self.focused_widget().takes_text():
+            self.scheduler.stop()
+        elif self.focused_widget().wants_key(val):
+            self.notifywidget(val)
+            self.request_render()
+            if CODES.get(val.code) == 'KEY_ENTER':
+                if self.miniwindow:
+                    events = {w.name: w.choice() for w in self.widgets}
+                    events[self.small_window_widget.name] = self.small_window_widget.choice()
+                    self.push_events(events)
+                else:
+                    self.push_events({w.name: w.choice() for w in self.widgets})
+            if CODES.get(val.code) == 'KEY_TAB':
+                self.widgetfocus = (self.widgetfocus + 1) % len(self.widgets)
+
+    def add_key_handler(self, key: str, handler: Callable[[], None]) -> None:
+        """Calls handler when a key such as 'KEY_F4' is pressed, whichever widget has the focus"""
+        self.key_handlers[key] = handler
+
+    def add_overlay(self, widget: Widget) -> None:
+        """Adds a widget drawn over the others, below the timing overlay"""
+        self.overlays.insert(len(self.overlays) - 1, widget)
+
+    def add_tick_source(self, source: Callable[[], bool], interval: float = None) -> None:
+        """Calls source every interval seconds (the tick rate by default), repainting if it returns True"""
+        interval = interval if interval else 1 / self.tick_rate
+        self.scheduler.call_every(interval, lambda: source() and self.request_render())
+
+    def request_render(self) -> None:
+        """Asks for a repaint once the current batch of events is handled"""
+        self.render_pending = True
+
+    def render_if_pending(self) -> None:
+        """Repaints if anything asked for it since the last frame"""
+        if self.render_pending:
+            self.render_pending = False
+            self.render()
+        if self.input_started is not None:
+            metrics.since('key to paint', self.input_started)
+            self.input_started = None
+
+    def toggle_stats(self) -> None:
+        """Shows or hides the timing overlay, turning collection on the first time it is shown"""
+        if self.stats_widget.toggle():
+            metrics.enable()
+            self.stats_timer = self.scheduler.call_every(STATS_REFRESH, self.refresh_stats)
+        else:
+            self.stats_timer.cancel()
+            self.screen_stale = True
+
+    def refresh_stats(self) -> None:
+        """Repaints the timing overlay with the latest numbers"""
+        self.stats_widget.invalidate()
+        self.request_render()
 
     def render(self) -> None:
         """Renders the graphics to screen"""
+        started = metrics.start()
+        height, width = self.layout.size
         if self.miniwindow:
-            print(self.term.clear + self.small_window_widget.render_lines()[0])
+            screen = [' ' * width for _ in range(height)]
+            screen[0] = self.small_window_widget.lines()[0]
+            self.screen.flush(screen)
             return None
         all_widgets = [*self.widgets, *self.passive_widgets]
-        all_widgets.sort(key=lambda item: item.get_position()[0])
+        if not self.screen_stale and not any([w.is_dirty() for w in [*all_widgets, *self.overlays]]):
+            return None
+        self.screen_stale = False
 
-        screen = []
-        for i in range(self.term.height):
-            screen.append(' ' * self.term.width)
-        screen[0] = screen[0]
-        screen[1] = '=' * self.term.width
-        screen[-1] = '=' * self.term.width
+        screen = self.styles.frame(width, height)
 
-        for w in all_widgets:
-            pos = w.get_position()
+        placed = sorted([(w.get_position(), w) for w in all_widgets], key=lambda item: item[0][0])
+        # The overlays go on top of whatever they cover
+        placed.extend((w.get_position(), w) for w in self.overlays)
+        for pos, w in placed:
             x = pos[0]
             y = pos[1]
-            widgetlines = w.render_lines()
-            for row in range(len(widgetlines)):
-                start = screen[x + row][0:y] if screen[x + row][0:y] else ''
-                end = screen[x + row][y + self.term.length(widgetlines[row]):] \
-                    if screen[x + row][y + self.term.length(widgetlines[row]):] else ''
-                screen[x + row] = start + widgetlines[row] + end
-        print(self.term.clear + '\n'.join(screen))
+            widgetlines = w.lines()
+            lengths = w.line_lengths()
+            for row in range(min(len(widgetlines), len(screen) - x)):
+                line = screen[x + row]
+                screen[x + row] = line[0:y] + widgetlines[row] + line[y + lengths[row]:]
+        self.screen.flush(self.styles.paint_frame(screen))
+        metrics.since('frame', started)
+
+    def invalidate(self) -> None:
+        """Forces every widget to render again on the next frame, e.g. after the terminal size changed"""
+        self.screen_stale = True
+        for w in [*self.widgets, *self.passive_widgets, self.small_window_widget, *self.overlays]:
+            if w is not None:
+                w.invalidate()
+
+    def frame_stats(self) -> dict:
+        """Gets the bytes written to the terminal per frame"""
+        return self.screen.stats()
 
     def add_widget(self, widget: Widget) -> None:
         """Adds a widget to the app"""
@@ -111,12 +232,15 @@ class MusicTerminal:
         for wp in self.widgets:
             wp.update(keystroke)
 
+    def focused_widget(self) -> Widget:
+        """Gets the widget keystrokes go to"""
+        if self.miniwindow:
+            return self.small_window_widget
+        return self.widgets[self.widgetfocus]
+
     def notifywidget(self, keystroke: blessed.keyboard.Keystroke) -> None:
         """Notify a single widget"""
-        if self.miniwindow:
-            self.small_window_widget.update(keystroke)
-        else:
-            self.widgets[self.widgetfocus].update(keystroke)
+        self.focused_widget().update(keystroke)
 
     def push_events(self, events: dict) -> None:
         """Updates all subscribers of app events"""
@@ -126,8 +250,9 @@ class MusicTerminal:
     def minimum_window_size(self) -> tuple:
         """Gets the minimum window size to fit all widgets"""
         allwidgets = [*self.widgets, *self.passive_widgets]
-        maxypos = max([x.position[0] + len(x.render_lines()) for x in allwidgets])
-        maxxpos = max([x.position[1] + max([len(line) for line in x.render_lines()]) for x in allwidgets])
+        sizes = [(x.position, x.measure()) for x in allwidgets]
+        maxypos = max([pos[0] + size[0] for pos, size in sizes])
+        maxxpos = max([pos[1] + size[1] for pos, size in sizes])
         return maxypos, maxxpos
 
     @property
@@ -138,5 +263,11 @@ class MusicTerminal:
     @skin.setter
     def skin(self, skin: str = 'dark') -> None:
         """Skin setter"""
-        if skin in self.styles.skins:
+        if self.styles.set_skin(skin):
             self.skin_type = skin
+            self.screen_stale = True
+
+    def cycle_skin(self) -> None:
+        """Switches to the next skin"""
+        names = list(self.styles.skins)
+        self.skin = names[(names.index(self.skin_type) + 1) % len(names)]
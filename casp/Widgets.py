@@ -1,8 +1,18 @@
+from bisect import bisect_left, bisect_right
+from typing import Callable, Sequence
+
 import blessed
 
 CODES = blessed.keyboard.get_keyboard_codes()
 
 
+def text_width(term: blessed.Terminal, text: str) -> int:
+    """Gets the printable width of text, skipping the slow sequence parser for plain ascii"""
+    if text.isascii() and '\x1b' not in text:
+        return len(text)
+    return term.length(text)
+
+
 class Widget:
     """Generic widget class"""
 
@@ -10,6 +20,9 @@ class Widget:
         self.name = name
         self.passive = passive
         self.widget_position = (0, 0)
+        self.dirty = True
+        self.cached_lines = []
+        self.cached_lengths = []
 
     @property
     def position(self) -> tuple[int, int]:
@@ -25,6 +38,46 @@ class Widget:
         """Gets the position can can be overloaded for dynamic position assignment"""
         return self.position
 
+    def wants_key(self, keystroke: blessed.keyboard.Keystroke) -> bool:
+        """Checks whether the widget handles a keystroke, by default only special keys"""
+        return keystroke.is_sequence
+
+    def takes_text(self) -> bool:
+        """Checks whether the widget is taking typed text, so letters must not trigger app shortcuts"""
+        return False
+
+    def key_delta(self, keystroke: blessed.keyboard.Keystroke) -> int:
+        """Gets how many rows a keystroke moves the choice, 0 unless it is a step that can be merged with others"""
+        return 0
+
+    def invalidate(self) -> None:
+        """Marks the cached lines as stale so the next frame renders the widget again"""
+        self.dirty = True
+
+    def is_dirty(self) -> bool:
+        """Checks whether the cached lines are stale, can be overloaded for widgets with dynamic content"""
+        return self.dirty
+
+    def lines(self) -> list[str]:
+        """Gets the rendered lines, only calling render_lines when the widget changed"""
+        if self.is_dirty():
+            self.cached_lines = self.render_lines()
+            self.cached_lengths = None
+            self.dirty = False
+        return self.cached_lines
+
+    def line_lengths(self) -> list[int]:
+        """Gets the printable width of each rendered line, measured once per render"""
+        lines = self.lines()
+        if self.cached_lengths is None:
+            self.cached_lengths = [text_width(self.term, line) for line in lines]
+        return self.cached_lengths
+
+    def measure(self) -> tuple[int, int]:
+        """Gets the smallest (lines, width) the widget needs on screen"""
+        lengths = self.line_lengths()
+        return len(lengths), max(lengths, default=0)
+
 
 class Option:
     """Single option for a select widget"""
@@ -49,9 +102,21 @@ class ProgressBarWidget(Widget):
         self.term = terminal if terminal else blessed.terminal
         self.length = length
         self.fillstyle = self.term.on_white
-        self.progress = 0
+        self.progress_cells = 0
         self.background = self.term.normal
 
+    @property
+    def progress(self) -> int:
+        """Progress getter, in filled cells"""
+        return self.progress_cells
+
+    @progress.setter
+    def progress(self, cells: int) -> None:
+        """Progress setter, in filled cells"""
+        if cells != self.progress_cells:
+            self.progress_cells = cells
+            self.invalidate()
+
     def render_lines(self) -> list:
         """Returns lines to be rendered"""
         lines = list()
@@ -69,23 +134,358 @@ class ProgressBarWidget(Widget):
         if 'width_window' in events.keys():
             self.length = events['width_window'] - 4
             self.progress = int(self.progress * self.length / 100)
+            self.invalidate()
+
+
+class LabelWidget(Widget):
+    """Single line of text, e.g. the song that is playing"""
+
+    def __init__(self, name: str = '', text: str = '', terminal: blessed.Terminal = None):
+        Widget.__init__(self, name, True)
+        self.term = terminal if terminal else blessed.terminal
+        self.text = text
+
+    def get_text(self) -> str:
+        """Gets the text and can be overloaded for dynamic text"""
+        return self.text
+
+    def is_dirty(self) -> bool:
+        """Checks whether the text changed since the last render"""
+        return self.dirty or self.cached_lines != [self.get_text()]
+
+    def render_lines(self) -> list:
+        """Returns lines to be rendered"""
+        return [self.get_text()]
+
+    def update(self, events: dict) -> None:
+        """Updates the text from events"""
+        if 'text' in events.keys():
+            self.text = events['text']
+            self.invalidate()
+
+
+class StatsWidget(Widget):
+    """Overlay table of timings in the top right corner that stays hidden until it is toggled
+
+    The rows span the whole terminal width, so splicing them never cuts through the styling of what is beneath.
+    """
+
+    def __init__(self, name: str = '', get_lines: Callable[[], list[str]] = None, terminal: blessed.Terminal = None):
+        Widget.__init__(self, name, True)
+        self.term = terminal if terminal else blessed.terminal
+        self.get_lines = get_lines if get_lines else list
+        self.shown = False
+        self.style = self.term.black_on_yellow
+
+    def toggle(self) -> bool:
+        """Shows or hides the overlay, returns whether it is shown"""
+        self.shown = not self.shown
+        self.invalidate()
+        return self.shown
+
+    def render_lines(self) -> list[str]:
+        """Returns lines to be rendered, none while hidden"""
+        if not self.shown:
+            return []
+        lines = self.get_lines()
+        width = max(map(len, lines), default=0)
+        pad = ' ' * max(0, self.term.width - width - 2)
+        return [pad + self.style + line.ljust(width) + self.term.normal + '  ' for line in lines]
+
+
+def half_block_column(start: int, end: int, rows: int) -> str:
+    """Draws pixels start to end of a column two pixels per row high, top to bottom, as half block characters"""
+    if end <= start:
+        return ' ' * rows
+    first, last = start // 2, (end - 1) // 2
+    if first == last:
+        cell = '█' if end - start == 2 else '▄' if start % 2 else '▀'
+        return ' ' * first + cell + ' ' * (rows - first - 1)
+    head = '▄' if start % 2 else '█'
+    tail = '█' if end % 2 == 0 else '▀'
+    return ' ' * first + head + '█' * (last - first - 1) + tail + ' ' * (rows - last - 1)
+
+
+class ArtWidget(Widget):
+    """Art region between the title and the progress bar, drawn over the menu while it shows something
+
+    Levels from 0 to 1 become bars of half block characters, standing on the bottom or centred for a waveform.
+    Columns before split are drawn in the played style. A picture is drawn as given, centred. The rows span the
+    whole terminal width, like the stats overlay.
+    """
+
+    def __init__(self, name: str = '', terminal: blessed.Terminal = None):
+        Widget.__init__(self, name, True)
+        self.term = terminal if terminal else blessed.terminal
+        self.shown = False
+        self.levels = []
+        self.centred = False
+        self.split = 0
+        self.message = ''
+        self.picture = None
+        self.played_style = self.term.cyan
+        self.style = self.term.bright_black
+
+    def get_size(self) -> tuple[int, int]:
+        """Gets the (rows, width) of the region, can be overloaded to follow the terminal size"""
+        return self.term.height - 8, self.term.width
+
+    def show(self, shown: bool) -> None:
+        """Shows or hides the region"""
+        if shown != self.shown:
+            self.shown = shown
+            self.invalidate()
+
+    def set_levels(self, levels: list[float], centred: bool = False, split: int = 0) -> bool:
+        """Draws a bar per level, returns False if nothing changed"""
+        if (levels, centred, split, '', None) == (self.levels, self.centred, self.split, self.message, self.picture):
+            return False
+        self.levels = levels
+        self.centred = centred
+        self.split = split
+        self.message = ''
+        self.picture = None
+        self.invalidate()
+        return True
+
+    def set_picture(self, width: int, lines: list[str]) -> bool:
+        """Draws rows already styled, width cells wide, returns False if they are already shown"""
+        if self.picture is not None and self.picture[1] is lines and not self.message:
+            return False
+        self.picture = (width, lines)
+        self.message = ''
+        self.invalidate()
+        return True
+
+    def set_message(self, message: str) -> bool:
+        """Shows a line of text instead of the bars, returns False if it is already shown"""
+        if message == self.message:
+            return False
+        self.message = message
+        self.invalidate()
+        return True
+
+    def render_lines(self) -> list[str]:
+        """Returns lines to be rendered, none while hidden"""
+        rows, width = self.get_size()
+        if not self.shown or rows <= 0:
+            return []
+        if self.message or not self.levels and self.picture is None:
+            lines = [' ' * width] * rows
+            lines[rows // 2] = self.message[:width].center(width)
+            return lines
+        if self.picture is not None:
+            cells, picture = self.picture
+            if cells > width or len(picture) > rows:
+                return [' ' * width] * rows
+            left = ' ' * ((width - cells) // 2)
+            right = ' ' * (width - cells - len(left))
+            top = (rows - len(picture)) // 2
+            return ([' ' * width] * top + [left + line + right for line in picture]
+                    + [' ' * width] * (rows - top - len(picture)))
+        levels = self.levels[:width]
+        pixels = rows * 2
+        columns = []
+        for level in levels:
+            height = round(min(max(level, 0.0), 1.0) * pixels)
+            start = (pixels - height) // 2 if self.centred else pixels - height
+            columns.append(half_block_column(start, start + height, rows))
+        left = ' ' * ((width - len(levels)) // 2)
+        right = ' ' * (width - len(left) - len(levels))
+        split = min(max(self.split, 0), len(levels))
+        normal = self.term.normal
+        return [left + self.played_style + row[:split] + self.style + row[split:] + normal + right
+                for row in map(''.join, zip(*columns))]
+
+    def line_lengths(self) -> list[int]:
+        """Every row is as wide as the region, which saves measuring the styled rows"""
+        return [self.get_size()[1]] * len(self.lines())
 
 
 class SelectWidget(Widget):
     """Selection pane for selecting from a menu or control"""
 
     def __init__(self, options: list[Option] = None, initialchoice: int = None, selectformat: object = None,
-                 layout: str = 'Verticle', terminal: blessed.Terminal = None):
+                 layout: str = 'Verticle', terminal: blessed.Terminal = None, viewport: int = None):
         Widget.__init__(self, '')
         self.term = terminal if terminal else blessed.terminal
+        self.option_metrics = None
         self.options = options if options else []
-        self.choiceindex = initialchoice if initialchoice else 0
+        self.choice_index = initialchoice if initialchoice else 0
+        self.viewport_height = viewport
+        self.min_viewport_height = 3
+        self.scroll_offset = 0
+        self.visible = None
+        self.visible_pos = 0
+        self.search = None
+        self.searching = False
+        self.query = ''
         self.selectformat = selectformat if selectformat else self.term.on_green
         self.layout = layout
         self.header = ''
         self.footer = ''
         self.optionlead = self.term.on_green
         self.optiontail = self.term.normal
+        self.letter_index = None
+
+    @property
+    def options(self) -> list[Option]:
+        """Options getter"""
+        return self.option_list
+
+    @options.setter
+    def options(self, options: list[Option]) -> None:
+        """Options setter"""
+        self.option_list = options
+        self.option_metrics = None
+        self.letter_index = None
+        self.invalidate()
+
+    @property
+    def choiceindex(self) -> int:
+        """Choice index getter"""
+        return self.choice_index
+
+    @choiceindex.setter
+    def choiceindex(self, index: int) -> None:
+        """Choice index setter"""
+        if index != self.choice_index:
+            self.choice_index = index
+            self.invalidate()
+
+    def get_option_metrics(self) -> tuple[int, int]:
+        """Gets the (lines per option, widest line) over all options, measured once per options list"""
+        if self.option_metrics is None:
+            # Options made on demand, e.g. casp.tracks.TrackOptions, can measure without making every option
+            measure = getattr(self.options, 'measure', None)
+            if measure is not None:
+                self.option_metrics = measure(lambda line: text_width(self.term, line))
+            else:
+                maxlines = max([len(x.graphic) for x in self.options], default=0)
+                width = max([text_width(self.term, line) for x in self.options for line in x.graphic], default=0)
+                self.option_metrics = (maxlines, width)
+        return self.option_metrics
+
+    def set_option_graphic(self, index: int, graphic: list[str]) -> None:
+        """Replaces the graphic of one option, e.g. once its tags are known"""
+        self.options[index] = Option(graphic, self.options[index].choice)
+        self.letter_index = None
+        self.invalidate()
+        if self.option_metrics is not None:
+            maxlines, width = self.option_metrics
+            self.option_metrics = (max(maxlines, len(graphic)),
+                                   max([width, *[text_width(self.term, line) for line in graphic]]))
+
+    def insert_option(self, index: int, option: Option) -> None:
+        """Inserts an option before index, keeping the choice on the same option"""
+        self.options.insert(index, option)
+        self.letter_index = None
+        if index <= self.choice_index and len(self.options) > 1:
+            self.choice_index += 1
+        if self.option_metrics is not None:
+            maxlines, width = self.option_metrics
+            self.option_metrics = (max(maxlines, len(option.graphic)),
+                                   max([width, *[text_width(self.term, line) for line in option.graphic]]))
+        self.invalidate()
+
+    def remove_option(self, index: int) -> None:
+        """Removes an option, keeping the choice on the same option or the one after it"""
+        del self.options[index]
+        self.letter_index = None
+        if index < self.choice_index or self.choice_index >= len(self.options):
+            self.choice_index = max(0, self.choice_index - 1)
+        self.invalidate()
+
+    def get_viewport_height(self) -> int:
+        """Gets the number of rows the options may use, can be overloaded to follow the terminal size"""
+        return self.viewport_height
+
+    def rows(self) -> Sequence[int]:
+        """Gets the indices of the options that are shown, in order"""
+        return self.visible if self.visible is not None else range(len(self.options))
+
+    def choice_row(self) -> int:
+        """Gets the position of the choice among the shown options"""
+        return self.choiceindex if self.visible is None else self.visible_pos
+
+    def select_row(self, row: int) -> None:
+        """Moves the choice to a position among the shown options"""
+        if self.visible is None:
+            self.choiceindex = row
+        else:
+            self.visible_pos = row
+            self.choiceindex = self.visible[row]
+
+    def move(self, delta: int) -> None:
+        """Moves the choice delta rows, wrapping around"""
+        rows = self.rows()
+        if rows:
+            self.select_row((self.choice_row() + delta) % len(rows))
+
+    def page_rows(self) -> int:
+        """Gets how many options fit in the viewport, all of them without one"""
+        height = self.get_viewport_height()
+        if height is None:
+            return max(1, len(self.rows()))
+        maxlines = self.get_option_metrics()[0] or 1
+        return max(1, (max(height, self.min_viewport_height) - 2) // maxlines)
+
+    def move_to(self, row: int) -> None:
+        """Moves the choice to a row, stopping at the first and the last instead of wrapping"""
+        rows = self.rows()
+        if rows:
+            self.select_row(min(max(row, 0), len(rows) - 1))
+
+    def get_letter_index(self) -> dict[str, list[int]]:
+        """Gets the ascending positions among the shown options of the labels starting with each letter or digit
+
+        The index is built once per options list and filter, so a jump is a dictionary lookup and a bisection.
+        """
+        if self.letter_index is None:
+            index = {}
+            for row, i in enumerate(self.rows()):
+                label = self.options[i].line(0)
+                first = next((c for c in label if c.isalnum()), None)
+                if first is not None:
+                    index.setdefault(first.lower(), []).append(row)
+            self.letter_index = index
+        return self.letter_index
+
+    def jump_to_letter(self, letter: str) -> bool:
+        """Moves the choice to the next option whose label starts with letter, wrapping around"""
+        rows = self.get_letter_index().get(letter.lower())
+        if not rows:
+            return False
+        self.select_row(rows[bisect_right(rows, self.choice_row()) % len(rows)])
+        return True
+
+    def set_filter(self, indices: list[int]) -> None:
+        """Shows only the options at the given ascending indices, or all options for None"""
+        self.visible = indices
+        self.letter_index = None
+        self.invalidate()
+        if not indices:
+            self.visible_pos = 0
+            return
+        pos = min(bisect_left(indices, self.choiceindex), len(indices) - 1)
+        self.select_row(pos)
+
+    def set_query(self, query: str) -> None:
+        """Filters the options through the search index"""
+        self.query = query
+        self.set_filter(self.search.search(query))
+
+    def scroll_window(self, height: int) -> tuple[int, int]:
+        """Scrolls so the choice is visible and returns the (first, last) row shown in a viewport"""
+        visible = self.page_rows()
+        total = len(self.rows())
+        cursor = self.choice_row()
+        if cursor < self.scroll_offset:
+            self.scroll_offset = cursor
+        elif cursor >= self.scroll_offset + visible:
+            self.scroll_offset = cursor - visible + 1
+        self.scroll_offset = max(0, min(self.scroll_offset, total - visible))
+        return self.scroll_offset, min(total, self.scroll_offset + visible)
 
     def render(self) -> str:
         """Renders the selection pane"""
@@ -144,6 +544,9 @@ class SelectWidget(Widget):
 
     def render_lines_verticle(self) -> list[str]:
         """Renders a list of string lines vertically"""
+        height = self.get_viewport_height()
+        if height is not None:
+            return self.render_lines_viewport(height)
         phrase = []
         maxlines = max([len(x.graphic) for x in self.options])
         for i in range(len(self.options)):
@@ -154,30 +557,108 @@ class SelectWidget(Widget):
                     phrase.append(f"{self.options[i].line(row)}")
         return phrase
 
+    def render_lines_viewport(self, height: int) -> list[str]:
+        """Renders only the options inside the viewport, with scroll indicators above and below"""
+        maxlines = self.get_option_metrics()[0]
+        first, last = self.scroll_window(height)
+        rows = self.rows()
+        top = f"{chr(9650)} {first} more" if first > 0 else ''
+        if self.searching or self.query:
+            top = f"/{self.query}{'_' if self.searching else ''} [{len(rows)}] {top}"
+        phrase = [top]
+        for i in rows[first:last]:
+            for row in range(maxlines):
+                if i == self.choiceindex:
+                    phrase.append(f"{self.term.on_green}{self.options[i].line(row)}{self.term.normal}")
+                else:
+                    phrase.append(f"{self.options[i].line(row)}")
+        remaining = len(rows) - last
+        phrase.append(f"{chr(9660)} {remaining} more" if remaining > 0 else '')
+        return phrase
+
+    def measure(self) -> tuple[int, int]:
+        """Gets the smallest (lines, width) the widget needs, without rendering a viewport"""
+        if self.layout != 'Horizontal' and self.get_viewport_height() is not None:
+            return self.min_viewport_height, self.get_option_metrics()[1]
+        return Widget.measure(self)
+
     def get_dimensions(self) -> tuple[int, int]:
         """Gets the dimensions of the widget"""
-        lines = self.render_lines()
+        if self.layout != 'Horizontal' and self.get_viewport_height() is not None:
+            return self.get_option_metrics()[1], self.get_option_metrics()[1]
+        lengths = self.line_lengths()
         if self.layout == 'Horizontal':
-            x = self.term.length(lines[0])
-            y = len(lines)
+            x = lengths[0]
+            y = len(lengths)
         else:
-            x = self.term.length(lines[0])
-            y = max(self.term.length(line) for line in lines)
+            x = lengths[0]
+            y = max(lengths)
         return x, y
 
     def choice(self) -> str:
         """Returns the selection of a widget"""
         return self.options[self.choiceindex].choice
 
+    def wants_key(self, keystroke: blessed.keyboard.Keystroke) -> bool:
+        """Takes every key while typing a search, '/' to start one and letters and digits to jump in a list"""
+        return (keystroke.is_sequence or self.searching or (self.search is not None and keystroke == '/')
+                or self.layout != 'Horizontal' and len(keystroke) == 1 and keystroke.isalnum())
+
+    def takes_text(self) -> bool:
+        """Checks whether a search query is being typed"""
+        return self.searching
+
+    def key_delta(self, keystroke: blessed.keyboard.Keystroke) -> int:
+        """Up and down move one row in a list, so a run of them is one move"""
+        if self.layout == 'Horizontal':
+            return 0
+        return {'KEY_DOWN': 1, 'KEY_UP': -1}.get(CODES.get(keystroke.code), 0)
+
+    def update_search(self, keystroke: blessed.keyboard.Keystroke) -> bool:
+        """Handles typing a search query, returns True if the key was used"""
+        if not self.searching:
+            if keystroke == '/':
+                self.searching = True
+                return True
+            return False
+        code = CODES.get(keystroke.code)
+        if code in ('KEY_BACKSPACE', 'KEY_DELETE'):
+            self.set_query(self.query[:-1])
+        elif code == 'KEY_ESCAPE':
+            self.searching = False
+            self.set_query('')
+        elif code == 'KEY_ENTER':
+            self.searching = False
+            return False
+        elif not keystroke.is_sequence and keystroke.isprintable():
+            self.set_query(self.query + str(keystroke))
+        else:
+            return False
+        return True
+
     def update(self, keystroke: blessed.keyboard.Keystroke) -> None:
         """Updates the widgets based upon key pressed"""
+        self.invalidate()
+        if self.search is not None and self.update_search(keystroke):
+            return
         if self.layout == 'Horizontal':
-            if CODES[keystroke.code] == 'KEY_RIGHT':
+            if CODES.get(keystroke.code) == 'KEY_RIGHT':
                 self.choiceindex = (self.choiceindex + 1) % len(self.options)
-            elif CODES[keystroke.code] == 'KEY_LEFT':
+            elif CODES.get(keystroke.code) == 'KEY_LEFT':
                 self.choiceindex = (self.choiceindex - 1) % len(self.options)
         else:
-            if CODES[keystroke.code] == 'KEY_DOWN':
-                self.choiceindex = (self.choiceindex + 1) % len(self.options)
-            elif CODES[keystroke.code] == 'KEY_UP':
-                self.choiceindex = (self.choiceindex - 1) % len(self.options)
+            code = CODES.get(keystroke.code)
+            if code == 'KEY_DOWN':
+                self.move(1)
+            elif code == 'KEY_UP':
+                self.move(-1)
+            elif code == 'KEY_PGDOWN':
+                self.move_to(self.choice_row() + self.page_rows())
+            elif code == 'KEY_PGUP':
+                self.move_to(self.choice_row() - self.page_rows())
+            elif code == 'KEY_HOME':
+                self.move_to(0)
+            elif code == 'KEY_END':
+                self.move_to(len(self.rows()) - 1)
+            elif not keystroke.is_sequence and keystroke.isalnum():
+                self.jump_to_letter(str(keystroke))
@@ -0,0 +1,4 @@
+import time
+
+# Taken before any other casp module loads, so --startup-profile can time the imports
+IMPORT_STARTED = time.perf_counter()
@@ -0,0 +1,208 @@
+import hashlib
+import mmap
+import os
+import queue
+import threading
+import time
+import wave
+from collections import OrderedDict
+from os.path import join
+
+from casp.cache import cache_dir, load_json, save_json
+from casp.decode import decode_elsewhere
+from casp.probe import file_key, probe_duration
+
+CACHE_VERSION = 1
+# WAV files are already PCM, caching them would only copy them
+CACHED_EXTENSIONS = ('.mp3', '.flac', '.ogg')
+# What the mixer decodes to by default, 44.1 kHz 16 bit stereo
+PCM_BYTES_PER_SECOND = 44100 * 2 * 2
+# A hit only moves a song to the back of the index, so that is saved at most this often and on exit
+SAVE_INTERVAL = 30.0
+
+
+class AudioCache:
+    """Disk cache of songs decoded to PCM WAV, bounded by a byte budget and evicted least recently used first
+
+    A worker thread has the helper process of casp.decode decode the songs that were played or queued. Files are
+    written under a temporary name and renamed into place, so a crash never leaves a half written song behind.
+    Cached songs are opened through a memory map, so replaying one costs no decoding and no copy. Songs that
+    would not fit in the budget on their own are never decoded, they would only push everything else out.
+    """
+
+    def __init__(self, budget: int, directory: str = None):
+        self.budget = budget
+        self.directory = directory if directory else join(cache_dir(), 'audio')
+        self.index_file = join(self.directory, 'index.json')
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.pending = set()
+        self.thread = None
+        self.counts = {'hits': 0, 'misses': 0, 'fills': 0, 'evictions': 0, 'errors': 0, 'too_big': 0}
+        self.changed = False
+        self.saved_at = time.monotonic()
+        self.load()
+
+    def load(self) -> None:
+        """Reads the index, reconciled with the files that are really there"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        data = load_json(self.index_file, {})
+        saved = data.get('entries', []) if data.get('version') == CACHE_VERSION else []
+        on_disk = {}
+        for name in names:
+            path = join(self.directory, name)
+            if name.endswith('.tmp'):
+                # Left behind by a fill that never finished
+                self.remove(path)
+            elif name.endswith('.wav'):
+                try:
+                    on_disk[name[:-4]] = os.path.getsize(path)
+                except OSError:
+                    pass
+        # Files the index does not know about are the first to go
+        for key in on_disk.keys() - {key for key, _ in saved}:
+            self.entries[key] = on_disk[key]
+        for key, _ in saved:
+            if key in on_disk:
+                self.entries[key] = on_disk[key]
+        self.evict()
+
+    def save(self) -> bool:
+        """Writes the index, least recently used first, one save at a time"""
+        with self.save_lock:
+            with self.lock:
+                data = {'version': CACHE_VERSION, 'entries': list(self.entries.items())}
+                self.changed = False
+                self.saved_at = time.monotonic()
+            return save_json(self.index_file, data)
+
+    def key(self, filename: str) -> str:
+        """Gets the cache key of a song, which changes with its path, size and mtime"""
+        return hashlib.sha1('\0'.join(map(str, file_key(filename))).encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def path(self, key: str) -> str:
+        """Gets the cached WAV of a key"""
+        return join(self.directory, key + '.wav')
+
+    def open(self, filename: str) -> mmap.mmap:
+        """Maps the cached PCM of a song, or gets None and decodes it in the background for next time"""
+        if not filename.lower().endswith(CACHED_EXTENSIONS):
+            return None
+        try:
+            key = self.key(filename)
+        except OSError:
+            return None
+        with self.lock:
+            cached = key in self.entries
+            if cached:
+                self.entries.move_to_end(key)
+        if cached:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                with self.lock:
+                    self.counts['hits'] += 1
+                    self.changed = True
+                    due = time.monotonic() - self.saved_at > SAVE_INTERVAL
+                if due:
+                    self.save()
+                return source
+            except (OSError, ValueError):
+                with self.lock:
+                    self.entries.pop(key, None)
+        with self.lock:
+            self.counts['misses'] += 1
+        self.request(filename)
+        return None
+
+    def request(self, filename: str) -> None:
+        """Asks the worker to decode a song into the cache"""
+        if not filename.lower().endswith(CACHED_EXTENSIONS):
+            return
+        with self.lock:
+            if filename in self.pending:
+                return
+            self.pending.add(filename)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work, name='casp-audio-cache', daemon=True)
+            self.thread.start()
+        self.requests.put(filename)
+
+    def work(self) -> None:
+        """Worker loop that fills the cache"""
+        while True:
+            filename = self.requests.get()
+            try:
+                self.fill(filename)
+            except (OSError, ValueError, RuntimeError, EOFError, wave.Error):
+                with self.lock:
+                    self.counts['errors'] += 1
+            with self.lock:
+                self.pending.discard(filename)
+
+    def fill(self, filename: str) -> None:
+        """Decodes a song into the cache unless it is there already"""
+        key = self.key(filename)
+        with self.lock:
+            if key in self.entries:
+                return
+        seconds = probe_duration(filename)
+        if seconds is not None and seconds * PCM_BYTES_PER_SECOND > self.budget:
+            with self.lock:
+                self.counts['too_big'] += 1
+            return
+        target = self.path(key)
+        tmp = f'{target}.{os.getpid()}.tmp'
+        try:
+            decode_elsewhere(filename, tmp)
+            os.replace(tmp, target)
+        finally:
+            # Nothing is left to remove once the rename went through
+            self.remove(tmp)
+        with self.lock:
+            self.entries[key] = os.path.getsize(target)
+            self.counts['fills'] += 1
+        self.evict()
+        self.save()
+
+    def evict(self) -> None:
+        """Deletes the least recently used songs until the cache fits its budget"""
+        while True:
+            with self.lock:
+                if sum(self.entries.values()) <= self.budget or not self.entries:
+                    return
+                key, _ = self.entries.popitem(last=False)
+                self.counts['evictions'] += 1
+            # A song that is playing keeps its memory map after the file is gone
+            self.remove(self.path(key))
+
+    def close(self) -> None:
+        """Saves the order of the songs played since the last save"""
+        if self.changed:
+            self.save()
+
+    def remove(self, path: str) -> None:
+        """Deletes a file if it is there"""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        """Gets the hit and miss counts and how full the cache is"""
+        with self.lock:
+            lookups = self.counts['hits'] + self.counts['misses']
+            return {**self.counts, 'hit_rate': self.counts['hits'] / lookups if lookups else 0.0,
+                    'files': len(self.entries), 'bytes': sum(self.entries.values()), 'budget': self.budget}
+
+    def overlay_lines(self) -> list[str]:
+        """Gets the stats as rows for the F3 overlay"""
+        stats = self.stats()
+        return [f'{"audio cache":<13}{"hits":>8}{"misses":>8}{"MB":>8}',
+                f'{str(stats["files"]) + " songs":<13}{stats["hits"]:8d}{stats["misses"]:8d}{stats["bytes"] >> 20:8d}']
@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+import tempfile
+from os.path import expanduser, join
+
+
+def cache_dir() -> str:
+    """Gets the directory casp keeps its caches in, creating it if needed"""
+    base = os.environ.get('XDG_CACHE_HOME') or join(expanduser('~'), '.cache')
+    path = join(base, 'casp')
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        pass
+    return path
+
+
+def cache_path(prefix: str, key: str, ext: str = '.json') -> str:
+    """Gets the cache file for a key such as a music directory"""
+    digest = hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+    return join(cache_dir(), f'{prefix}-{digest}{ext}')
+
+
+def load_json(path: str, default: object = None) -> object:
+    """Reads a json cache file, returning default if it is missing or unreadable"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path: str, data: object) -> bool:
+    """Writes a json cache file atomically so a crash never leaves a half written file"""
+    return save_bytes(path, json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+
+def save_bytes(path: str, data: bytes) -> bool:
+    """Writes a binary cache file atomically, under a temporary name of its own so concurrent saves never collide"""
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp('.tmp', os.path.basename(path) + '.', os.path.dirname(path))
+        with open(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        return False
+    return True
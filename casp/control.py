@@ -0,0 +1,289 @@
+import json
+import os
+import socket
+import time
+from typing import Callable
+
+from casp.cache import cache_dir
+from casp.scheduler import Scheduler
+from casp.Widgets import Widget
+
+COMMANDS = ('play', 'pause', 'next', 'previous', 'shuffle', 'repeat', 'volume', 'status', 'quit')
+CLIENT_TIMEOUT = 2.0
+MAX_LINE = 1 << 16
+# A daemon that has not answered a poll for this long is treated as gone
+STALL_TIMEOUT = 5.0
+RECONNECT_TIMEOUT = 0.1
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 8.0
+GONE_MESSAGE = 'The casp daemon is gone, reconnecting...'
+
+
+def socket_path() -> str:
+    """Gets the default path of the control socket, private to the user"""
+    base = os.environ.get('XDG_RUNTIME_DIR') or cache_dir()
+    return os.path.join(base, 'casp.sock')
+
+
+def encode(message: dict) -> bytes:
+    """Encodes one message of the protocol: a JSON object on a single line"""
+    return json.dumps(message, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class ControlServer:
+    """Unix socket on the scheduler that answers each line holding a JSON command with one JSON line"""
+
+    def __init__(self, scheduler: Scheduler, handler: Callable[[dict], dict], path: str = None):
+        self.scheduler = scheduler
+        self.handler = handler
+        self.path = path if path else socket_path()
+        self.sock = None
+        self.buffers = {}
+
+    def start(self) -> None:
+        """Binds the socket, replacing one left behind by a daemon that is no longer running"""
+        if os.path.exists(self.path):
+            try:
+                send_command({'cmd': 'status'}, self.path)
+            except OSError:
+                os.unlink(self.path)
+            else:
+                raise OSError(f'casp is already running on {self.path}')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen(8)
+        self.sock.setblocking(False)
+        self.scheduler.add_reader(self.sock.fileno(), self.accept)
+
+    def accept(self) -> None:
+        """Starts reading commands from a new client"""
+        try:
+            conn, _ = self.sock.accept()
+        except OSError:
+            return
+        conn.setblocking(False)
+        self.buffers[conn] = b''
+        self.scheduler.add_reader(conn.fileno(), lambda: self.receive(conn))
+
+    def receive(self, conn: socket.socket) -> None:
+        """Answers every complete line a client sent"""
+        try:
+            data = conn.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(conn)
+            return
+        buffer = self.buffers[conn] + data
+        while b'\n' in buffer:
+            line, buffer = buffer.split(b'\n', 1)
+            try:
+                conn.sendall(encode(self.answer(line)))
+            except OSError:
+                self.drop(conn)
+                return
+        if len(buffer) > MAX_LINE:
+            self.drop(conn)
+            return
+        self.buffers[conn] = buffer
+
+    def answer(self, line: bytes) -> dict:
+        """Runs one command and gets the reply"""
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {'ok': False, 'error': 'not valid JSON'}
+        if not isinstance(request, dict) or request.get('cmd') not in COMMANDS:
+            return {'ok': False, 'error': f'expected {{"cmd": ...}} with one of {", ".join(COMMANDS)}'}
+        try:
+            return self.handler(request)
+        except (KeyError, ValueError, TypeError) as err:
+            return {'ok': False, 'error': str(err)}
+
+    def drop(self, conn: socket.socket) -> None:
+        """Forgets a client that hung up"""
+        self.scheduler.remove_reader(conn.fileno())
+        self.buffers.pop(conn, None)
+        conn.close()
+
+    def close(self) -> None:
+        """Closes every connection and removes the socket file"""
+        for conn in list(self.buffers):
+            self.drop(conn)
+        if self.sock is not None:
+            self.scheduler.remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class ControlClient:
+    """Connection to a running daemon that sends one command at a time"""
+
+    def __init__(self, path: str = None, timeout: float = CLIENT_TIMEOUT):
+        self.path = path if path else socket_path()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(self.path)
+        self.buffer = b''
+
+    def send(self, request: dict) -> dict:
+        """Sends a command and waits for its reply"""
+        self.sock.sendall(encode(request))
+        while b'\n' not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError('casp daemon closed the connection')
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return json.loads(line)
+
+    def close(self) -> None:
+        """Hangs up"""
+        self.sock.close()
+
+
+def send_command(request: dict, path: str = None) -> dict:
+    """Sends a single command to a running daemon"""
+    client = ControlClient(path)
+    try:
+        return client.send(request)
+    finally:
+        client.close()
+
+
+class RemoteEventHandler:
+    """Stands in for MusicEventHandler in a TUI attached to a daemon, forwarding the controls to its socket
+
+    Only the first status is waited for. After that commands and status polls are written without waiting and
+    the replies are read when the scheduler finds the socket readable, so a slow daemon never holds up a frame.
+    A daemon that quits or stalls is shown as gone and reconnected to with backoff.
+    """
+
+    def __init__(self, progress_bar: Widget, scheduler: Scheduler, path: str = None):
+        self.path = path
+        self.scheduler = scheduler
+        self.progress_bar = progress_bar
+        self.event_publishers = []
+        self.state = {}
+        self.currentsong = ''
+        self.progress = 0
+        self.message = ''
+        self.waiting = 0
+        self.sent_at = 0.0
+        self.retry_at = 0.0
+        self.retry_delay = RECONNECT_DELAY
+        self.client = ControlClient(path)
+        self.keep(self.client.send({'cmd': 'status'}))
+        self.listen()
+
+    def listen(self) -> None:
+        """Hands the connection to the scheduler, which reads the replies as they come"""
+        self.client.sock.setblocking(False)
+        self.scheduler.add_reader(self.client.sock.fileno(), self.receive)
+
+    def keep(self, reply: dict) -> None:
+        """Keeps the status that comes back with a reply"""
+        if reply.get('ok'):
+            self.state = reply['status']
+            self.currentsong = self.state['song']
+
+    def post(self, request: dict) -> None:
+        """Sends a command without waiting for its reply"""
+        if self.client is None:
+            return
+        try:
+            self.client.sock.sendall(encode(request))
+        except OSError:
+            self.disconnect()
+            return
+        if not self.waiting:
+            self.sent_at = time.monotonic()
+        self.waiting += 1
+
+    def receive(self) -> None:
+        """Reads the replies that arrived"""
+        try:
+            data = self.client.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.disconnect()
+            return
+        buffer = self.client.buffer + data
+        while b'\n' in buffer:
+            line, buffer = buffer.split(b'\n', 1)
+            self.waiting = max(0, self.waiting - 1)
+            self.sent_at = time.monotonic()
+            try:
+                self.keep(json.loads(line))
+            except ValueError:
+                pass
+        if len(buffer) > MAX_LINE:
+            self.disconnect()
+            return
+        self.client.buffer = buffer
+
+    def disconnect(self) -> None:
+        """Drops the connection to a daemon that went away and shows that it is gone"""
+        if self.client is not None:
+            self.scheduler.remove_reader(self.client.sock.fileno())
+            self.client.close()
+            self.client = None
+        self.waiting = 0
+        self.message = GONE_MESSAGE
+        self.retry_at = time.monotonic() + self.retry_delay
+
+    def reconnect(self) -> None:
+        """Tries to connect again once the backoff is over, doubling it every time that fails"""
+        now = time.monotonic()
+        if now < self.retry_at:
+            return
+        try:
+            self.client = ControlClient(self.path, RECONNECT_TIMEOUT)
+        except OSError:
+            self.retry_delay = min(self.retry_delay * 2, MAX_RECONNECT_DELAY)
+            self.retry_at = now + self.retry_delay
+            return
+        self.retry_delay = RECONNECT_DELAY
+        self.message = ''
+        self.listen()
+
+    def update(self, event: dict) -> None:
+        """Called when app subscribed to has an event"""
+        if event.get('controls') in COMMANDS:
+            self.post({'cmd': event['controls'], 'file': event.get('filename')})
+
+    def run(self) -> bool:
+        """Polls the daemon's status and updates the progress bar from the last one that came back"""
+        message = self.message
+        if self.client is None:
+            self.reconnect()
+        elif self.waiting and time.monotonic() - self.sent_at > STALL_TIMEOUT:
+            self.disconnect()
+        if self.client is not None and not self.waiting:
+            self.post({'cmd': 'status'})
+        length = self.state.get('length')
+        progress = self.state.get('position', 0) / length * 100 if length else 0
+        if progress != self.progress:
+            self.progress = progress
+            for event_publisher in self.event_publishers:
+                event_publisher.update({'progress': progress})
+            return True
+        return message != self.message
+
+    def check_end(self) -> bool:
+        """The daemon moves on to the next song by itself, so there is nothing to do here"""
+        return False
+
+    def add_publisher(self, publisher: Widget) -> None:
+        """Publishes events for the event"""
+        self.event_publishers.append(publisher)
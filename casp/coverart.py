@@ -0,0 +1,163 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import blessed
+
+from casp.metadata import read_picture
+
+FOLDER_IMAGES = ('cover.jpg', 'cover.jpeg', 'cover.png', 'folder.jpg', 'folder.png', 'front.jpg')
+MAX_CACHED_ART = 64
+MAX_CACHED_PICTURES = 8
+# Pictures are shrunk to this many pixels a side once decoded, so the cache stays small
+MAX_PICTURE_SIDE = 512
+TRUECOLOR = 1 << 24
+# Channel levels of the xterm 256 colour cube
+CUBE_LEVELS = (0, 95, 135, 175, 215, 255)
+
+
+def find_picture(filename: str) -> tuple[str, bytes]:
+    """Gets the embedded cover of a song or else the cover image in its folder, as (mime type or name, data)"""
+    picture = read_picture(filename)
+    if picture is not None:
+        return picture
+    folder = os.path.dirname(filename) or os.curdir
+    names = {name.lower(): name for name in os.listdir(folder)}
+    for name in FOLDER_IMAGES:
+        if name in names:
+            with open(os.path.join(folder, names[name]), 'rb') as f:
+                return name, f.read()
+    return None
+
+
+def decode_picture(hint: str, data: bytes) -> object:
+    """Decodes image data to a (height, width, 3) uint8 array of RGB pixels"""
+    import numpy as np
+    import pygame.image
+    import pygame.surfarray
+    try:
+        surface = pygame.image.load(io.BytesIO(data), hint.replace('/', '.'))
+    except pygame.error as err:
+        raise ValueError(f'can not decode the picture: {err}')
+    return np.ascontiguousarray(pygame.surfarray.array3d(surface).transpose(1, 0, 2))
+
+
+def downscale(pixels: object, height: int, width: int) -> object:
+    """Resizes pixels to height by width, averaging the pixels that fall in each output pixel"""
+    import numpy as np
+    rows = np.arange(height) * pixels.shape[0] // height
+    columns = np.arange(width) * pixels.shape[1] // width
+    sums = np.add.reduceat(np.add.reduceat(pixels.astype(np.uint32), rows, axis=0), columns, axis=1)
+    # reduceat takes the single pixel at a repeated index, which is how an image is stretched
+    counts = (np.maximum(np.diff(rows, append=pixels.shape[0]), 1)[:, None]
+              * np.maximum(np.diff(columns, append=pixels.shape[1]), 1)[None, :])
+    return (sums // counts[:, :, None]).astype(np.uint8)
+
+
+def fit_picture(pixels: object, rows: int, width: int) -> object:
+    """Shrinks or stretches pixels to fit rows of half block cells, two pixels high, keeping the aspect ratio"""
+    height, columns = pixels.shape[:2]
+    scale = min(rows * 2 / height, width / columns)
+    fitted_height = min(max(2, round(height * scale / 2) * 2), rows * 2)
+    fitted_width = min(max(1, round(columns * scale)), width)
+    return downscale(pixels, fitted_height, fitted_width)
+
+
+def snap_to_cube(pixels: object) -> object:
+    """Moves every channel to the nearest level of the 256 colour cube"""
+    import numpy as np
+    levels = np.array(CUBE_LEVELS, np.uint8)
+    middles = (levels[:-1].astype(np.uint16) + levels[1:]) // 2
+    return levels[np.searchsorted(middles, pixels, side='right')]
+
+
+def half_block_rows(pixels: object, term: blessed.Terminal, foregrounds: dict = None,
+                    backgrounds: dict = None) -> list[str]:
+    """Draws pixels as rows of upper half blocks, the top pixel of each cell in the foreground colour
+
+    foregrounds and backgrounds remember the escape string of each colour, blessed takes a while to find the
+    nearest one on terminals without truecolor. Those get the pixels snapped to the colour cube first, which
+    leaves far fewer colours to look up.
+    """
+    import numpy as np
+    foregrounds = {} if foregrounds is None else foregrounds
+    backgrounds = {} if backgrounds is None else backgrounds
+    if term.number_of_colors < TRUECOLOR:
+        pixels = snap_to_cube(pixels)
+    packed = (pixels[:, :, 0].astype(np.uint32) << 16) | (pixels[:, :, 1].astype(np.uint32) << 8) | pixels[:, :, 2]
+    lines = []
+    for top, bottom in zip(packed[0::2].tolist(), packed[1::2].tolist()):
+        cells = []
+        last = None
+        for colours in zip(top, bottom):
+            if colours != last:
+                fg, bg = colours
+                if fg not in foregrounds:
+                    foregrounds[fg] = str(term.color_rgb(fg >> 16, fg >> 8 & 0xff, fg & 0xff))
+                if bg not in backgrounds:
+                    backgrounds[bg] = str(term.on_color_rgb(bg >> 16, bg >> 8 & 0xff, bg & 0xff))
+                cells.append(foregrounds[fg] + backgrounds[bg])
+                last = colours
+            cells.append('▀')
+        lines.append(''.join(cells) + term.normal)
+    return lines
+
+
+class CoverArt:
+    """Cover art of songs as terminal rows, cached per song and size
+
+    get only looks in the cache, convert does the reading, decoding and downscaling and is meant for a worker
+    thread. The decoded pictures are kept too, so a resize only downscales again.
+    """
+
+    def __init__(self, terminal: blessed.Terminal):
+        self.term = terminal
+        self.lock = threading.Lock()
+        self.art = OrderedDict()
+        self.pictures = OrderedDict()
+        self.foregrounds = {}
+        self.backgrounds = {}
+
+    def get(self, filename: str, rows: int, width: int) -> tuple[int, list[str]]:
+        """Gets (width, lines) of the converted cover, (0, []) if the song has none or None if not converted yet"""
+        key = (filename, rows, width)
+        with self.lock:
+            art = self.art.get(key)
+            if art is not None:
+                self.art.move_to_end(key)
+            return art
+
+    def convert(self, filename: str, rows: int, width: int) -> tuple[int, list[str]]:
+        """Reads the cover of a song and converts it to fit rows by width cells"""
+        art = self.get(filename, rows, width)
+        if art is not None:
+            return art
+        pixels = self.picture(filename)
+        if pixels is None or rows <= 0 or width <= 0:
+            art = (0, [])
+        else:
+            fitted = fit_picture(pixels, rows, width)
+            art = (fitted.shape[1], half_block_rows(fitted, self.term, self.foregrounds, self.backgrounds))
+        with self.lock:
+            self.art[(filename, rows, width)] = art
+            while len(self.art) > MAX_CACHED_ART:
+                self.art.popitem(last=False)
+        return art
+
+    def picture(self, filename: str) -> object:
+        """Gets the decoded cover of a song, or None if it has none"""
+        with self.lock:
+            if filename in self.pictures:
+                self.pictures.move_to_end(filename)
+                return self.pictures[filename]
+        found = find_picture(filename)
+        pixels = decode_picture(*found) if found is not None else None
+        if pixels is not None and max(pixels.shape[:2]) > MAX_PICTURE_SIDE:
+            scale = MAX_PICTURE_SIDE / max(pixels.shape[:2])
+            pixels = downscale(pixels, max(1, round(pixels.shape[0] * scale)), max(1, round(pixels.shape[1] * scale)))
+        with self.lock:
+            self.pictures[filename] = pixels
+            while len(self.pictures) > MAX_CACHED_PICTURES:
+                self.pictures.popitem(last=False)
+        return pixels
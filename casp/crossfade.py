@@ -0,0 +1,400 @@
+import math
+import os
+import threading
+import time
+
+from casp.decode import PcmStream
+from casp.music import MusicPlayer, ensure_mixer
+from casp.probe import probe_duration
+
+CHUNK_MS = 100
+MIN_CHUNK_MS = 20
+# The next song is opened this long before its fade starts, decoding a compressed one takes a while
+PREPARE_SECONDS = 15.0
+SAMPLE_TYPES = {-16: 'int16', 16: 'uint16', -8: 'int8', 8: 'uint8', 32: 'float32'}
+
+
+class Voice:
+    """One song streaming into a mixer channel a chunk at a time, with an optional fade
+
+    The channel is handed over once the voice is opened, so opening it needs no lock.
+    """
+
+    def __init__(self, filename: str, level: float, source: object = None):
+        self.stream = PcmStream(filename, source)
+        self.filename = filename
+        self.channel = None
+        self.level = level
+        rate, size, self.channels = ensure_mixer().get_init()
+        if size not in SAMPLE_TYPES:
+            raise ValueError(f'the mixer plays {size} bit samples')
+        self.dtype = SAMPLE_TYPES[size]
+        self.step = self.stream.rate / rate
+        self.source_pos = 0.0
+        self.sent = 0
+        self.fade = None
+        self.started = None
+        self.paused_at = None
+
+    @property
+    def done(self) -> bool:
+        """Whether every chunk of the song has been handed to the channel"""
+        return self.source_pos >= self.stream.frames
+
+    @property
+    def remaining(self) -> int:
+        """Frames at the mixer rate that are still to be sent"""
+        return max(0, int((self.stream.frames - self.source_pos) / self.step))
+
+    def fade_to(self, target: float, frames: int) -> None:
+        """Ramps the gain from where it is now to target over the next frames"""
+        self.fade = (self.sent, max(1, frames), self.envelope_at(self.sent), target)
+
+    def envelope_at(self, frame: int) -> float:
+        """Gets the fade gain at an output frame"""
+        if self.fade is None:
+            return 1.0
+        start, length, begin, end = self.fade
+        return begin + (end - begin) * min(max((frame - start) / length, 0.0), 1.0)
+
+    def next_chunk(self, frames: int) -> object:
+        """Reads, resamples and fades the next chunk, as a Sound for the channel"""
+        import numpy as np
+        import pygame.sndarray
+        first = int(self.source_pos)
+        frames = min(frames, max(1, self.remaining))
+        needed = int(math.ceil((self.source_pos - first) + frames * self.step)) + 1
+        source = self.stream.read(first, needed)
+        if self.step == 1.0:
+            samples = source[:frames]
+        else:
+            # Linear interpolation is plenty for the odd 48 kHz song on a 44.1 kHz mixer
+            where = (self.source_pos - first) + np.arange(frames) * self.step
+            where = np.minimum(where, len(source) - 1)
+            samples = np.stack([np.interp(where, np.arange(len(source)), source[:, c])
+                                for c in range(source.shape[1])], axis=1)
+        self.source_pos += len(samples) * self.step
+        if self.fade is not None:
+            start, length, begin, end = self.fade
+            ramp = np.clip((np.arange(self.sent, self.sent + len(samples)) - start) / length, 0, 1)
+            samples = samples * (begin + (end - begin) * ramp)[:, None]
+        self.sent += len(samples)
+        if samples.shape[1] != self.channels:
+            samples = samples.mean(axis=1, keepdims=True) if self.channels == 1 else samples[:, [0] * self.channels]
+        dtype = np.dtype(self.dtype)
+        if dtype.kind == 'f':
+            out = samples.astype(dtype)
+        else:
+            info = np.iinfo(dtype)
+            middle = (int(info.max) + 1) // 2 if dtype.kind == 'u' else 0
+            out = np.clip(samples * (middle or info.max) + middle, info.min, info.max).astype(dtype)
+        return pygame.sndarray.make_sound(np.ascontiguousarray(out if self.channels > 1 else out[:, 0]))
+
+    def feed(self, frames: int) -> None:
+        """Keeps a chunk queued behind the one playing"""
+        channel = self.channel
+        while not self.done and channel.get_queue() is None:
+            sound = self.next_chunk(frames)
+            if channel.get_busy():
+                channel.queue(sound)
+            else:
+                channel.play(sound)
+                if self.started is None:
+                    self.started = time.monotonic()
+
+    def position(self) -> float:
+        """Seconds of the song played so far"""
+        if self.started is None:
+            return 0.0
+        return (self.paused_at if self.paused_at is not None else time.monotonic()) - self.started
+
+    def pause(self) -> None:
+        """Holds the channel"""
+        self.channel.pause()
+        if self.paused_at is None:
+            self.paused_at = time.monotonic()
+
+    def unpause(self) -> None:
+        """Resumes the channel"""
+        self.channel.unpause()
+        if self.paused_at is not None:
+            if self.started is not None:
+                self.started += time.monotonic() - self.paused_at
+            self.paused_at = None
+
+    def close(self) -> None:
+        """Silences the channel and releases the song"""
+        if self.channel is not None:
+            self.channel.stop()
+        self.stream.close()
+
+
+class CrossfadePlayer(MusicPlayer):
+    """Stands in for MusicPlayer, fading each song into the next on two mixer channels
+
+    A worker thread converts the songs in chunks of chunk_ms, applies the fade ramps with numpy and keeps one
+    chunk queued behind the playing one on each channel. Longer chunks cost more latency on pause and volume
+    changes but wake the worker less often. WAV files, and songs in casp.audiocache, are streamed from disk.
+    Other formats are decoded by the helper process of casp.decode into a temporary WAV file that is streamed
+    the same way, so only a few chunks of each song are in memory. Songs are opened outside the lock, and
+    nothing in the playing process decodes, so neither the controls nor the mixer wait on a decode.
+    """
+
+    def __init__(self, crossfade: float, chunk_ms: int = CHUNK_MS):
+        MusicPlayer.__init__(self)
+        self.crossfade = crossfade
+        self.chunk_seconds = max(chunk_ms, MIN_CHUNK_MS) / 1000
+        self.lock = threading.RLock()
+        self.wake = threading.Event()
+        self.current = None
+        self.fading = None
+        self.incoming = None
+        self.pending = None
+        self.loads = 0
+        self.unopenable = None
+        self.transitions = 0
+        self.seen_transitions = 0
+        self.ended = False
+        self.channels = None
+        self.thread = None
+        self.closed = False
+
+    def start(self) -> None:
+        """Reserves the two channels and starts the worker"""
+        if self.thread is None:
+            mixer = ensure_mixer()
+            mixer.set_reserved(2)
+            self.channels = (mixer.Channel(0), mixer.Channel(1))
+            self.thread = threading.Thread(target=self.work, name='casp-crossfade', daemon=True)
+            self.thread.start()
+
+    def free_channel(self) -> object:
+        """Gets the channel no voice is using, stopping a fade that still holds it"""
+        used = self.current.channel if self.current else None
+        channel = self.channels[1] if used is self.channels[0] else self.channels[0]
+        if self.fading is not None and self.fading.channel is channel:
+            self.fading.close()
+            self.fading = None
+        return channel
+
+    def load_file(self, filename: str) -> bool:
+        """Function to load file"""
+        if not os.path.isfile(filename):
+            print(filename + " not found!")
+            return False
+        self.start()
+        # The headers give the length for now, the worker sets it from the song once it is open
+        self.total_length = self.get_length(filename) * 1000
+        with self.lock:
+            for voice in (self.current, self.fading, self.incoming):
+                if voice is not None:
+                    voice.close()
+            self.current = self.fading = self.incoming = None
+            # The worker opens the song, decoding a compressed one can take a while
+            self.pending = filename
+            self.loads += 1
+            self.current_song_file = filename
+            self.queued_file = None
+            self.playing = True
+            self.paused = False
+            self.ended = False
+        self.wake.set()
+        return True
+
+    def get_length(self, filename: str) -> float:
+        """Gets the song length in seconds from the file headers, 0 if only opening the song can tell"""
+        length = probe_duration(filename)
+        return length if length is not None else 0.0
+
+    def pause(self) -> None:
+        """Function to pause music"""
+        with self.lock:
+            for voice in (self.current, self.fading):
+                if voice is not None:
+                    voice.pause()
+            self.paused = self.playing or self.paused
+            self.playing = False
+
+    def unpause(self) -> None:
+        """Function to unpause music"""
+        with self.lock:
+            if self.paused:
+                for voice in (self.current, self.fading):
+                    if voice is not None:
+                        voice.unpause()
+                self.playing = True
+                self.paused = False
+        self.wake.set()
+
+    def stop(self) -> None:
+        """Function to stop music"""
+        with self.lock:
+            for voice in (self.current, self.fading, self.incoming):
+                if voice is not None:
+                    voice.close()
+            self.current = self.fading = self.incoming = None
+            self.pending = None
+            self.playing = False
+            self.paused = False
+            self.queued_file = None
+
+    def close(self) -> None:
+        """Stops the worker, which must not touch the mixer once pygame shuts it down at exit"""
+        self.stop()
+        with self.lock:
+            self.closed = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join(1)
+        MusicPlayer.close(self)
+
+    def set_volume(self, volume: float) -> None:
+        """Sets volumes (0.0 to 1.0)"""
+        self.volume = volume
+        self.apply_volume()
+
+    def set_gain(self, gain: float) -> None:
+        """Scales the volume for the loudness of the song (0.0 to 1.0)"""
+        self.gain = gain
+        with self.lock:
+            if self.current is not None:
+                self.current.level = gain
+        self.apply_volume()
+
+    def apply_volume(self) -> None:
+        """Sets the channel volumes, each voice keeping the gain of its own song"""
+        with self.lock:
+            for voice in (self.current, self.fading):
+                if voice is not None:
+                    voice.channel.set_volume(self.volume * voice.level)
+
+    def get_percent(self) -> float:
+        """Gets percent of song passed"""
+        return self.get_position() * 1000 / self.total_length * 100 if self.total_length else 0.0
+
+    def get_position(self) -> float:
+        """Gets how far into the song the player is, in seconds"""
+        current = self.current
+        return current.position() if current is not None and (self.playing or self.paused) else 0.0
+
+    def queue_file(self, filename: str, length: float) -> None:
+        """Hands the next song to the worker, which fades it in as the current one ends"""
+        self.queued_file = filename
+        self.queued_length = length * 1000
+
+    def poll_transition(self) -> bool:
+        """Checks whether the worker started fading into the queued song since the last call"""
+        if self.transitions == self.seen_transitions:
+            return False
+        self.seen_transitions = self.transitions
+        return True
+
+    def finished(self) -> bool:
+        """Checks whether the song ran out on its own since the last call"""
+        if self.ended and self.playing:
+            self.ended = False
+            self.playing = False
+            return True
+        return False
+
+    def work(self) -> None:
+        """Worker loop that opens the songs, keeps both channels fed and starts the fades"""
+        while True:
+            self.wake.wait(self.chunk_seconds / 2)
+            self.wake.clear()
+            with self.lock:
+                if self.closed:
+                    return
+                wanted = self.wanted_voice()
+            voice = None
+            if wanted is not None:
+                try:
+                    voice = Voice(wanted[1], self.gain, self.source(wanted[1])[0])
+                except (OSError, ValueError, RuntimeError, EOFError):
+                    pass
+            with self.lock:
+                if self.closed:
+                    if voice is not None:
+                        voice.close()
+                    return
+                try:
+                    if wanted is not None:
+                        self.install(wanted, voice)
+                    self.step()
+                except (OSError, ValueError, RuntimeError, EOFError):
+                    # A song the worker can not decode ends like any other
+                    for voice in (self.current, self.fading):
+                        if voice is not None:
+                            voice.close()
+                    self.current = self.fading = self.pending = None
+                    self.ended = True
+
+    def wanted_voice(self) -> tuple:
+        """Gets the song the worker should open next, the one to play or the one to fade into, or None"""
+        if self.pending is not None:
+            return 'load', self.pending, self.loads
+        queued, current = self.queued_file, self.current
+        if (not queued or queued == self.unopenable or current is None
+                or self.incoming is not None and self.incoming.filename == queued):
+            return None
+        rate = ensure_mixer().get_init()[0]
+        if current.remaining <= (self.crossfade + PREPARE_SECONDS) * rate:
+            return 'queue', queued
+        return None
+
+    def install(self, wanted: tuple, voice: Voice) -> None:
+        """Takes on a voice opened outside the lock, unless the song it was opened for is no longer wanted"""
+        if wanted[0] == 'load':
+            if (self.pending, self.loads) != wanted[1:]:
+                if voice is not None:
+                    voice.close()
+                return
+            self.pending = None
+            if voice is None:
+                raise ValueError(f'can not open {wanted[1]}')
+            voice.channel = self.free_channel()
+            voice.level = self.gain
+            self.current = voice
+            self.total_length = voice.stream.length * 1000
+            self.apply_volume()
+        elif voice is None:
+            # Playback moves on to it without a fade once the current song ends
+            self.unopenable = wanted[1]
+        elif self.queued_file == wanted[1]:
+            if self.incoming is not None:
+                self.incoming.close()
+            self.incoming = voice
+        else:
+            voice.close()
+
+    def step(self) -> None:
+        """Moves on to the queued song when it is time and feeds the channels"""
+        rate = ensure_mixer().get_init()[0]
+        frames = int(rate * self.chunk_seconds)
+        current = self.current
+        if current is None or not self.playing:
+            return
+        fade_frames = int(self.crossfade * rate)
+        incoming = self.incoming
+        if (self.queued_file and incoming is not None and incoming.filename == self.queued_file
+                and current.remaining <= fade_frames):
+            self.incoming = None
+            incoming.channel = self.free_channel()
+            incoming.level = self.gain
+            incoming.fade = (0, max(1, min(fade_frames, current.remaining)), 0.0, 1.0)
+            current.fade_to(0.0, current.remaining)
+            self.fading, self.current = current, incoming
+            self.current_song_file, self.queued_file = self.queued_file, None
+            self.total_length = incoming.stream.length * 1000
+            self.transitions += 1
+            self.apply_volume()
+        for voice in (self.current, self.fading):
+            if voice is not None:
+                voice.feed(frames)
+        if self.fading is not None and self.fading.done and not self.fading.channel.get_busy():
+            self.fading.close()
+            self.fading = None
+        if self.current.done and not self.current.channel.get_busy():
+            self.current.close()
+            self.current = None
+            self.ended = True
@@ -0,0 +1,58 @@
+import os
+import signal
+import sys
+
+from casp.control import ControlServer
+from casp.loudness import LoudnessStore
+from casp.music import MusicEventHandler, MusicPlayer, preload_mixer
+from casp.scheduler import Scheduler
+
+END_CHECK_INTERVAL = 0.25
+CHANGES_INTERVAL = 1.0
+
+
+def handle(music_event: MusicEventHandler, scheduler: Scheduler, request: dict) -> dict:
+    """Runs one control command against the player and replies with its status"""
+    command = request['cmd']
+    if command == 'quit':
+        scheduler.stop()
+    elif command == 'volume':
+        music_event.update({'filename': '', 'controls': 'volume', 'volume': float(request['value'])})
+    elif command != 'status':
+        songfile = request.get('file') or music_event.currentsong or music_event.queue.current
+        if command == 'play' and songfile not in music_event.queue:
+            return {'ok': False, 'error': f'{songfile} is not in the library'}
+        music_event.update({'filename': songfile, 'controls': command})
+    return {'ok': True, 'status': music_event.status()}
+
+
+def run_daemon(music_dir: str, path: str = None, normalize: bool = False, player: MusicPlayer = None) -> None:
+    """Plays music_dir with no TUI, taking commands from the control socket until told to quit"""
+    scheduler = Scheduler()
+    loudness = LoudnessStore(music_dir) if normalize else None
+    music_event = MusicEventHandler(music_dir, progress_bar=None, player=player, loudness=loudness)
+    if len(music_event.queue) == 0:
+        exit("No music files were found")
+    server = ControlServer(scheduler, lambda request: handle(music_event, scheduler, request), path)
+    try:
+        server.start()
+    except OSError as err:
+        exit(f'casp: {err}')
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: scheduler.stop())
+    # The loop sleeps in select between commands, so only the end of song check wakes it
+    scheduler.call_every(END_CHECK_INTERVAL, music_event.check_end)
+    music_event.file_handler.watch()
+    scheduler.call_every(CHANGES_INTERVAL, lambda: music_event.apply_changes(music_event.file_handler.changes()))
+    preload_mixer()
+    if loudness is not None:
+        loudness.fill(music_event.file_handler.files, music_event.file_handler.library.stat)
+    sys.stderr.write(f'casp playing {os.path.abspath(music_dir)}, control socket {server.path}\n')
+    try:
+        scheduler.run()
+    finally:
+        server.close()
+        music_event.musicplayer.stop()
+        music_event.musicplayer.close()
+        if loudness is not None:
+            loudness.close()
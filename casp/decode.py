@@ -0,0 +1,199 @@
+import os
+import tempfile
+import threading
+import wave
+from typing import Iterator
+
+from casp.cache import cache_dir
+from casp.music import ensure_mixer
+
+BLOCK_FRAMES = 1 << 16
+# WAV sample layouts a decoded song can be written as: 8 bit unsigned, 16 and 32 bit signed
+WAV_SAMPLES = (('u', 1), ('i', 2), ('i', 4))
+
+# Set in helper processes, which decode with a mixer of their own since no song plays there
+decoding_here = False
+decoder = None
+decoder_lock = threading.Lock()
+
+
+def numpy_available() -> bool:
+    """Checks whether numpy is installed, without importing it"""
+    from importlib.util import find_spec
+    return find_spec('numpy') is not None
+
+
+def start_worker() -> None:
+    """Sets up a helper process so it never opens a sound card, yields to playback and decodes songs itself"""
+    global decoding_here
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    # SDL would turn SIGTERM into a quit event, and terminating the helper would never end it
+    os.environ['SDL_NO_SIGNAL_HANDLERS'] = '1'
+    os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+    if hasattr(os, 'nice'):
+        os.nice(10)
+    decoding_here = True
+
+
+def write_wav(filename: str, target: str) -> None:
+    """Helper process task that decodes a song into a PCM WAV file and flushes it to disk"""
+    stream = PcmStream(filename)
+    try:
+        samples = stream.samples
+        if samples is None or (samples.dtype.kind, samples.dtype.itemsize) not in WAV_SAMPLES:
+            raise ValueError(f'{filename} does not decode to WAV samples')
+        with wave.open(target, 'wb') as out:
+            out.setnchannels(stream.channels)
+            out.setsampwidth(samples.dtype.itemsize)
+            out.setframerate(stream.rate)
+            for start in range(0, len(samples), BLOCK_FRAMES):
+                out.writeframesraw(samples[start:start + BLOCK_FRAMES].tobytes())
+        with open(target, 'rb+') as f:
+            os.fsync(f.fileno())
+    finally:
+        stream.close()
+
+
+def decode_elsewhere(filename: str, target: str) -> None:
+    """Decodes a song into a WAV file in the helper process
+
+    pygame holds the audio device lock while it decodes, so a decode in the playing process stalls the
+    playback for as long as it takes.
+    """
+    global decoder
+    with decoder_lock:
+        if decoder is None:
+            # Imported here to keep it off the startup path
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            decoder = ProcessPoolExecutor(max_workers=1, initializer=start_worker,
+                                          mp_context=multiprocessing.get_context('spawn'))
+        executor = decoder
+    from concurrent.futures.process import BrokenProcessPool
+    try:
+        executor.submit(write_wav, filename, target).result()
+    except BrokenProcessPool:
+        # The next decode starts a new helper
+        with decoder_lock:
+            if decoder is executor:
+                decoder = None
+        raise
+
+
+def stop_decoder() -> None:
+    """Ends the helper process once the decode under way is done"""
+    global decoder
+    with decoder_lock:
+        executor, decoder = decoder, None
+    if executor is not None:
+        executor.shutdown()
+
+
+def wav_samples(data: bytes, width: int, channels: int) -> object:
+    """Converts little endian PCM bytes to float32 frames in -1..1, one column per channel"""
+    import numpy as np
+    if width == 1:
+        samples = (np.frombuffer(data, np.uint8).astype(np.float32) - 128) / 128
+    elif width == 3:
+        raw = np.frombuffer(data, np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = ((raw[:, 0] << 8 | raw[:, 1] << 16 | raw[:, 2] << 24) >> 8) / float(1 << 23)
+    else:
+        dtype = {2: '<i2', 4: '<i4'}[width]
+        samples = np.frombuffer(data, dtype) / float(1 << (8 * width - 1))
+    return samples.astype(np.float32, copy=False).reshape(-1, channels)
+
+
+class PcmStream:
+    """Decoded samples of a song, read in blocks of float32 frames with one column per channel
+
+    PCM WAV files are read straight from disk with the wave module, so they are never held in memory. source
+    can stand in for the file, e.g. the memory map of its decoded copy from casp.audiocache. Other formats are
+    decoded by the helper process into a temporary WAV file that is read the same way. Only in helper processes
+    are they decoded whole by the pygame mixer, which starts it if it is not running yet.
+    """
+
+    def __init__(self, filename: str, source: object = None):
+        self.filename = filename
+        self.wav = None
+        self.samples = None
+        self.temporary = None
+        try:
+            self.wav = wave.open(source if source is not None else filename, 'rb')
+        except (wave.Error, EOFError):
+            pass
+        if self.wav is None and not decoding_here:
+            self.open_decoded()
+        if self.wav is not None:
+            self.rate = self.wav.getframerate()
+            self.channels = self.wav.getnchannels()
+            self.frames = self.wav.getnframes()
+            self.width = self.wav.getsampwidth()
+            if self.width not in (1, 2, 3, 4):
+                self.close()
+                raise ValueError(f'{filename} has {self.width * 8} bit samples')
+            return
+        import numpy as np
+        import pygame.sndarray
+        mixer = ensure_mixer()
+        try:
+            sound = mixer.Sound(filename)
+        except pygame.error as err:
+            raise ValueError(f'can not decode {filename}: {err}')
+        self.rate, size, self.channels = mixer.get_init()
+        samples = pygame.sndarray.samples(sound)
+        self.samples = samples.reshape(len(samples), -1)
+        self.scale = float(np.iinfo(samples.dtype).max + 1) if samples.dtype.kind in 'iu' else 1.0
+        self.frames = len(self.samples)
+
+    def open_decoded(self) -> None:
+        """Opens a WAV copy of the song decoded by the helper process"""
+        fd, path = tempfile.mkstemp('.tmp', 'decoded-', cache_dir())
+        os.close(fd)
+        try:
+            decode_elsewhere(self.filename, path)
+            self.wav = wave.open(path, 'rb')
+        except BaseException:
+            os.remove(path)
+            raise
+        try:
+            # The open file stays readable, and nothing is left behind if casp dies
+            os.remove(path)
+        except OSError:
+            self.temporary = path
+
+    @property
+    def length(self) -> float:
+        """Length of the song in seconds"""
+        return self.frames / self.rate if self.rate else 0.0
+
+    def read(self, start: int, count: int) -> object:
+        """Gets up to count frames from frame start on, fewer at the end of the song"""
+        import numpy as np
+        start = max(0, min(start, self.frames))
+        count = max(0, min(count, self.frames - start))
+        if self.wav is not None:
+            self.wav.setpos(start)
+            return wav_samples(self.wav.readframes(count), self.width, self.channels)
+        block = self.samples[start:start + count]
+        if block.dtype.kind == 'u':
+            return (block.astype(np.float32) - self.scale / 2) / (self.scale / 2)
+        return block.astype(np.float32) / self.scale
+
+    def blocks(self, size: int = BLOCK_FRAMES) -> Iterator[object]:
+        """Yields the whole song from the start, size frames at a time"""
+        for start in range(0, self.frames, size):
+            yield self.read(start, size)
+
+    def close(self) -> None:
+        """Releases the file or the decoded samples"""
+        if self.wav is not None:
+            self.wav.close()
+            self.wav = None
+        self.samples = None
+        if self.temporary is not None:
+            try:
+                os.remove(self.temporary)
+            except OSError:
+                pass
+            self.temporary = None
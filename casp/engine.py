@@ -0,0 +1,294 @@
+import multiprocessing
+import os
+import signal
+import time
+
+from casp.audiocache import AudioCache
+from casp.crossfade import CHUNK_MS, CrossfadePlayer
+from casp.decode import stop_decoder
+from casp.music import MusicPlayer, ensure_mixer
+from casp.probe import probe_duration
+
+ENGINE_TICK = 0.02
+# The audio cache counters only feed the stats overlay and the control socket, so they are published less often
+CACHE_STATS_INTERVAL = 1.0
+
+# Layout of the shared status block. SEQ is a seqlock counter that is odd while the engine writes
+SEQ, ACK, STATE, POSITION, LENGTH, VOLUME, TRANSITIONS, TRANSITION_AT, FINISHES, FINISHED_AT, ERRORS = range(11)
+CACHE_COUNTS = ('hits', 'misses', 'fills', 'evictions', 'errors', 'too_big', 'files', 'bytes')
+CACHE_FIELDS = dict(zip(CACHE_COUNTS, range(11, 11 + len(CACHE_COUNTS))))
+FIELDS = 11 + len(CACHE_COUNTS)
+STOPPED, PLAYING, PAUSED = range(3)
+COMMANDS = ('load_file', 'queue_file', 'pause', 'unpause', 'stop', 'set_volume', 'set_gain')
+
+
+class StatusBlock:
+    """Fixed block of doubles in shared memory, written by the engine and read by the UI without locks"""
+
+    def __init__(self, values: object):
+        self.values = values
+
+    def write(self, fields: dict) -> None:
+        """Updates fields so a concurrent reader sees either none or all of them"""
+        values = self.values
+        values[SEQ] += 1
+        for field, value in fields.items():
+            values[field] = value
+        values[SEQ] += 1
+
+    def read(self) -> list[float]:
+        """Gets a consistent copy of every field, retrying if the engine was halfway through a write"""
+        values = self.values
+        while True:
+            seq = values[SEQ]
+            if not seq % 2:
+                snapshot = values[:]
+                if values[SEQ] == seq:
+                    return snapshot
+
+
+def end_engine(signum: int, frame: object) -> None:
+    """Takes the helper process down with the engine when the UI gives up waiting and terminates it"""
+    for child in multiprocessing.active_children():
+        child.kill()
+    os._exit(1)
+
+
+def serve(commands: object, values: object, crossfade: float = 0, chunk_ms: int = CHUNK_MS,
+          cache_bytes: int = 0) -> None:
+    """Engine loop of the child process: runs commands from the pipe and publishes the player state"""
+    # The UI must not wait on the engine when it exits, but the engine has to start the helper process that decodes
+    multiprocessing.current_process().daemon = False
+    # SDL would turn SIGTERM into a quit event, and the UI could never terminate a stuck engine
+    os.environ['SDL_NO_SIGNAL_HANDLERS'] = '1'
+    signal.signal(signal.SIGTERM, end_engine)
+    status = StatusBlock(values)
+    player = CrossfadePlayer(crossfade, chunk_ms) if crossfade else MusicPlayer()
+    if cache_bytes:
+        player.audio_cache = AudioCache(cache_bytes)
+    ensure_mixer()
+    ack = transitions = transition_at = finishes = finished_at = errors = 0
+    cache_stats_at = 0.0
+    while True:
+        if commands.poll(ENGINE_TICK):
+            try:
+                ack, name, args = commands.recv()
+            except EOFError:
+                break
+            if name == 'quit':
+                break
+            failed = False
+            if name == 'queue_file' and not args[1]:
+                # The UI could not tell the length from the headers, so the engine decodes the song for it
+                try:
+                    args = (args[0], player.get_length(args[0]))
+                except Exception:  # Still queued, without a length
+                    failed = True
+            try:
+                if name in COMMANDS:
+                    getattr(player, name)(*args)
+            except Exception:  # A song the mixer can not play must not stop the engine
+                player.playing = player.paused = False
+                failed = True
+            errors += failed
+        if player.poll_transition():
+            transitions += 1
+            transition_at = ack
+        if player.finished():
+            finishes += 1
+            finished_at = ack
+        playing = player.playing or player.paused
+        status.write({ACK: ack,
+                      STATE: PLAYING if player.playing else PAUSED if player.paused else STOPPED,
+                      POSITION: player.get_position() * 1000 if playing else 0,
+                      LENGTH: player.total_length if playing else 0,
+                      VOLUME: player.volume,
+                      TRANSITIONS: transitions, TRANSITION_AT: transition_at,
+                      FINISHES: finishes, FINISHED_AT: finished_at, ERRORS: errors})
+        if player.audio_cache is not None and time.monotonic() - cache_stats_at >= CACHE_STATS_INTERVAL:
+            cache_stats_at = time.monotonic()
+            stats = player.audio_cache.stats()
+            status.write({field: stats[name] for name, field in CACHE_FIELDS.items()})
+    player.stop()
+    player.close()
+    # A spawned process waits on its children before it exits, and the helper would wait for work forever
+    stop_decoder()
+
+
+class EngineCacheStats:
+    """Stands in for the AudioCache of the engine, reading its counters from the status block"""
+
+    overlay_lines = AudioCache.overlay_lines
+
+    def __init__(self, player: 'EnginePlayer', budget: int):
+        self.player = player
+        self.budget = budget
+
+    def stats(self) -> dict:
+        """Gets the hit and miss counts and how full the cache is, as the engine last published them"""
+        values = self.player.status.read()
+        stats = {name: int(values[field]) for name, field in CACHE_FIELDS.items()}
+        lookups = stats['hits'] + stats['misses']
+        return {**stats, 'hit_rate': stats['hits'] / lookups if lookups else 0.0, 'budget': self.budget}
+
+
+class EnginePlayer:
+    """Stands in for MusicPlayer, driving one in a child process so UI stalls never hold up audio commands
+
+    Commands go down a pipe without waiting for an answer. Position, length, volume and state come back
+    through a shared status block, so reading them costs no lock and no system call.
+    """
+
+    def __init__(self, crossfade: float = 0, chunk_ms: int = CHUNK_MS, cache_bytes: int = 0):
+        self.crossfade = crossfade
+        self.chunk_ms = chunk_ms
+        self.cache_bytes = cache_bytes
+        self.start()
+        self.sent = 0
+        self.song_changed_at = 0
+        self.current_song_file = ""
+        self.playing = False
+        self.paused = False
+        self.volume = 1
+        self.gain = 1
+        self.queued_file = None
+        self.queued_length = 0
+        # The cache lives in the engine, which is the process that decodes. This only reads its counters
+        self.audio_cache = EngineCacheStats(self, cache_bytes) if cache_bytes else None
+
+    def start(self) -> None:
+        """Spawns the engine process with a fresh status block"""
+        context = multiprocessing.get_context('spawn')
+        self.status = StatusBlock(context.RawArray('d', FIELDS))
+        receiver, self.commands = context.Pipe(duplex=False)
+        self.process = context.Process(target=serve, name='casp-audio', daemon=True,
+                                       args=(receiver, self.status.values, self.crossfade, self.chunk_ms,
+                                             self.cache_bytes))
+        self.process.start()
+        receiver.close()
+        self.seen_transitions = 0
+        self.seen_finishes = 0
+
+    def post(self, name: str, *args) -> None:
+        """Writes one command down the pipe"""
+        self.sent += 1
+        self.commands.send((self.sent, name, args))
+
+    def send(self, name: str, *args) -> None:
+        """Hands a MusicPlayer call to the engine, starting a new engine if the old one died"""
+        try:
+            self.post(name, *args)
+        except OSError:
+            # The engine is gone, e.g. killed or crashed. A new one starts stopped with the same volume
+            self.commands.close()
+            self.process.join(0)
+            self.start()
+            self.playing = self.paused = False
+            self.queued_file = None
+            self.post('set_volume', self.volume)
+            self.post('set_gain', self.gain)
+            self.post(name, *args)
+
+    @property
+    def total_length(self) -> float:
+        """Length of the song in milliseconds as the engine measured it"""
+        return self.status.values[LENGTH]
+
+    def load_file(self, filename: str) -> bool:
+        """Function to load file"""
+        if not os.path.isfile(filename):
+            print(filename + " not found!")
+            return False
+        self.send('load_file', filename)
+        self.song_changed_at = self.sent
+        self.current_song_file = filename
+        self.playing = True
+        self.paused = False
+        self.queued_file = None
+        return True
+
+    def get_length(self, filename: str) -> float:
+        """Gets the song length in seconds from the file headers, 0 if only the engine can tell by decoding"""
+        length = probe_duration(filename)
+        return length if length is not None else 0.0
+
+    def pause(self) -> None:
+        """Function to pause music"""
+        self.send('pause')
+        self.paused = self.playing or self.paused
+        self.playing = False
+
+    def stop(self) -> None:
+        """Function to stop music"""
+        self.send('stop')
+        self.song_changed_at = self.sent
+        self.playing = False
+        self.paused = False
+        self.queued_file = None
+
+    def unpause(self) -> None:
+        """Function to unpause music"""
+        if self.paused:
+            self.send('unpause')
+            self.playing = True
+            self.paused = False
+
+    def set_volume(self, volume: float) -> None:
+        """Sets volumes (0.0 to 1.0)"""
+        self.volume = volume
+        self.send('set_volume', volume)
+
+    def set_gain(self, gain: float) -> None:
+        """Scales the volume for the loudness of the song (0.0 to 1.0)"""
+        if gain != self.gain:
+            self.gain = gain
+            self.send('set_gain', gain)
+
+    def get_percent(self) -> float:
+        """Gets percent of song passed"""
+        values = self.status.read()
+        return values[POSITION] / values[LENGTH] * 100 if values[LENGTH] else 0.0
+
+    def get_position(self) -> float:
+        """Gets how far into the song the engine is, in seconds"""
+        return self.status.values[POSITION] / 1000
+
+    def queue_file(self, filename: str, length: float) -> None:
+        """Hands the next song to the engine so it starts without a gap when the current one ends"""
+        self.send('queue_file', filename, length)
+        self.queued_file = filename
+        self.queued_length = length * 1000
+
+    def poll_transition(self) -> bool:
+        """Checks whether the engine moved on to the queued song since the last call"""
+        values = self.status.read()
+        if values[TRANSITIONS] == self.seen_transitions:
+            return False
+        self.seen_transitions = values[TRANSITIONS]
+        # A transition the engine saw before it got the latest song change is stale
+        if values[TRANSITION_AT] < self.song_changed_at or not self.queued_file:
+            return False
+        self.current_song_file = self.queued_file
+        self.queued_file = None
+        return True
+
+    def finished(self) -> bool:
+        """Checks whether the song ran out on its own since the last call"""
+        values = self.status.read()
+        if values[FINISHES] == self.seen_finishes:
+            return False
+        self.seen_finishes = values[FINISHES]
+        if values[FINISHED_AT] < self.song_changed_at or not self.playing:
+            return False
+        self.playing = False
+        return True
+
+    def close(self) -> None:
+        """Stops the engine"""
+        try:
+            self.post('quit')
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
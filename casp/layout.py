@@ -0,0 +1,46 @@
+from typing import Callable
+
+from casp.Widgets import Widget
+
+# A rule gets the terminal (height, width) and the (lines, width) the widget measures, and returns its (row, column)
+Rule = Callable[[int, int, tuple[int, int]], tuple[int, int]]
+
+
+class Layout:
+    """Widget positions computed once per terminal size and widget extent instead of on every frame"""
+
+    def __init__(self, height: int = 0, width: int = 0):
+        self.height = height
+        self.width = width
+        self.rules = {}
+        self.geometry = {}
+
+    @property
+    def size(self) -> tuple[int, int]:
+        """The (height, width) the widgets are laid out for"""
+        return self.height, self.width
+
+    def resize(self, height: int, width: int) -> bool:
+        """Lays out for a new terminal size, returns False if the size did not change"""
+        if (height, width) == (self.height, self.width):
+            return False
+        self.height = height
+        self.width = width
+        self.geometry.clear()
+        return True
+
+    def place(self, widget: Widget, rule: Rule) -> None:
+        """Positions a widget by a rule, e.g. to anchor it to the bottom of the terminal"""
+        self.rules[widget] = rule
+        self.geometry.pop(widget, None)
+        widget.get_position = lambda: self.position(widget)
+
+    def position(self, widget: Widget) -> tuple[int, int]:
+        """Gets where a widget goes, running its rule only when the size or the widget's extent changed"""
+        extent = widget.measure()
+        cached = self.geometry.get(widget)
+        if cached is not None and cached[0] == extent:
+            return cached[1]
+        position = self.rules[widget](self.height, self.width, extent)
+        self.geometry[widget] = (extent, position)
+        return position
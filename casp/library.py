@@ -0,0 +1,181 @@
+import os
+from os.path import abspath, join
+from typing import Iterable, Iterator
+
+from casp.cache import cache_path, load_json, save_json
+
+INDEX_VERSION = 1
+
+
+class LibraryIndex:
+    """Recursive index of music files under a directory that is kept on disk between launches"""
+
+    def __init__(self, root: str, extensions: list[str], index_file: str = None, recursive: bool = True):
+        self.root = abspath(root)
+        self.extensions = {ext.lower() for ext in extensions}
+        self.index_file = index_file if index_file else cache_path('library', self.root)
+        self.recursive = recursive
+        self.dirs = {}
+        self.scanned_dirs = 0
+        self.loaded = False
+
+    def load(self) -> None:
+        """Loads the index saved by a previous launch"""
+        data = load_json(self.index_file, {})
+        if data.get('version') == INDEX_VERSION and data.get('root') == self.root \
+                and data.get('recursive') == self.recursive:
+            self.dirs = data.get('dirs', {})
+        self.loaded = True
+
+    def save(self) -> bool:
+        """Saves the index for the next launch"""
+        return save_json(self.index_file, {'version': INDEX_VERSION, 'root': self.root,
+                                           'recursive': self.recursive, 'dirs': self.dirs})
+
+    def scan(self) -> bool:
+        """Brings the index up to date, only listing directories whose mtime changed. Returns True if it changed"""
+        if not self.loaded:
+            self.load()
+        old = self.dirs
+        self.dirs = {}
+        self.scanned_dirs = 0
+        changed = False
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            try:
+                mtime = os.stat(join(self.root, rel)).st_mtime_ns
+            except OSError:
+                changed = True
+                continue
+            entry = old.get(rel)
+            if entry is None or entry['mtime'] != mtime:
+                entry = self.scan_dir(rel, mtime)
+                changed = True
+            self.dirs[rel] = entry
+            pending.extend(join(rel, name) for name in reversed(entry['dirs']))
+        if changed or len(old) != len(self.dirs):
+            self.save()
+            return True
+        return False
+
+    def changed_dirs(self) -> list[str]:
+        """Gets the indexed directories whose mtime changed, with one stat per directory and none per file"""
+        changed = []
+        for rel, entry in list(self.dirs.items()):
+            try:
+                mtime = os.stat(join(self.root, rel)).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != entry['mtime']:
+                changed.append(rel)
+        return changed
+
+    def refresh(self, rels: Iterable[str], force: bool = False) -> tuple[list, list, list]:
+        """Rescans only the given directories and returns the (added, removed, changed) files as (path, stat) pairs
+
+        New subdirectories are scanned in full and vanished ones are dropped with everything below them.
+        A directory whose mtime did not change is skipped unless force is set, e.g. after a file was rewritten.
+        """
+        added, removed, changed = [], [], []
+        pending = list(rels)
+        while pending:
+            rel = pending.pop()
+            old = self.dirs.get(rel)
+            try:
+                mtime = os.stat(join(self.root, rel)).st_mtime_ns
+            except OSError:
+                self.drop_dir(rel, removed)
+                continue
+            if old is not None and old['mtime'] == mtime and not force:
+                continue
+            entry = self.scan_dir(rel, mtime)
+            self.dirs[rel] = entry
+            old_files = old['files'] if old else {}
+            for name, stat in entry['files'].items():
+                if name not in old_files:
+                    added.append((join(rel, name), tuple(stat)))
+                elif old_files[name] != stat:
+                    changed.append((join(rel, name), tuple(stat)))
+            removed.extend((join(rel, name), tuple(stat)) for name, stat in old_files.items()
+                           if name not in entry['files'])
+            old_dirs = set(old['dirs']) if old else set()
+            pending.extend(join(rel, name) for name in entry['dirs'] if name not in old_dirs)
+            for name in old_dirs.difference(entry['dirs']):
+                self.drop_dir(join(rel, name), removed)
+        return added, removed, changed
+
+    def restat(self) -> list[tuple[str, tuple]]:
+        """Stats every indexed file again and returns the ones rewritten in place as (path, stat) pairs
+
+        Rewriting a file leaves the mtime of its directory alone, so scan and refresh never notice it.
+        """
+        changed = []
+        for rel, entry in list(self.dirs.items()):
+            files = entry['files']
+            for name, stat in list(files.items()):
+                try:
+                    st = os.stat(join(self.root, rel, name))
+                except OSError:
+                    continue
+                current = [st.st_size, st.st_mtime_ns]
+                if current != stat:
+                    files[name] = current
+                    changed.append((join(rel, name), tuple(current)))
+        return changed
+
+    def drop_dir(self, rel: str, removed: list) -> None:
+        """Forgets a directory and everything below it, collecting its files as (path, stat) pairs"""
+        entry = self.dirs.pop(rel, None)
+        if entry is None:
+            return
+        removed.extend((join(rel, name), tuple(stat)) for name, stat in entry['files'].items())
+        for name in entry['dirs']:
+            self.drop_dir(join(rel, name), removed)
+
+    def scan_dir(self, rel: str, mtime: int) -> dict:
+        """Lists a single directory with scandir, keeping size and mtime of each music file"""
+        files = {}
+        dirs = []
+        self.scanned_dirs += 1
+        try:
+            with os.scandir(join(self.root, rel)) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file():
+                            if os.path.splitext(entry.name)[1].lower() in self.extensions:
+                                st = entry.stat()
+                                files[entry.name] = [st.st_size, st.st_mtime_ns]
+                        elif self.recursive and entry.is_dir(follow_symlinks=False) \
+                                and not entry.name.startswith('.'):
+                            dirs.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        return {'mtime': mtime, 'files': dict(sorted(files.items())), 'dirs': sorted(dirs)}
+
+    def files(self) -> Iterator[str]:
+        """Yields the indexed files as paths relative to the root, in directory order"""
+        for rel, names in self.listing():
+            for name in names:
+                yield join(rel, name)
+
+    def listing(self) -> Iterator[tuple[str, list[str]]]:
+        """Yields (directory, file names) for every indexed directory, in the order files yields the paths"""
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            entry = self.dirs.get(rel)
+            if entry is None:
+                continue
+            yield rel, list(entry['files'])
+            pending.extend(join(rel, name) for name in reversed(entry['dirs']))
+
+    def stat(self, path: str) -> tuple[int, int]:
+        """Gets the indexed (size, mtime) of a file relative to the root"""
+        rel, name = os.path.split(path)
+        entry = self.dirs.get(rel)
+        if entry is None or name not in entry['files']:
+            return None
+        return tuple(entry['files'][name])
@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from contextlib import nullcontext
+from typing import Callable
+
+from casp.cache import cache_path, load_json, save_json
+from casp.decode import PcmStream, start_worker
+from casp.probe import probe_duration
+
+CACHE_VERSION = 1
+BATCH_SIZE = 4
+SAVE_INTERVAL = 5.0
+# ReplayGain plays pink noise at -20 dBFS RMS at its reference level
+TARGET_DB = -20.0
+WINDOW_SECONDS = 0.05
+PERCENTILE = 95
+# pygame decodes compressed songs whole, so longer ones are left alone to keep the workers' memory flat
+MAX_DECODED_SECONDS = 1800
+# How many workers may hold a whole decoded song at once, up to about 300 MB each at MAX_DECODED_SECONDS
+MAX_WHOLE_DECODES = 1
+
+# Set in the workers to the semaphore they share for MAX_WHOLE_DECODES
+whole_decodes = None
+
+
+def start_analysis_worker(slots: object) -> None:
+    """Sets up a worker process as a decoding helper that takes turns at decoding songs whole"""
+    global whole_decodes
+    start_worker()
+    whole_decodes = slots
+
+
+def analyse(filename: str) -> dict:
+    """Measures the gain in dB that brings a song to the target loudness, and its peak sample
+
+    Like ReplayGain, the loudness is the 95th percentile of the RMS of 50 ms windows, but without the
+    equal loudness filter. Only the window levels are kept, WAV files are read block by block and the workers
+    take turns at songs that are decoded whole.
+    """
+    import numpy as np
+    compressed = not filename.lower().endswith('.wav')
+    if compressed and (probe_duration(filename) or 0) > MAX_DECODED_SECONDS:
+        raise ValueError(f'{filename} is too long to decode at once')
+    carry = np.zeros(0, np.float32)
+    levels = []
+    peak = 0.0
+    # WAV files are streamed, any other song is in memory whole until it is measured
+    with whole_decodes if compressed and whole_decodes is not None else nullcontext():
+        stream = PcmStream(filename)
+        window = max(1, int(stream.rate * WINDOW_SECONDS))
+        try:
+            for block in stream.blocks():
+                peak = max(peak, float(np.abs(block).max(initial=0)))
+                squares = np.concatenate((carry, (block * block).mean(axis=1)))
+                whole = len(squares) - len(squares) % window
+                levels.append(squares[:whole].reshape(-1, window).mean(axis=1))
+                carry = squares[whole:]
+        finally:
+            stream.close()
+    levels = np.concatenate(levels) if levels else carry
+    if not len(levels):
+        raise ValueError(f'{filename} has no samples')
+    loudness = 10 * np.log10(max(float(np.percentile(levels, PERCENTILE)), 1e-10))
+    return {'gain': round(float(TARGET_DB - loudness), 2), 'peak': round(peak, 4)}
+
+
+def analyse_batch(root: str, batch: list[tuple[str, tuple]]) -> list[tuple[str, dict]]:
+    """Worker task that analyses a batch of songs"""
+    results = []
+    for path, stat in batch:
+        try:
+            entry = analyse(os.path.join(root, path))
+        except Exception:  # A bad file gets an entry too, so it is not analysed again on every launch
+            entry = {'gain': None, 'peak': None}
+        entry['stat'] = list(stat) if stat else None
+        results.append((path, entry))
+    return results
+
+
+class LoudnessStore:
+    """Gain cache for a library that fills in on a process pool and persists between launches
+
+    Results are saved every few seconds while the analysis runs, so an interrupted run picks up where it
+    stopped the next time. Closing the store kills the workers, so quitting never waits on a long song.
+    """
+
+    def __init__(self, root: str, cache_file: str = None, workers: int = None):
+        self.root = os.path.abspath(root)
+        self.cache_file = cache_file if cache_file else cache_path('loudness', self.root)
+        self.workers = workers
+        self.gains = {}
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.pool = None
+        self.closed = False
+        self.outstanding = 0
+        self.changed = False
+        self.saved_at = 0.0
+        self.loaded = False
+
+    def load(self) -> None:
+        """Loads the gains saved by a previous launch"""
+        data = load_json(self.cache_file, {})
+        if data.get('version') == CACHE_VERSION and data.get('root') == self.root:
+            self.gains = data.get('gains', {})
+        self.loaded = True
+
+    def save(self) -> bool:
+        """Saves the gains for the next launch, one save at a time"""
+        with self.save_lock:
+            with self.lock:
+                data = {'version': CACHE_VERSION, 'root': self.root, 'gains': dict(self.gains)}
+                self.changed = False
+                self.saved_at = time.monotonic()
+            return save_json(self.cache_file, data)
+
+    def get(self, path: str, stat: tuple = None) -> dict:
+        """Gets the analysis of a song, or None if it is missing or older than stat (size, mtime)"""
+        entry = self.gains.get(path)
+        if entry is None or stat is not None and entry['stat'] != list(stat):
+            return None
+        return entry
+
+    def factor(self, path: str) -> float:
+        """Gets the volume factor for a song, only ever turning loud songs down since the mixer can not boost"""
+        entry = self.gains.get(path)
+        if entry is None or entry['gain'] is None:
+            return 1.0
+        return min(1.0, 10 ** (entry['gain'] / 20))
+
+    def fill(self, paths: list[str], stat: Callable[[str], tuple]) -> int:
+        """Analyses every song that is not cached yet in the background. Returns how many were queued"""
+        if not self.loaded:
+            self.load()
+        missing = [path for path in paths if self.get(path, stat(path)) is None]
+        if not missing:
+            return 0
+        if self.closed:
+            return 0
+        if self.pool is None:
+            # Imported here to keep it off the startup path
+            import multiprocessing
+
+            # Spawned rather than forked, a fork would copy the mixer and the UI threads
+            context = multiprocessing.get_context('spawn')
+            self.pool = context.Pool(self.workers, initializer=start_analysis_worker,
+                                     initargs=(context.Semaphore(MAX_WHOLE_DECODES),))
+        for start in range(0, len(missing), BATCH_SIZE):
+            batch = [(path, stat(path)) for path in missing[start:start + BATCH_SIZE]]
+            with self.lock:
+                self.outstanding += 1
+            self.pool.apply_async(analyse_batch, (self.root, batch), callback=self.collect,
+                                  error_callback=lambda err: self.collect([]))
+        return len(missing)
+
+    def collect(self, results: list[tuple[str, dict]]) -> None:
+        """Keeps the results of a finished batch, saving them every few seconds and at the end"""
+        with self.lock:
+            if self.closed:
+                return
+            for path, entry in results:
+                self.gains[path] = entry
+            self.changed = self.changed or bool(results)
+            self.outstanding -= 1
+            due = self.changed and (self.outstanding == 0 or time.monotonic() - self.saved_at > SAVE_INTERVAL)
+        if due:
+            self.save()
+
+    def close(self) -> None:
+        """Stops the analysis, keeping what finished so far"""
+        with self.lock:
+            self.closed = True
+        if self.pool is not None:
+            # Batches that are still running are thrown away, they would hold up the exit
+            self.pool.terminate()
+            self.pool = None
+        if self.changed:
+            self.save()
@@ -1,39 +1,227 @@
 #!/usr/bin/env python
 
+import argparse
+import json
 import os
 
 from blessed import Terminal
 
+from casp import IMPORT_STARTED, metrics
+from casp.audiocache import AudioCache
+from casp.cache import cache_dir
+from casp.control import COMMANDS, RemoteEventHandler, send_command
+from casp.crossfade import CHUNK_MS, CrossfadePlayer
+from casp.daemon import run_daemon
+from casp.decode import numpy_available
+from casp.engine import EnginePlayer
 from casp.FileHandling import FileHandler
-from casp.music import MusicEventHandler
+from casp.loudness import LoudnessStore
+from casp.metadata import MetadataStore, display_name
+from casp.music import MusicEventHandler, MusicPlayer, preload_mixer
 from casp.MusicTerminal import MusicTerminal
-from casp.Widgets import Option, ProgressBarWidget, SelectWidget
+from casp.profiling import StartupProfile
+from casp.search import SearchIndex
+from casp.tracks import TrackOptions
+from casp.visualizer import VISUAL_FPS, Visualizer
+from casp.Widgets import (
+    ArtWidget, LabelWidget, Option, ProgressBarWidget, SelectWidget
+)
 
-os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+END_CHECK_INTERVAL = 0.25
+TAGS_INTERVAL = 0.5
+CHANGES_INTERVAL = 0.5
+
+
+def parse_args() -> argparse.Namespace:
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(prog='casp', description='Music file viewer and player')
+    parser.add_argument('--tick-rate', type=float, default=10,
+                        help='how many times a second the progress bar is updated (default: 10)')
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='print how long import, scan, init and first paint took on exit')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='collect frame, key to paint, song load and tick timings from the start and write them '
+                             'to FILE on exit (F3 shows them while running)')
+    parser.add_argument('--audio-process', action='store_true',
+                        help='run the audio engine in a child process so a slow terminal never delays playback')
+    parser.add_argument('--crossfade', type=float, default=0, metavar='SECONDS',
+                        help='fade each song into the next over SECONDS (needs numpy, default: off)')
+    parser.add_argument('--chunk-ms', type=int, default=CHUNK_MS, metavar='MS',
+                        help='size of the chunks the crossfade streams, longer ones use less CPU but react slower '
+                             f'to pause and volume (default: {CHUNK_MS})')
+    parser.add_argument('--audio-cache', type=int, default=0, metavar='MB',
+                        help='keep up to MB of decoded mp3, flac and ogg songs on disk so replays start at once '
+                             '(needs numpy, default: off)')
+    parser.add_argument('--normalize', action='store_true',
+                        help='analyse the loudness of every song in the background and turn the loud ones down '
+                             '(needs numpy)')
+    parser.add_argument('--daemon', action='store_true',
+                        help='play the current directory with no TUI, controlled through a socket (see casp ctl)')
+    parser.add_argument('--attach', action='store_true', help='run the TUI as a remote for a running daemon')
+    parser.add_argument('--socket', metavar='PATH', help='control socket of the daemon (default: casp.sock in '
+                                                         '$XDG_RUNTIME_DIR or the cache directory)')
+    subcommands = parser.add_subparsers(dest='command')
+    ctl = subcommands.add_parser('ctl', help='send a command to a running daemon')
+    ctl.add_argument('action', choices=COMMANDS)
+    ctl.add_argument('value', nargs='?', help='song to play, relative to the daemon directory, or volume from 0 to 1')
+    ctl.add_argument('--socket', metavar='PATH', default=argparse.SUPPRESS, help='control socket of the daemon')
+    ctl.add_argument('--json', action='store_true', help='print the raw reply')
+    return parser.parse_args()
+
+
+def run_ctl(args: argparse.Namespace) -> None:
+    """Sends one command to a running daemon and prints what it is playing"""
+    request = {'cmd': args.action}
+    if args.action == 'volume':
+        if args.value is None:
+            exit('casp ctl volume needs a level from 0 to 1')
+        request['value'] = args.value
+    elif args.value:
+        request['file'] = args.value
+    try:
+        reply = send_command(request, args.socket)
+    except OSError as err:
+        exit(f'casp: no daemon on {args.socket or "the default socket"}: {err}')
+    if args.json:
+        print(json.dumps(reply))
+    elif not reply.get('ok'):
+        exit(f"casp: {reply.get('error')}")
+    else:
+        print(describe_status(reply['status']))
+
+
+def describe_status(status: dict) -> str:
+    """Gets a one line summary of a daemon status"""
+    state = 'playing' if status['playing'] else 'paused' if status['paused'] else 'stopped'
+    position, length = int(status['position']), int(status['length'])
+    line = (f"{state} {status['song'] or '-'} {position // 60}:{position % 60:02d}/{length // 60}:{length % 60:02d}"
+            f" volume {round(status['volume'] * 100)}% shuffle {'on' if status['shuffle'] else 'off'}"
+            f" repeat {status['repeat']}")
+    cache = status.get('cache')
+    if cache:
+        line += f" cache {cache['hit_rate']:.0%} hits {cache['bytes'] >> 20}/{cache['budget'] >> 20} MB"
+    return line
+
+
+def show_tags(menu: SelectWidget, tags: MetadataStore, options: TrackOptions) -> bool:
+    """Relabels the menu options whose tags arrived since the last call"""
+    arrived = tags.drain()
+    for file in arrived:
+        index = options.row_of(options.table.find(file))
+        if index < 0:
+            continue
+        menu.set_option_graphic(index, [display_name(tags.get(file), file)])
+        if menu.search is not None:
+            menu.search.update(index, search_text(menu.options[index]))
+    return bool(arrived)
+
+
+def show_changes(menu: SelectWidget, options: TrackOptions, fh: FileHandler, tags: MetadataStore,
+                 music_event: MusicEventHandler) -> bool:
+    """Slots files that were added, removed or renamed since the last call into the menu and the queue"""
+    changes = fh.changes()
+    if not changes:
+        return False
+    table = options.table
+    for change in changes:
+        chosen = False
+        if change[0] in ('remove', 'rename'):
+            index = options.row_of(table.find(change[1]))
+            if index >= 0:
+                chosen = menu.choiceindex == index
+                menu.remove_option(index)
+                if menu.search is not None:
+                    menu.search.remove(index)
+        if change[0] in ('add', 'rename'):
+            path = change[-1]
+            option = Option([display_name(tags.get(path), path)], path)
+            index = options.row_for(table.add(path))
+            menu.insert_option(index, option)
+            if menu.search is not None:
+                menu.search.insert(index, search_text(option))
+            if change[0] == 'rename' and chosen:
+                menu.choiceindex = index
+    if menu.query:
+        menu.set_query(menu.query)
+    music_event.apply_changes(changes)
+    tags.fill([change[-1] for change in changes if change[0] != 'remove'], fh.library.stat)
+    return True
+
+
+def search_text(option: Option) -> str:
+    """Gets the text the menu search matches an option against: its label and its file name"""
+    return f'{option.graphic[0]}\n{option.choice}'
+
+
+def now_playing(tags: MetadataStore, songfile: str) -> str:
+    """Gets the artist, title and album of the song that is playing"""
+    if not songfile:
+        return ''
+    info = tags.get(songfile)
+    label = display_name(info, songfile)
+    if info and info.get('album'):
+        label += f" ({info['album']})"
+    return label
+
+
+def make_player(args: argparse.Namespace) -> MusicPlayer:
+    """Gets the player the command line asks for"""
+    if (args.crossfade or args.audio_cache) and not numpy_available():
+        exit('casp: --crossfade and --audio-cache need numpy, pip install casp[visualizer]')
+    cache_bytes = args.audio_cache << 20
+    if args.audio_process:
+        return EnginePlayer(args.crossfade, args.chunk_ms, cache_bytes)
+    player = CrossfadePlayer(args.crossfade, args.chunk_ms) if args.crossfade else MusicPlayer()
+    if cache_bytes:
+        player.audio_cache = AudioCache(cache_bytes)
+    return player
 
 
 def run() -> None:
     """Runs the program"""
+    args = parse_args()
+    if args.command == 'ctl':
+        return run_ctl(args)
+    if args.daemon:
+        return run_daemon(os.curdir, args.socket, args.normalize, make_player(args))
+    profile = StartupProfile(IMPORT_STARTED) if args.startup_profile else None
+    mark = profile.mark if profile else lambda phase: None
+    mark('import')
+    if args.metrics:
+        metrics.enable()
     term = Terminal()
-    m = MusicTerminal(term)
+    m = MusicTerminal(term, tick_rate=args.tick_rate)
     MUSIC_DIR = os.curdir
 
     controls = SelectWidget([Option([" play "], "play"),
                              Option([" |<< "], "previous"),
                              Option([" pause "], "pause"),
-                             Option([" >>| "], "next")], layout="Horizontal", terminal=term)
+                             Option([" >>| "], "next"),
+                             Option([" shuffle "], "shuffle"),
+                             Option([" repeat "], "repeat")], layout="Horizontal", terminal=term)
 
     fh = FileHandler(MUSIC_DIR)
     files = fh.files
     if len(files) == 0:
         exit("No music files were found")
-    filenames = []
+    mark('scan')
 
-    for file in files:
-        filenames.append(Option([file], file))
+    tags = MetadataStore(MUSIC_DIR)
+    tags.load()
+    mark('tag cache')
+    # Options are made from the shared track table on demand, only tagged songs keep a label of their own
+    filenames = TrackOptions(files)
+    for index, file in enumerate(files):
+        info = tags.get(file)
+        if info:
+            label = display_name(info, file)
+            if label != file:
+                filenames.graphics[index] = [label]
 
-    music_menu = SelectWidget(filenames, terminal=term)
+    music_menu = SelectWidget(filenames, terminal=term, viewport=term.height - 11)
+    music_menu.get_viewport_height = lambda: m.layout.height - 11
     music_menu.name = 'filename'
+    music_menu.search = SearchIndex([search_text(option) for option in filenames])
 
     mini_controls = SelectWidget([Option([" <<< "], "previous"),
                                   Option([" Play "], "play"),
@@ -51,23 +239,80 @@ def run() -> None:
     volct.name = 'volume'
 
     progressbar = ProgressBarWidget('progressbar', term.width - 12, terminal=term)
+    loudness = LoudnessStore(MUSIC_DIR) if args.normalize and not args.attach else None
+    if loudness is not None:
+        loudness.load()
 
-    music_event = MusicEventHandler(MUSIC_DIR, progress_bar=progressbar)
+    if args.attach:
+        try:
+            music_event = RemoteEventHandler(progressbar, m.scheduler, args.socket)
+        except OSError as err:
+            exit(f'casp: no daemon to attach to: {err}')
+    else:
+        music_event = MusicEventHandler(MUSIC_DIR, progress_bar=progressbar, file_handler=fh,
+                                        tick_interval=1 / args.tick_rate,
+                                        player=make_player(args), loudness=loudness)
+        cache = music_event.musicplayer.audio_cache
+        if cache is not None:
+            m.stats_widget.get_lines = lambda: metrics.overlay_lines() + cache.overlay_lines()
+    nowplaying = LabelWidget('nowplaying', terminal=term)
+    # An attached TUI says so in place of the song while the daemon is gone
+    message = (lambda: music_event.message) if args.attach else str
+    nowplaying.get_text = lambda: (message() or now_playing(tags, music_event.currentsong))[:m.layout.width - 4]
+    nowplaying.position = (0, 2)
     music_menu.position = (4, 2)
-    music_menu.get_position = lambda: (4, int(m.term.width/2 - music_menu.get_dimensions()[1]/2))
     music_event.position = (len(music_menu.options) + 4, 2)
-    volct.get_position = lambda: (m.term.height - 2, m.term.width - volct.get_dimensions()[0] - 5)
-    progressbar.get_position = lambda: (m.term.height - 6, 2)
-    controls.get_position = lambda: (m.term.height - 2, 2)
+    m.layout.place(music_menu, lambda height, width, extent: (4, int(width / 2 - extent[1] / 2)))
+    m.layout.place(volct, lambda height, width, extent: (height - 2, width - extent[1] - 5))
+    m.layout.place(progressbar, lambda height, width, extent: (height - 6, 2))
+    m.layout.place(controls, lambda height, width, extent: (height - 2, 2))
     m.add_widget(music_menu)
     m.add_widget(music_event.progress_bar)
     m.add_widget(volct)
     m.add_widget(controls)
+    m.add_widget(nowplaying)
     m.small_window_widget = mini_controls
 
+    # F4 swaps the menu for the cover art, then a waveform overview and a spectrum, of the song that is playing
+    art = ArtWidget('art', terminal=term)
+    art.position = (2, 0)
+    art.get_size = lambda: (m.layout.height - 8, m.layout.width)
+    m.add_overlay(art)
+    visualizer = Visualizer(art, (lambda: music_event.state) if args.attach else music_event.status,
+                            m.styles.gen_art_dim)
+    m.add_key_handler('KEY_F4', visualizer.cycle)
+    m.add_tick_source(visualizer.tick, 1 / VISUAL_FPS)
+
     m.add_event_subscriber(music_event)
     m.add_event_subscriber(fh)
     m.add_event_subscriber(progressbar)
-    m.dummypublishers.append(music_event)
+    m.add_tick_source(music_event.run)
+    m.add_tick_source(music_event.check_end, END_CHECK_INTERVAL)
+    m.add_tick_source(lambda: show_tags(music_menu, tags, filenames), TAGS_INTERVAL)
+    if not args.attach:
+        m.add_tick_source(lambda: show_changes(music_menu, filenames, fh, tags, music_event), CHANGES_INTERVAL)
     music_event.add_publisher(progressbar)
-    m.run()
+    mark('ui')
+
+    def on_first_paint() -> None:
+        mark('first paint')
+        tags.fill(files, fh.library.stat)
+        if not args.attach:
+            fh.watch()
+        if loudness is not None:
+            loudness.fill(files, fh.library.stat)
+        if not args.attach and not args.audio_process:
+            preload_mixer(lambda started: profile.time_background('mixer init', started) if profile else None)
+
+    try:
+        m.run(on_first_paint)
+    finally:
+        if not args.attach:
+            music_event.musicplayer.close()
+        if loudness is not None:
+            loudness.close()
+        if metrics.enabled:
+            # Timings turned on with F3 alone still get written, next to the caches
+            metrics.dump(args.metrics if args.metrics else os.path.join(cache_dir(), 'metrics.json'))
+    if profile:
+        profile.report()
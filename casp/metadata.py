@@ -0,0 +1,318 @@
+import os
+import struct
+import threading
+from typing import Callable, Iterator
+
+from casp.cache import cache_path, load_json, save_json
+
+CACHE_VERSION = 1
+BATCH_SIZE = 256
+OGG_HEADER_LIMIT = 1 << 18
+TAG_FIELDS = ('title', 'artist', 'album')
+
+ID3_FRAMES = {'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album',
+              'TT2': 'title', 'TP1': 'artist', 'TAL': 'album'}
+VORBIS_FIELDS = {'TITLE': 'title', 'ARTIST': 'artist', 'ALBUM': 'album'}
+TEXT_ENCODINGS = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}
+PICTURE_BLOCK = 6
+FRONT_COVER = 3
+
+
+def syncsafe(data: bytes) -> int:
+    """Decodes a 28 bit syncsafe integer"""
+    return (data[0] & 0x7f) << 21 | (data[1] & 0x7f) << 14 | (data[2] & 0x7f) << 7 | (data[3] & 0x7f)
+
+
+def read_id3v2_frames(f: object) -> Iterator[tuple[str, bytes]]:
+    """Yields (frame id, frame body) from the ID3v2 tag at the start of a file"""
+    f.seek(0)
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return
+    version, flags = header[3], header[5]
+    tag = f.read(syncsafe(header[6:10]))
+    if flags & 0x80 and version < 4:
+        tag = tag.replace(b'\xff\x00', b'\xff')
+    pos = 0
+    if flags & 0x40 and version >= 3:
+        pos = syncsafe(tag[0:4]) if version == 4 else struct.unpack('>I', tag[0:4])[0] + 4
+    id_size, header_size = (3, 6) if version == 2 else (4, 10)
+    while pos + header_size <= len(tag):
+        frame_id = tag[pos:pos + id_size]
+        if not frame_id.strip(b'\x00') or not frame_id.isalnum():
+            return
+        if version == 2:
+            size = int.from_bytes(tag[pos + 3:pos + 6], 'big')
+        elif version == 4:
+            size = syncsafe(tag[pos + 4:pos + 8])
+        else:
+            size = struct.unpack('>I', tag[pos + 4:pos + 8])[0]
+        body = tag[pos + header_size:pos + header_size + size]
+        pos += header_size + size
+        yield frame_id.decode('latin-1'), body
+
+
+def decode_text_frame(body: bytes) -> str:
+    """Decodes the text of an ID3v2 text frame"""
+    if not body:
+        return ''
+    encoding = TEXT_ENCODINGS.get(body[0], 'latin-1')
+    return body[1:].decode(encoding, 'replace').split('\x00')[0].strip()
+
+
+def read_id3v1(f: object, size: int) -> dict:
+    """Reads the fixed 128 byte ID3v1 tag at the end of a file"""
+    if size < 128:
+        return {}
+    f.seek(size - 128)
+    data = f.read(128)
+    if data[:3] != b'TAG':
+        return {}
+    fields = {'title': data[3:33], 'artist': data[33:63], 'album': data[63:93]}
+    tags = {}
+    for key, raw in fields.items():
+        text = raw.split(b'\x00')[0].decode('latin-1').strip()
+        if text:
+            tags[key] = text
+    return tags
+
+
+def read_flac_blocks(f: object) -> Iterator[tuple[int, bytes]]:
+    """Yields (block type, block body) for the metadata blocks of a FLAC file"""
+    f.seek(0)
+    head = f.read(10)
+    start = 10 + syncsafe(head[6:10]) if head[:3] == b'ID3' else 0
+    f.seek(start)
+    if f.read(4) != b'fLaC':
+        return
+    last = False
+    while not last:
+        header = f.read(4)
+        if len(header) < 4:
+            return
+        last = bool(header[0] & 0x80)
+        yield header[0] & 0x7f, f.read(int.from_bytes(header[1:4], 'big'))
+
+
+def parse_vorbis_comment(data: bytes) -> dict:
+    """Parses a Vorbis comment block as used by Ogg Vorbis, Opus and FLAC"""
+    tags = {}
+    vendor_length = struct.unpack('<I', data[0:4])[0]
+    pos = 4 + vendor_length
+    count = struct.unpack('<I', data[pos:pos + 4])[0]
+    pos += 4
+    for _ in range(count):
+        if pos + 4 > len(data):
+            break
+        length = struct.unpack('<I', data[pos:pos + 4])[0]
+        comment = data[pos + 4:pos + 4 + length].decode('utf-8', 'replace')
+        pos += 4 + length
+        key, _, value = comment.partition('=')
+        field = VORBIS_FIELDS.get(key.upper())
+        if field and value and field not in tags:
+            tags[field] = value.strip()
+    return tags
+
+
+def read_ogg_packets(f: object, count: int) -> list[bytes]:
+    """Reassembles the first count packets of an Ogg stream from its page lacing"""
+    f.seek(0)
+    packets = []
+    packet = b''
+    read = 0
+    while len(packets) < count and read < OGG_HEADER_LIMIT:
+        header = f.read(27)
+        if len(header) < 27 or header[:4] != b'OggS':
+            break
+        lacing = f.read(header[26])
+        body = f.read(sum(lacing))
+        read += 27 + len(lacing) + len(body)
+        pos = 0
+        for size in lacing:
+            packet += body[pos:pos + size]
+            pos += size
+            if size < 255:
+                packets.append(packet)
+                packet = b''
+    return packets[:count]
+
+
+def read_tags(filename: str) -> dict:
+    """Reads title, artist and album from the headers of a music file"""
+    tags = {}
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        magic = f.read(4)
+        if magic == b'OggS':
+            packets = read_ogg_packets(f, 2)
+            if len(packets) == 2:
+                if packets[1][:7] == b'\x03vorbis':
+                    tags = parse_vorbis_comment(packets[1][7:])
+                elif packets[1][:8] == b'OpusTags':
+                    tags = parse_vorbis_comment(packets[1][8:])
+            return tags
+        for block_type, body in read_flac_blocks(f):
+            if block_type == 4:
+                return parse_vorbis_comment(body)
+        for frame_id, body in read_id3v2_frames(f):
+            field = ID3_FRAMES.get(frame_id)
+            if field and field not in tags:
+                text = decode_text_frame(body)
+                if text:
+                    tags[field] = text
+        if len(tags) < len(TAG_FIELDS):
+            for key, value in read_id3v1(f, size).items():
+                tags.setdefault(key, value)
+    return tags
+
+
+def split_terminated(data: bytes, pos: int, encoding: int) -> int:
+    """Gets the position after the null terminated string at pos, two null bytes for the UTF-16 encodings"""
+    if encoding in (1, 2):
+        end = pos
+        while True:
+            end = data.index(b'\x00\x00', end)
+            if (end - pos) % 2 == 0:
+                return end + 2
+            end += 1
+    return data.index(b'\x00', pos) + 1
+
+
+def parse_apic(frame_id: str, body: bytes) -> tuple[int, str, bytes]:
+    """Parses an ID3v2 APIC frame, or a PIC frame of ID3v2.2, into (picture type, mime type, image data)"""
+    encoding = body[0]
+    if frame_id == 'PIC':
+        mime, pos = 'image/' + body[1:4].decode('latin-1').lower(), 4
+    else:
+        pos = body.index(b'\x00', 1)
+        mime, pos = body[1:pos].decode('latin-1').lower(), pos + 1
+    return body[pos], mime, body[split_terminated(body, pos + 1, encoding):]
+
+
+def parse_flac_picture(body: bytes) -> tuple[int, str, bytes]:
+    """Parses a FLAC PICTURE block into (picture type, mime type, image data)"""
+    picture_type, mime_length = struct.unpack('>II', body[0:8])
+    mime = body[8:8 + mime_length].decode('latin-1').lower()
+    pos = 8 + mime_length
+    pos += 4 + struct.unpack('>I', body[pos:pos + 4])[0] + 16
+    length = struct.unpack('>I', body[pos:pos + 4])[0]
+    return picture_type, mime, body[pos + 4:pos + 4 + length]
+
+
+def read_picture(filename: str) -> tuple[str, bytes]:
+    """Reads the embedded cover of a music file as (mime type, image data), or None if it has none
+
+    The front cover is picked when there are several pictures, otherwise the first one. Pictures that are cut
+    short or malformed are skipped.
+    """
+    pictures = []
+    with open(filename, 'rb') as f:
+        for block_type, body in read_flac_blocks(f):
+            if block_type == PICTURE_BLOCK:
+                try:
+                    pictures.append(parse_flac_picture(body))
+                except (ValueError, struct.error, IndexError):
+                    pass
+        if not pictures:
+            for frame_id, body in read_id3v2_frames(f):
+                if frame_id in ('APIC', 'PIC'):
+                    try:
+                        pictures.append(parse_apic(frame_id, body))
+                    except (ValueError, struct.error, IndexError):
+                        pass
+    pictures = [picture for picture in pictures if picture[2]]
+    if not pictures:
+        return None
+    _, mime, data = next((picture for picture in pictures if picture[0] == FRONT_COVER), pictures[0])
+    return mime, data
+
+
+def display_name(tags: dict, filename: str) -> str:
+    """Gets the label to show for a song, falling back to the file name"""
+    if tags and tags.get('title'):
+        if tags.get('artist'):
+            return f"{tags['artist']} - {tags['title']}"
+        return tags['title']
+    return filename
+
+
+class MetadataStore:
+    """Tag cache for a library that fills in on a thread pool and persists between launches"""
+
+    def __init__(self, root: str, cache_file: str = None, workers: int = None):
+        self.root = os.path.abspath(root)
+        self.cache_file = cache_file if cache_file else cache_path('tags', self.root)
+        self.workers = workers
+        self.tags = {}
+        self.arrived = []
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.executor = None
+        self.outstanding = 0
+        self.changed = False
+        self.loaded = False
+
+    def load(self) -> None:
+        """Loads the tags saved by a previous launch"""
+        data = load_json(self.cache_file, {})
+        if data.get('version') == CACHE_VERSION and data.get('root') == self.root:
+            self.tags = data.get('tags', {})
+        self.loaded = True
+
+    def save(self) -> bool:
+        """Saves the tags for the next launch, one save at a time"""
+        with self.save_lock:
+            with self.lock:
+                data = {'version': CACHE_VERSION, 'root': self.root, 'tags': dict(self.tags)}
+                self.changed = False
+            return save_json(self.cache_file, data)
+
+    def get(self, path: str, stat: tuple = None) -> dict:
+        """Gets the cached tags of a song, or None if they are missing or older than stat (size, mtime)"""
+        entry = self.tags.get(path)
+        if entry is None or stat is not None and entry['stat'] != list(stat):
+            return None
+        return entry['tags']
+
+    def fill(self, paths: list[str], stat: Callable[[str], tuple]) -> int:
+        """Reads the tags of every song that is not cached yet in the background. Returns how many were queued"""
+        if not self.loaded:
+            self.load()
+        missing = [path for path in paths if self.get(path, stat(path)) is None]
+        if not missing:
+            return 0
+        if self.executor is None:
+            # Imported here to keep it off the startup path
+            from concurrent.futures import ThreadPoolExecutor
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='casp-tags')
+        for start in range(0, len(missing), BATCH_SIZE):
+            batch = [(path, stat(path)) for path in missing[start:start + BATCH_SIZE]]
+            with self.lock:
+                self.outstanding += 1
+            self.executor.submit(self.read_batch, batch)
+        return len(missing)
+
+    def read_batch(self, batch: list[tuple[str, tuple]]) -> None:
+        """Worker task that reads the tags of a batch of songs"""
+        results = []
+        for path, stat in batch:
+            try:
+                tags = read_tags(os.path.join(self.root, path))
+            except (OSError, ValueError, struct.error, IndexError):
+                tags = {}
+            results.append((path, {'stat': list(stat) if stat else None, 'tags': tags}))
+        with self.lock:
+            for path, entry in results:
+                self.tags[path] = entry
+                self.arrived.append(path)
+            self.changed = True
+            self.outstanding -= 1
+            done = self.outstanding == 0
+        if done:
+            self.save()
+
+    def drain(self) -> list[str]:
+        """Gets the songs whose tags arrived since the last call"""
+        with self.lock:
+            arrived, self.arrived = self.arrived, []
+        return arrived
@@ -0,0 +1,106 @@
+import threading
+import time
+from array import array
+
+from casp.cache import save_json
+
+RING_SIZE = 1024
+
+# Hooks check this flag before reading the clock, so collection costs one attribute lookup while it is off
+enabled = False
+histograms = {}
+lock = threading.Lock()
+
+
+class Histogram:
+    """Ring buffer of the latest samples of one measurement, summarised on demand"""
+
+    def __init__(self, name: str, size: int = RING_SIZE):
+        self.name = name
+        self.samples = array('d', bytes(8 * size))
+        self.size = size
+        self.count = 0
+        self.total = 0.0
+        self.peak = 0.0
+
+    def add(self, value: float) -> None:
+        """Records one sample, overwriting the oldest once the ring is full"""
+        self.samples[self.count % self.size] = value
+        self.count += 1
+        self.total += value
+        if value > self.peak:
+            self.peak = value
+
+    def window(self) -> list[float]:
+        """Gets the samples still in the ring, sorted"""
+        return sorted(self.samples[:min(self.count, self.size)])
+
+    def percentile(self, p: float, window: list[float] = None) -> float:
+        """Gets the p-th percentile of the samples in the ring, or 0 if there are none"""
+        window = window if window is not None else self.window()
+        if not window:
+            return 0.0
+        return window[min(len(window) - 1, int(len(window) * p / 100))]
+
+    def summary(self) -> dict:
+        """Gets the sample count, mean, p50, p99 and max in milliseconds"""
+        window = self.window()
+        return {'count': self.count,
+                'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+                'p50_ms': self.percentile(50, window) * 1000,
+                'p99_ms': self.percentile(99, window) * 1000,
+                'max_ms': self.peak * 1000}
+
+
+def enable(on: bool = True) -> None:
+    """Turns collection on or off"""
+    global enabled
+    enabled = on
+
+
+def record(name: str, seconds: float) -> None:
+    """Adds a sample in seconds to the named histogram"""
+    histogram = histograms.get(name)
+    if histogram is None:
+        with lock:
+            histogram = histograms.setdefault(name, Histogram(name))
+    histogram.add(seconds)
+
+
+def since(name: str, started: float) -> None:
+    """Records the time since a perf_counter reading, doing nothing if there was none"""
+    if started is not None:
+        record(name, time.perf_counter() - started)
+
+
+def start() -> float:
+    """Reads the clock if collection is on, otherwise returns None"""
+    return time.perf_counter() if enabled else None
+
+
+def summary() -> dict:
+    """Summarises every histogram"""
+    with lock:
+        collected = list(histograms.values())
+    return {histogram.name: histogram.summary() for histogram in collected}
+
+
+def overlay_lines() -> list[str]:
+    """Gets the p50/p99 table shown by the stats overlay"""
+    lines = [f'{"metric":<13}{"p50 ms":>8}{"p99 ms":>8}{"count":>8}']
+    for name, stats in sorted(summary().items()):
+        lines.append(f'{name[:12]:<13}{stats["p50_ms"]:8.2f}{stats["p99_ms"]:8.2f}{stats["count"]:8d}')
+    if len(lines) == 1:
+        lines.append('no samples yet')
+    return lines
+
+
+def dump(path: str) -> bool:
+    """Writes the histogram summaries and the sorted samples still in each ring to a JSON file"""
+    with lock:
+        collected = list(histograms.values())
+    data = {}
+    for histogram in collected:
+        data[histogram.name] = histogram.summary()
+        data[histogram.name]['samples'] = histogram.window()
+    return save_json(path, data)
@@ -1,12 +1,43 @@
 import os
+import threading
+import time
+from typing import Callable
 
-import pygame
-
+from casp import metrics
 from casp.FileHandling import FileHandler
+from casp.playlist import PlayQueue
+from casp.prefetch import Prefetcher
+from casp.probe import probe_duration, remember_duration
 from casp.Widgets import Widget
 
-pygame.init()
-pygame.mixer.init()
+mixer = None
+mixer_lock = threading.Lock()
+
+
+def ensure_mixer() -> object:
+    """Imports pygame and starts only its mixer, the first time something needs audio"""
+    global mixer
+    if mixer is None:
+        with mixer_lock:
+            if mixer is None:
+                os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+                import pygame.mixer
+                pygame.mixer.init()
+                mixer = pygame.mixer
+    return mixer
+
+
+def preload_mixer(on_ready: Callable[[float], None] = None) -> threading.Thread:
+    """Starts the mixer on a background thread so the first play does not wait for it"""
+    def preload() -> None:
+        started = time.perf_counter()
+        ensure_mixer()
+        if on_ready:
+            on_ready(started)
+
+    thread = threading.Thread(target=preload, name='casp-mixer-init', daemon=True)
+    thread.start()
+    return thread
 
 
 class MusicPlayer:
@@ -19,32 +50,72 @@ class MusicPlayer:
         self.playing = False
         self.total_length = 1
         self.volume = 1
-        self.paused = pygame.mixer.music.get_busy()
-        self.dummypublishers = []
+        self.gain = 1
+        self.paused = False
+        self.queued_file = None
+        self.queued_length = 0
+        self.last_pos = 0
+        self.audio_cache = None
 
     def load_file(self, filename: str) -> bool:
         """Function to load file"""
+        started = metrics.start()
         try:
-            current_song_obj = pygame.mixer.Sound(filename)
             self.current_song_file = filename
-            pygame.mixer.music.load(filename)
-            self.total_length = current_song_obj.get_length() * 1000
-            pygame.mixer.music.play()
+            ensure_mixer().music.load(*self.source(filename))
+            self.total_length = self.get_length(filename) * 1000
+            if self.volume * self.gain != 1:
+                # Loading a song resets the mixer to full volume
+                ensure_mixer().music.set_volume(self.volume * self.gain)
+            ensure_mixer().music.play()
+            self.playing = True
+            self.paused = False
+            self.queued_file = None
+            self.last_pos = 0
+            metrics.since('load file', started)
         except FileNotFoundError as err:
             print("File Not Found Error: {0}".format(err))
             print(filename + " not found!")
             return False
         return True
 
+    def source(self, filename: str) -> tuple:
+        """Gets what the mixer should load for a song: its decoded copy from the audio cache, or the file"""
+        mapped = self.audio_cache.open(filename) if self.audio_cache else None
+        return (mapped, 'wav') if mapped is not None else (filename,)
+
+    def get_length(self, filename: str) -> float:
+        """Gets the song length in seconds from the file headers, decoding the file only if that fails"""
+        length = probe_duration(filename)
+        if length is None:
+            length = ensure_mixer().Sound(filename).get_length()
+            remember_duration(filename, length)
+        return length
+
     def pause(self) -> None:
         """Function to pause music"""
-        pygame.mixer.music.pause()
+        ensure_mixer().music.pause()
+        self.paused = self.playing or self.paused
+        self.playing = False
+
+    def stop(self) -> None:
+        """Function to stop music"""
+        ensure_mixer().music.stop()
         self.playing = False
+        self.paused = False
+        self.queued_file = None
 
     def unpause(self) -> None:
         """Function to unpause music"""
-        pygame.mixer.music.unpause()
-        self.playing = True
+        if self.paused:
+            ensure_mixer().music.unpause()
+            self.playing = True
+            self.paused = False
+
+    def close(self) -> None:
+        """Releases the player on exit, the mixer needs nothing"""
+        if self.audio_cache is not None:
+            self.audio_cache.close()
 
     # TODO: next song and other controls
     # TODO: clean song data
@@ -56,28 +127,72 @@ class MusicPlayer:
     def set_volume(self, volume: float) -> None:
         """Sets volumes (0.0 to 1.0)"""
         self.volume = volume
-        pygame.mixer.music.set_volume(volume)
+        ensure_mixer().music.set_volume(volume * self.gain)
         return
 
-    def get_percent(self) -> int:
+    def set_gain(self, gain: float) -> None:
+        """Scales the volume for the loudness of the song, e.g. from casp.loudness (0.0 to 1.0)"""
+        if gain != self.gain:
+            self.gain = gain
+            ensure_mixer().music.set_volume(self.volume * gain)
+
+    def get_percent(self) -> float:
         """Gets percent of song passed"""
-        self.current_length = pygame.mixer.music.get_pos()
-        return int((self.current_length / self.total_length) * 100)
+        self.current_length = ensure_mixer().music.get_pos()
+        return (self.current_length / self.total_length) * 100
+
+    def get_position(self) -> float:
+        """Gets how far into the song the mixer is, in seconds"""
+        if not self.playing and not self.paused:
+            return 0.0
+        return max(ensure_mixer().music.get_pos(), 0) / 1000
+
+    def queue_file(self, filename: str, length: float) -> None:
+        """Hands the next song to the mixer so it starts without a gap when the current one ends"""
+        ensure_mixer().music.queue(*self.source(filename))
+        self.queued_file = filename
+        self.queued_length = length * 1000
+
+    def poll_transition(self) -> bool:
+        """Checks whether the mixer moved on to the queued song, which restarts its position"""
+        if not self.queued_file or not self.playing:
+            return False
+        pos = ensure_mixer().music.get_pos()
+        if 0 <= pos < self.last_pos:
+            self.current_song_file = self.queued_file
+            self.total_length = self.queued_length
+            self.queued_file = None
+            self.last_pos = pos
+            return True
+        self.last_pos = pos
+        return False
+
+    def finished(self) -> bool:
+        """Checks whether the song ran out on its own since the last call"""
+        if self.playing and not ensure_mixer().music.get_busy():
+            self.playing = False
+            return True
+        return False
 
 
 class MusicEventHandler:
     """Music Event subscriber of app events"""
 
-    def __init__(self, music_dir: str, progress_bar: Widget):
+    def __init__(self, music_dir: str, progress_bar: Widget, file_handler: FileHandler = None,
+                 tick_interval: float = 0.1, player: MusicPlayer = None, loudness: object = None):
         self.currentsong = ''
-        self.musicplayer = MusicPlayer()
-        self.queue = []
-        self.queue_pointer = 0
+        self.loudness = loudness
+        self.musicplayer = player if player else MusicPlayer()
+        self.file_handler = file_handler if file_handler else FileHandler(music_dir)
+        self.queue = PlayQueue(self.file_handler.files)
+        self.prefetcher = Prefetcher(self.musicplayer.get_length)
         self.percent = 0
         self.dir = music_dir
         self.progress_bar = progress_bar
         self.progress = 0
         self.event_publishers = []
+        self.tick_interval = tick_interval
+        self.last_tick = None
 
     def update(self, event: dict) -> None:
         """Called when app subscribed to has an event"""
@@ -88,36 +203,134 @@ class MusicEventHandler:
         event_type = event['controls']
 
         if event_type == "play":
-            self.queue = FileHandler(self.dir).files
-            if not songfile == self.currentsong:  # If a song hasn't been selected already
-                self.currentsong = songfile
-                self.musicplayer.load_file(os.path.abspath(songfile))
-            else:
+            # Unpause if the selected song is the one already loaded
+            if songfile == self.currentsong and (self.musicplayer.playing or self.musicplayer.paused):
                 self.musicplayer.unpause()
+            elif songfile in self.queue:
+                self.play(self.queue.select(songfile))
 
         elif event_type == "pause":
             self.musicplayer.pause()
 
         elif event_type == "next" and len(self.queue) != 0:
-            self.queue_pointer += (self.queue.index(songfile) + 1)
-            self.queue_pointer = self.queue_pointer % len(self.queue)
-            self.musicplayer.load_file(self.dir + os.path.sep + self.queue[self.queue_pointer])
+            if not self.currentsong and songfile in self.queue:
+                self.queue.select(songfile)
+            self.play(self.queue.advance(manual=True))
 
         elif event_type == "previous" and len(self.queue) != 0:
-            self.queue_pointer += self.queue.index(songfile) - 1
-            self.queue_pointer = self.queue_pointer % len(self.queue)
-            self.musicplayer.load_file(self.dir + os.path.sep + self.queue[self.queue_pointer])
+            if not self.currentsong and songfile in self.queue:
+                self.queue.select(songfile)
+            self.play(self.queue.rewind())
+
+        elif event_type == "shuffle":
+            self.queue.set_shuffle(not self.queue.shuffled)
+
+        elif event_type == "repeat":
+            self.queue.cycle_repeat()
+
+        elif event_type == "volume":
+            self.musicplayer.set_volume(min(max(float(event['volume']), 0.0), 1.0))
+
+    def play(self, songfile: str) -> None:
+        """Loads and plays a song from the queue"""
+        if songfile is None:
+            return
+        self.currentsong = songfile
+        self.apply_gain()
+        self.musicplayer.load_file(self.song_path(songfile))
+        self.prefetch()
+
+    def apply_gain(self) -> None:
+        """Turns the current song down by its gain if loudness normalization is on"""
+        if self.loudness is not None:
+            self.musicplayer.set_gain(self.loudness.factor(self.currentsong))
+
+    def song_path(self, songfile: str) -> str:
+        """Gets the absolute path of a song in the queue"""
+        return os.path.abspath(os.path.join(self.dir, songfile))
+
+    def prefetch(self) -> None:
+        """Prepares the song after the current one and queues it in the mixer once it is ready"""
+        upcoming = self.queue.peek()
+        if upcoming is None or not self.musicplayer.playing and not self.musicplayer.paused:
+            return
+        path = self.song_path(upcoming)
+        if self.musicplayer.queued_file == path:
+            return
+        length = self.prefetcher.take(path)
+        if length is None:
+            self.prefetcher.request(path)
+        else:
+            self.musicplayer.queue_file(path, length)
 
     def run(self) -> bool:
         """Updates progress bar"""
+        now = metrics.start()
+        if now is not None and self.last_tick is not None:
+            metrics.record('tick jitter', abs(now - self.last_tick - self.tick_interval))
+        self.last_tick = now
+        if not self.musicplayer.playing:
+            return False
         progress = self.musicplayer.get_percent()
         if not self.progress == progress:
+            self.progress = progress
             events = {'progress': progress}
             for event_publisher in self.event_publishers:
                 event_publisher.update(events)
             return True
         return False
 
+    def check_end(self) -> bool:
+        """Autoplays the next song in the queue when the current one ends"""
+        if self.musicplayer.poll_transition():
+            # The mixer already started the queued song, catch the queue up with it
+            upcoming = self.queue.peek()
+            if upcoming is not None and self.song_path(upcoming) == self.musicplayer.current_song_file:
+                self.currentsong = self.queue.advance()
+                self.apply_gain()
+                self.prefetch()
+            else:
+                songfile = self.queue.advance()
+                if songfile is None:
+                    self.musicplayer.stop()
+                else:
+                    self.play(songfile)
+            return True
+        if not self.musicplayer.finished():
+            self.prefetch()
+            return False
+        self.play(self.queue.advance())
+        return True
+
+    def apply_changes(self, changes: list[tuple]) -> None:
+        """Follows files that were added, removed, renamed or rewritten in the library while playing"""
+        for change in changes:
+            if change[0] == 'add':
+                self.queue.enqueue(change[1])
+            elif change[0] == 'remove':
+                self.queue.dequeue(change[1])
+            elif change[0] == 'rename':
+                self.queue.rename(change[1], change[2])
+                if self.currentsong == change[1]:
+                    self.currentsong = change[2]
+        if self.loudness is not None:
+            self.loudness.fill([change[-1] for change in changes if change[0] != 'remove'],
+                               self.file_handler.library.stat)
+
+    def status(self) -> dict:
+        """Gets what is playing and how far along it is, for clients of the control socket"""
+        player = self.musicplayer
+        return {'song': self.currentsong,
+                'playing': player.playing,
+                'paused': player.paused,
+                'position': player.get_position(),
+                'length': player.total_length / 1000 if self.currentsong else 0.0,
+                'volume': player.volume,
+                'shuffle': self.queue.shuffled,
+                'repeat': self.queue.repeat,
+                'tracks': len(self.queue),
+                'cache': player.audio_cache.stats() if player.audio_cache else None}
+
     def add_publisher(self, publisher: Widget) -> None:
         """Publishes events for the event"""
         self.event_publishers.append(publisher)
@@ -0,0 +1,298 @@
+import os
+import random
+from array import array
+from typing import Iterable, Iterator
+
+from casp.tracks import TrackTable
+
+REPEAT_MODES = ['off', 'all', 'one']
+
+
+class ShuffleOrder:
+    """Random permutation of range(size) generated one step of Fisher-Yates at a time
+
+    Slots before generated are the steps drawn so far, the rest are a pool of positions still to draw. A slot
+    that is not in swapped holds its own index, so only the drawn steps and the slots they swapped with are
+    stored. Positions can be inserted and removed as the queue changes, keeping the steps drawn so far.
+    """
+
+    def __init__(self, size: int, first: int = None, rng: random.Random = None):
+        self.size = size
+        self.rng = rng if rng else random.Random()
+        self.swapped = {}
+        self.generated = 0
+        if first is not None:
+            self.swap(0, first)
+            self.generated = 1
+
+    def swap(self, i: int, j: int) -> None:
+        """Swaps two slots of the sparse permutation"""
+        vi = self.swapped.get(i, i)
+        self.swapped[i] = self.swapped.get(j, j)
+        self.swapped[j] = vi
+
+    def __getitem__(self, k: int) -> int:
+        """Gets the kth entry, drawing the entries before it if they were not drawn yet"""
+        while self.generated <= k:
+            self.swap(self.generated, self.rng.randrange(self.generated, self.size))
+            self.generated += 1
+        return self.swapped.get(k, k)
+
+    def insert(self, position: int) -> None:
+        """Makes room for a new queue position, renumbering the ones after it, and puts it in the pool"""
+        # The new slot goes where the pool starts, or at position itself to keep the slots after it implicit
+        slot = max(position, self.generated)
+        swapped = {k + 1 if k >= slot else k: v + 1 if v >= position else v for k, v in self.swapped.items()}
+        for k in range(position, slot):
+            if k not in self.swapped:
+                swapped[k] = k + 1
+        swapped[slot] = position
+        self.swapped = swapped
+        self.size += 1
+
+    def remove(self, position: int) -> int:
+        """Drops a queue position, renumbering the ones after it. Returns the step it was drawn at, or None"""
+        slot = next((k for k, v in self.swapped.items() if v == position), position)
+        drawn = None
+        if slot < self.generated:
+            # Out of the drawn steps into the pool, keeping the order of the steps after it
+            drawn = slot
+            later = [self[k] for k in range(slot + 1, self.generated)]
+            for k, v in enumerate(later, slot):
+                self.swapped[k] = v
+            self.generated -= 1
+            slot = self.generated
+            self.swapped[slot] = position
+        # Any pool slot will do, this one keeps the slots after it implicit once it is gone
+        target = max(position, self.generated)
+        self.swap(slot, target)
+        swapped = {k - 1 if k > target else k: v - 1 if v > position else v
+                   for k, v in self.swapped.items() if k != target}
+        for k in range(position + 1, target):
+            if k not in self.swapped:
+                swapped[k] = k - 1
+        self.swapped = swapped
+        self.size -= 1
+        return drawn
+
+
+class PlayQueue:
+    """Queue of unique tracks with constant time navigation, lazy shuffle and repeat modes
+
+    The queue holds ids into a TrackTable, which it shares with the file handler and the menu when given one.
+    """
+
+    def __init__(self, tracks: Iterable[str] = None, repeat: str = 'all', shuffle: bool = False):
+        self.table = tracks if isinstance(tracks, TrackTable) else TrackTable(tracks if tracks else [])
+        self.ids = array('I', range(len(self.table)))
+        self.positions = array('i', range(len(self.table)))
+        self.pointer = 0
+        self.repeat = repeat
+        self.shuffled = shuffle
+        self.order = None
+        self.rng = random.Random()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, track: str) -> bool:
+        return self.position_of(self.table.find(track)) >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        return (self.table[track_id] for track_id in self.ids)
+
+    def track(self, position: int) -> str:
+        """Gets the track at a position of the queue"""
+        return self.table[self.ids[position]]
+
+    def position_of(self, track_id: int) -> int:
+        """Gets the position of a track id in the queue, or -1 if it is not queued"""
+        if 0 <= track_id < len(self.positions):
+            return self.positions[track_id]
+        return -1
+
+    def index(self, track: str) -> int:
+        """Gets the position of a track in the queue"""
+        position = self.position_of(self.table.find(track))
+        if position < 0:
+            raise KeyError(track)
+        return position
+
+    def play_position(self, pointer: int) -> int:
+        """Gets the queue position played at a step of the play order"""
+        if self.shuffled:
+            if self.order is None:
+                self.order = ShuffleOrder(len(self.ids), rng=self.rng)
+            return self.order[pointer]
+        return pointer
+
+    @property
+    def current(self) -> str:
+        """Gets the track the queue points at"""
+        if not self.ids:
+            return None
+        return self.track(self.play_position(self.pointer))
+
+    def select(self, track: str) -> str:
+        """Points the queue at a track, starting a fresh shuffle from it when shuffling"""
+        position = self.index(track)
+        if self.shuffled:
+            self.order = ShuffleOrder(len(self), first=position, rng=self.rng)
+            self.pointer = 0
+        else:
+            self.pointer = position
+        return track
+
+    def step(self, delta: int, wrap: bool) -> int:
+        """Gets the play order pointer delta steps away, or None past either end"""
+        pointer = self.pointer + delta
+        if 0 <= pointer < len(self.ids):
+            return pointer
+        if not wrap:
+            return None
+        if self.shuffled and pointer >= len(self.ids):
+            self.order = ShuffleOrder(len(self.ids), rng=self.rng)
+        return pointer % len(self.ids)
+
+    def advance(self, manual: bool = False) -> str:
+        """Moves to the next track, honouring the repeat mode. Manual skips ignore repeat one"""
+        if not self.ids:
+            return None
+        if self.repeat == 'one' and not manual:
+            return self.current
+        pointer = self.step(1, self.repeat != 'off' or manual)
+        if pointer is None:
+            return None
+        self.pointer = pointer
+        return self.current
+
+    def rewind(self) -> str:
+        """Moves to the previous track"""
+        if not self.ids:
+            return None
+        pointer = self.step(-1, not self.shuffled)
+        if pointer is not None:
+            self.pointer = pointer
+        return self.current
+
+    def peek(self) -> str:
+        """Gets the track that would play after the current one ends, without moving"""
+        if not self.ids:
+            return None
+        if self.repeat == 'one':
+            return self.current
+        pointer = self.pointer + 1
+        if pointer >= len(self.ids):
+            if self.repeat == 'off' or self.shuffled:
+                return None
+            pointer = 0
+        return self.track(self.play_position(pointer))
+
+    def set_shuffle(self, shuffle: bool) -> None:
+        """Turns shuffle on or off, keeping the current track"""
+        current = self.current
+        self.shuffled = shuffle
+        self.order = None
+        self.pointer = 0
+        if current is not None:
+            self.select(current)
+
+    def cycle_repeat(self) -> str:
+        """Moves to the next repeat mode"""
+        self.repeat = REPEAT_MODES[(REPEAT_MODES.index(self.repeat) + 1) % len(REPEAT_MODES)]
+        return self.repeat
+
+    def add_track(self, track: str) -> int:
+        """Gets the id of a track, adding it to the table and making room for its position if it is new"""
+        track_id = self.table.add(track)
+        if len(self.positions) < len(self.table):
+            self.positions.extend([-1] * (len(self.table) - len(self.positions)))
+        return track_id
+
+    def enqueue(self, track: str, position: int = None) -> None:
+        """Adds a track at the end of the queue, or before position"""
+        track_id = self.add_track(track)
+        if self.positions[track_id] >= 0:
+            return
+        current = self.current
+        if position is None or position >= len(self.ids):
+            self.positions[track_id] = len(self.ids)
+            self.ids.append(track_id)
+        else:
+            self.ids.insert(position, track_id)
+            self.reindex(position)
+        if self.shuffled:
+            if self.order is not None:
+                self.order.insert(self.positions[track_id])
+        else:
+            self.keep_current(current)
+
+    def dequeue(self, track: str) -> None:
+        """Removes a track from the queue"""
+        track_id = self.table.find(track)
+        position = self.position_of(track_id)
+        if position < 0:
+            return
+        current = self.current
+        self.positions[track_id] = -1
+        del self.ids[position]
+        self.reindex(position)
+        if self.shuffled:
+            # The steps drawn so far stay, so rewind still goes back through what was played
+            step = self.order.remove(position) if self.order is not None else None
+            if step is not None and step < self.pointer:
+                self.pointer -= 1
+            self.pointer = min(self.pointer, len(self.ids) - 1) if self.ids else 0
+            return
+        if current == track:
+            self.pointer = min(self.pointer, len(self.ids) - 1) if self.ids else 0
+            current = self.current
+        self.keep_current(current)
+
+    def rename(self, old: str, new: str) -> None:
+        """Replaces a track with its new path, keeping its place in the queue"""
+        old_id = self.table.find(old)
+        position = self.position_of(old_id)
+        if position < 0:
+            return
+        new_id = self.add_track(new)
+        if self.positions[new_id] >= 0:
+            self.dequeue(old)
+            return
+        self.positions[old_id] = -1
+        self.positions[new_id] = position
+        self.ids[position] = new_id
+
+    def reindex(self, start: int) -> None:
+        """Refreshes the positions of the tracks from start on"""
+        for position in range(start, len(self.ids)):
+            self.positions[self.ids[position]] = position
+
+    def keep_current(self, current: str) -> None:
+        """Points back at current after the queue changed shape, when playing in queue order"""
+        if current is not None:
+            self.pointer = self.index(current)
+
+    def save_m3u(self, path: str, base_dir: str = '') -> None:
+        """Writes the queue as an M3U playlist, one line at a time"""
+        playlist_dir = os.path.dirname(os.path.abspath(path))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('#EXTM3U\n')
+            for track in self:
+                f.write(os.path.relpath(os.path.abspath(os.path.join(base_dir, track)), playlist_dir) + '\n')
+
+    def load_m3u(self, path: str, base_dir: str = '') -> int:
+        """Enqueues the entries of an M3U playlist, streaming it line by line. Returns how many were added"""
+        playlist_dir = os.path.dirname(os.path.abspath(path))
+        base = os.path.abspath(base_dir)
+        added = len(self)
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                track = os.path.abspath(os.path.join(playlist_dir, line))
+                if os.path.commonpath([track, base]) == base:
+                    track = os.path.relpath(track, base)
+                self.enqueue(track)
+        return len(self) - added
@@ -0,0 +1,65 @@
+import os
+import queue
+import threading
+from typing import Callable
+
+READAHEAD_CHUNK = 1 << 20
+READAHEAD_LIMIT = 64 << 20
+
+
+def readahead(filename: str, limit: int = READAHEAD_LIMIT) -> None:
+    """Pulls the start of a file into the page cache so opening it later does not wait on the disk"""
+    with open(filename, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, limit, os.POSIX_FADV_WILLNEED)
+            return
+        read = 0
+        while read < limit:
+            chunk = f.read(READAHEAD_CHUNK)
+            if not chunk:
+                break
+            read += len(chunk)
+
+
+class Prefetcher:
+    """Prepares upcoming songs on a worker thread while the current one plays"""
+
+    def __init__(self, get_length: Callable[[str], float]):
+        self.get_length = get_length
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.ready = {}
+        self.pending = set()
+        self.thread = None
+
+    def request(self, filename: str) -> None:
+        """Asks the worker to prepare a song"""
+        with self.lock:
+            if filename in self.ready or filename in self.pending:
+                return
+            self.pending.add(filename)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work, name='casp-prefetch', daemon=True)
+            self.thread.start()
+        self.requests.put(filename)
+
+    def take(self, filename: str) -> float:
+        """Gets the length in seconds of a prepared song, or None if it is not ready yet"""
+        with self.lock:
+            return self.ready.get(filename)
+
+    def work(self) -> None:
+        """Worker loop that probes and reads ahead requested songs"""
+        while True:
+            filename = self.requests.get()
+            try:
+                length = self.get_length(filename)
+                readahead(filename)
+            except Exception:  # A bad file must not kill the worker
+                length = None
+            with self.lock:
+                self.pending.discard(filename)
+                if length is not None:
+                    self.ready[filename] = length
+                    while len(self.ready) > 16:
+                        self.ready.pop(next(iter(self.ready)))
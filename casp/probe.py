@@ -0,0 +1,243 @@
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+MAX_CACHED = 4096
+MP3_SYNC_SEARCH = 1 << 16
+MP3_VBR_CHECK_FRAMES = 8
+OGG_TAIL = 1 << 16
+
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+
+durations = OrderedDict()
+durations_lock = threading.Lock()
+
+
+def file_key(filename: str) -> tuple:
+    """Gets the (path, size, mtime) key used to cache facts about a file"""
+    st = os.stat(filename)
+    return os.path.abspath(filename), st.st_size, st.st_mtime_ns
+
+
+def cached_duration(filename: str) -> float:
+    """Gets a remembered duration in seconds without touching the file contents"""
+    try:
+        key = file_key(filename)
+    except OSError:
+        return None
+    with durations_lock:
+        if key in durations:
+            durations.move_to_end(key)
+            return durations[key]
+    return None
+
+
+def remember_duration(filename: str, seconds: float) -> None:
+    """Remembers the duration of a file, e.g. one measured by decoding it"""
+    try:
+        key = file_key(filename)
+    except OSError:
+        return
+    with durations_lock:
+        durations[key] = seconds
+        durations.move_to_end(key)
+        while len(durations) > MAX_CACHED:
+            durations.popitem(last=False)
+
+
+def probe_duration(filename: str) -> float:
+    """Gets the duration in seconds by reading only the container headers, or None if it can not tell"""
+    seconds = cached_duration(filename)
+    if seconds is not None:
+        return seconds
+    try:
+        with open(filename, 'rb') as f:
+            seconds = probe_stream(f, os.fstat(f.fileno()).st_size)
+    except (OSError, ValueError, struct.error):
+        return None
+    if seconds is not None and seconds > 0:
+        remember_duration(filename, seconds)
+        return seconds
+    return None
+
+
+def probe_stream(f: object, size: int) -> float:
+    """Picks the header parser from the magic bytes of an open file"""
+    head = f.read(12)
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        return probe_wav(f, size)
+    if head[:4] == b'OggS':
+        return probe_ogg(f, size)
+    start = id3v2_size(head) if head[:3] == b'ID3' else 0
+    f.seek(start)
+    if f.read(4) == b'fLaC':
+        return probe_flac(f)
+    return probe_mp3(f, size, start)
+
+
+def id3v2_size(head: bytes) -> int:
+    """Gets the number of bytes taken by an ID3v2 tag from its 10 byte header"""
+    if len(head) < 10:
+        return 0
+    size = (head[6] & 0x7f) << 21 | (head[7] & 0x7f) << 14 | (head[8] & 0x7f) << 7 | (head[9] & 0x7f)
+    footer = 10 if head[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def probe_wav(f: object, size: int) -> float:
+    """Reads the fmt and data chunks of a RIFF/WAVE file"""
+    f.seek(12)
+    byte_rate = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        chunk_id, chunk_size = struct.unpack('<4sI', header)
+        if chunk_id == b'fmt ':
+            fmt = f.read(chunk_size + (chunk_size & 1))
+            byte_rate = struct.unpack('<I', fmt[8:12])[0]
+        elif chunk_id == b'data':
+            if not byte_rate:
+                return None
+            if chunk_size in (0, 0xffffffff):
+                chunk_size = size - f.tell()
+            return min(chunk_size, size - f.tell()) / byte_rate
+        else:
+            f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+
+def probe_flac(f: object) -> float:
+    """Reads total samples and sample rate from the STREAMINFO block, which always comes first"""
+    header = f.read(4)
+    if len(header) < 4 or header[0] & 0x7f != 0:
+        return None
+    info = f.read(34)
+    if len(info) < 18:
+        return None
+    packed = int.from_bytes(info[10:18], 'big')
+    sample_rate = packed >> 44
+    total_samples = packed & ((1 << 36) - 1)
+    if not sample_rate or not total_samples:
+        return None
+    return total_samples / sample_rate
+
+
+def probe_ogg(f: object, size: int) -> float:
+    """Reads the sample rate from the identification header and the granule position of the last page"""
+    f.seek(0)
+    first = f.read(512)
+    if len(first) < 28:
+        return None
+    body = first[27 + first[26]:]
+    pre_skip = 0
+    if body[:7] == b'\x01vorbis':
+        sample_rate = struct.unpack('<I', body[12:16])[0]
+    elif body[:8] == b'OpusHead':
+        sample_rate = 48000
+        pre_skip = struct.unpack('<H', body[10:12])[0]
+    else:
+        return None
+
+    tail = min(size, OGG_TAIL)
+    while True:
+        f.seek(size - tail)
+        data = f.read(tail)
+        pos = data.rfind(b'OggS')
+        while pos != -1:
+            if pos + 14 <= len(data):
+                granule = struct.unpack('<q', data[pos + 6:pos + 14])[0]
+                if granule >= 0:
+                    return max(granule - pre_skip, 0) / sample_rate
+            pos = data.rfind(b'OggS', 0, pos)
+        if tail >= size:
+            return None
+        tail = min(size, tail * 4)
+
+
+def mp3_frame(header: bytes) -> tuple:
+    """Decodes a 4 byte MPEG audio frame header into (frame length, samples per frame, sample rate, bitrate)"""
+    if len(header) < 4 or header[0] != 0xff or header[1] & 0xe0 != 0xe0:
+        return None
+    version = {0: 2.5, 2: 2, 3: 1}.get((header[1] >> 3) & 3)
+    layer = {1: 3, 2: 2, 3: 1}.get((header[1] >> 1) & 3)
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 3
+    if version is None or layer is None or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    padding = (header[2] >> 1) & 1
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate, bitrate
+    samples = 576 if layer == 3 and version != 1 else 1152
+    return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate, bitrate
+
+
+def probe_mp3(f: object, size: int, start: int) -> float:
+    """Uses the Xing/Info or VBRI header when present, otherwise scans frame headers"""
+    f.seek(start)
+    data = f.read(MP3_SYNC_SEARCH)
+    pos = data.find(b'\xff')
+    while pos != -1:
+        frame = mp3_frame(data[pos:pos + 4])
+        if frame and mp3_frame(data[pos + frame[0]:pos + frame[0] + 4]):
+            break
+        pos = data.find(b'\xff', pos + 1)
+    if pos == -1:
+        return None
+    length, samples, sample_rate, bitrate = frame
+    first = data[pos:pos + length]
+
+    mono = (first[3] >> 6) == 3
+    mpeg1 = (first[1] >> 3) & 3 == 3
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    xing = first[4 + side_info:4 + side_info + 12]
+    if xing[:4] in (b'Xing', b'Info') and len(xing) == 12 and xing[7] & 1:
+        return struct.unpack('>I', xing[8:12])[0] * samples / sample_rate
+    vbri = first[36:36 + 18]
+    if vbri[:4] == b'VBRI' and len(vbri) == 18:
+        return struct.unpack('>I', vbri[14:18])[0] * samples / sample_rate
+
+    audio_start = start + pos
+    audio_end = size
+    f.seek(max(size - 128, 0))
+    if f.read(3) == b'TAG':
+        audio_end -= 128
+    if mp3_is_cbr(f, audio_start, bitrate):
+        return (audio_end - audio_start) * 8 / bitrate
+    return mp3_scan_frames(f, audio_start, audio_end)
+
+
+def mp3_is_cbr(f: object, offset: int, bitrate: int) -> bool:
+    """Checks whether the first few frames share one bitrate"""
+    for _ in range(MP3_VBR_CHECK_FRAMES):
+        f.seek(offset)
+        frame = mp3_frame(f.read(4))
+        if frame is None:
+            return True
+        if frame[3] != bitrate:
+            return False
+        offset += frame[0]
+    return True
+
+
+def mp3_scan_frames(f: object, offset: int, end: int) -> float:
+    """Adds up the samples of every frame by hopping from header to header, without decoding"""
+    total = 0.0
+    while offset + 4 <= end:
+        f.seek(offset)
+        frame = mp3_frame(f.read(4))
+        if frame is None or frame[0] <= 0:
+            break
+        total += frame[1] / frame[2]
+        offset += frame[0]
+    return total
@@ -0,0 +1,37 @@
+import sys
+import threading
+import time
+from typing import TextIO
+
+
+class StartupProfile:
+    """Wall clock timings of the startup phases, printed by --startup-profile"""
+
+    def __init__(self, started: float = None):
+        self.started = started if started is not None else time.perf_counter()
+        self.last = self.started
+        self.phases = []
+        self.background = []
+        self.lock = threading.Lock()
+
+    def mark(self, phase: str) -> None:
+        """Ends a phase that ran on the main thread"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def time_background(self, phase: str, started: float) -> None:
+        """Records a phase that ran off the main thread"""
+        with self.lock:
+            self.background.append((phase, time.perf_counter() - started))
+
+    def report(self, stream: TextIO = None) -> None:
+        """Prints the timings"""
+        stream = stream if stream else sys.stderr
+        stream.write('casp startup profile\n')
+        for phase, seconds in self.phases:
+            stream.write(f'  {phase:<14}{seconds * 1000:8.1f} ms\n')
+        stream.write(f'  {"total":<14}{(self.last - self.started) * 1000:8.1f} ms\n')
+        with self.lock:
+            for phase, seconds in self.background:
+                stream.write(f'  {phase:<14}{seconds * 1000:8.1f} ms (background)\n')
@@ -1,48 +1,105 @@
 import blessed
 
+# Skins are described by blessed attribute names or (layer, r, g, b) tuples and compiled to escape strings once
+SKINS = {"classic": {"background": "black_on_white", "bar": "black_on_wheat",
+                     "time": "fuchsia", "info": "webpurple"},
+         "dark": {"background": "white_on_gray22", "bar": "white_on_darkslategray",
+                  "time": "turquoise", "info": "orchid1"},
+         "ocean": {"background": "white_on_darkslategray", "bar": "white_on_cadetblue",
+                   "time": "darkgoldenrod4", "info": "dodgerblue4"},
+         "cyberpunk": {"background": "white_on_black", "bar": "white_on_midnightblue",
+                       "time": "aqua", "info": "fuchsia"},
+         "onedark": {"background": ('on', 40, 44, 52), "bar": ('on', 33, 34, 43),
+                     "time": ('fg', 229, 192, 123), "info": ('fg', 198, 120, 221)},
+         "vlc": {"background": ('on', 255, 255, 255), "bar": ('on', 239, 239, 239),
+                 "time": ('fg', 249, 181, 95), "info": ('fg', 118, 118, 118)}
+         }
+
+compiled_skins = {}
+
+
+def compile_skin(term: blessed.Terminal, skin: str) -> dict:
+    """Gets the escape strings of a skin for a terminal, building them only the first time"""
+    key = (skin, term.kind, term.number_of_colors, term.does_styling)
+    palette = compiled_skins.get(key)
+    if palette is None:
+        palette = {}
+        for part, spec in SKINS[skin].items():
+            if isinstance(spec, tuple):
+                layer, r, g, b = spec
+                palette[part] = str(term.on_color_rgb(r, g, b) if layer == 'on' else term.color_rgb(r, g, b))
+            else:
+                palette[part] = str(getattr(term, spec))
+        palette["normal"] = str(term.normal)
+        compiled_skins[key] = palette
+    return palette
+
 
 class Render:
     """Provides style rendering capabilities to the TUI"""
 
-    def __init__(self, width: int = 150, height: int = 150, skin: str = 'classic'):
-        self.term = blessed.Terminal()
-        self.width = width
-        self.height = height
-        self.skin = skin
+    def __init__(self, width: int = 150, height: int = 150, skin: str = 'classic', terminal: blessed.Terminal = None):
+        self.term = terminal if terminal else blessed.Terminal()
+        self.skins = SKINS
+        self.width = 0
+        self.height = 0
+        self.blank = ''
         self.screen = []
-        self.skins = {"classic": {"background": self.term.black_on_white,
-                                  "bar": self.term.black_on_wheat,
-                                  "time": self.term.fuchsia, "info": self.term.webpurple},
-                      "dark": {"background": self.term.white_on_gray22,
-                               "bar": self.term.white_on_darkslategray,
-                               "time": self.term.turquoise, "info": self.term.orchid1},
-                      "ocean": {"background": self.term.white_on_darkslategray,
-                                "bar": self.term.white_on_cadetblue,
-                                "time": self.term.darkgoldenrod4,
-                                "info": self.term.dodgerblue4},
-                      "cyberpunk": {"background": self.term.white_on_black,
-                                    "bar": self.term.white_on_midnightblue,
-                                    "time": self.term.aqua, "info": self.term.fuchsia},
-                      "onedark": {"background": self.term.on_color_rgb(40, 44, 52),
-                                  "bar": self.term.on_color_rgb(33, 34, 43),
-                                  "time": self.term.color_rgb(229, 192, 123),
-                                  "info": self.term.color_rgb(198, 120, 221)},
-                      "vlc": {"background": self.term.on_color_rgb(255, 255, 255),
-                              "bar": self.term.on_color_rgb(239, 239, 239),
-                              "time": self.term.color_rgb(249, 181, 95),
-                              "info": self.term.color_rgb(118, 118, 118)}
-                      }
+        self.skin = skin
+        self.palette = compile_skin(self.term, skin)
+        self.resize(width, height)
+
+    def set_skin(self, skin: str) -> bool:
+        """Switches to another skin, returns False if there is no such skin"""
+        if skin not in self.skins:
+            return False
+        self.skin = skin
+        self.palette = compile_skin(self.term, skin)
+        return True
+
+    def resize(self, width: int, height: int) -> None:
+        """Sizes the frame buffer, reallocating it only when the size changed"""
+        if (width, height) != (self.width, self.height):
+            self.width = width
+            self.height = height
+            self.blank = ' ' * width
+            self.screen = [self.blank] * height
+
+    def clear(self) -> list[str]:
+        """Blanks every row of the frame buffer and returns it"""
+        screen = self.screen
+        blank = self.blank
+        for i in range(self.height):
+            screen[i] = blank
+        return screen
+
+    def frame(self, width: int, height: int) -> list[str]:
+        """Gets a blank frame for the live terminal view, with the border rows the skin colours in paint_frame"""
+        self.resize(width, height)
+        screen = self.clear()
+        if height > 1:
+            screen[1] = '=' * width
+            screen[-1] = '=' * width
+        return screen
+
+    def paint_frame(self, screen: list[str]) -> list[str]:
+        """Colours the title and border rows of a frame once the widgets are spliced in"""
+        palette = self.palette
+        if len(screen) > 1:
+            screen[0] = palette["info"] + screen[0] + palette["normal"]
+            screen[1] = palette["bar"] + screen[1] + palette["normal"]
+            screen[-1] = palette["bar"] + screen[-1] + palette["normal"]
+        return screen
 
     def render_album(self) -> list:
         """Renders the album"""
-        screen = []
-        for i in range(self.height):
-            screen.append(' ' * self.width)
-        screen[0] = self.skins[self.skin]["background"] + ' ' * self.width
-        screen[-1] = ' ' * self.width + self.term.normal
+        screen = self.clear()
+        screen[0] = self.palette["background"] + self.blank
+        screen[-1] = self.blank + self.palette["normal"]
         return screen
 
-    def render_skin(self, album: str, time1: str, time2: str, progress_bar: str, play: bool, volume: str) -> None:
+    def render_skin(self, album: str, time1: str, time2: str, progress_bar: str, play: bool, volume: str,
+                    title: str = '') -> None:
         """
         Renders the skin
 
@@ -52,37 +109,33 @@ class Render:
         progress_bar is an n character string with n given by gen_progress_dim
         play is a bool, set to True if the button should display "button" and False if "pause"
         volume is a 6 character string of the current volume e.g. --x--- or however it is formatted
+        title is the song title to show above the progress bar, e.g. from casp.metadata.display_name
 
         """
-        for i in range(self.height):
-            self.screen.append(' ' * self.width)
-        self.screen[0] = self.skins[self.skin]["background"] + ' ' * self.width
-        self.screen[-1] = ' ' * self.width + self.term.normal
+        palette = self.palette
+        screen = self.render_album()
 
         # adding in album art
         album_height = self.gen_art_dim()[0]
         album = album.split("\n")
         for i in range(2, album_height + 2):
             album_index = i - 2
-            self.screen[i] = album[album_index].center(self.width)
+            screen[i] = album[album_index].center(self.width)
 
         # changing colour
-        self.screen[-8] += (self.skins[self.skin]["bar"])
+        screen[-8] += palette["bar"]
 
         # adding in progress bar
-        self.screen[-6] = self.skins[self.skin]["info"] + "California Uber Alles".center(self.width)
-        self.screen[-6] += self.skins[self.skin]["bar"]
-        self.screen[-5] = "   " + self.skins[self.skin]["time"] + time1 + self.skins[self.skin]["bar"]
-        self.screen[-5] += " " + progress_bar + " " + self.skins[self.skin]["time"] + time2
-        self.screen[-5] += self.skins[self.skin]["bar"] + "   "
+        screen[-6] = palette["info"] + title[:self.width].center(self.width) + palette["bar"]
+        screen[-5] = "   " + palette["time"] + time1 + palette["bar"] + " " + progress_bar + " " \
+            + palette["time"] + time2 + palette["bar"] + "   "
 
         # adding play/pause etc
-        s = self.skins[self.skin]["info"] + ("play " if play else "pause") + self.skins[self.skin]["bar"]
-        t = "    " + s + " " + self.skins[self.skin]["info"] + "|<<" + self.skins[self.skin]["bar"] + "   " + \
-            self.skins[self.skin]["info"] + ">>|" + self.skins[self.skin]["bar"]
+        s = palette["info"] + ("play " if play else "pause") + palette["bar"]
+        t = "    " + s + " " + palette["info"] + "|<<" + palette["bar"] + "   " + \
+            palette["info"] + ">>|" + palette["bar"]
         n = self.term.length(t)
-        self.screen[-3] = t + " " * (self.width - 18 - n) + self.skins[self.skin]["info"] + "volume: " + volume
-        self.screen[-3] += self.skins[self.skin]["bar"] + "    "
+        screen[-3] = t + " " * (self.width - 18 - n) + palette["info"] + "volume: " + volume + palette["bar"] + "    "
 
     def gen_art_dim(self) -> tuple[int, int]:
         """Generates the dimentions for the album art in the form (height, width)"""
@@ -110,4 +163,4 @@ class Render:
     def get_skin(self, skin: str) -> dict:
         """Creates a skin and returns the lines"""
         if skin in self.skins.keys():
-            return self.skins[skin]
+            return compile_skin(self.term, skin)
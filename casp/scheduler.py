@@ -0,0 +1,129 @@
+import heapq
+import itertools
+import os
+import selectors
+import time
+from typing import Callable
+
+
+class Timer:
+    """Handle for a scheduled callback"""
+
+    def __init__(self, deadline: float, interval: float, callback: Callable):
+        self.deadline = deadline
+        self.interval = interval
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        """Stops the callback from running again"""
+        self.cancelled = True
+
+
+class Scheduler:
+    """Selector based event loop that sleeps until a file descriptor is readable or a timer is due"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.counter = itertools.count()
+        self.after_dispatch = []
+        self.running = False
+        self.wake_reader = None
+        self.wake_writer = None
+
+    def enable_wake(self) -> None:
+        """Sets up the pipe wake writes to, so a signal handler can interrupt the wait"""
+        if self.wake_writer is None:
+            self.wake_reader, self.wake_writer = os.pipe()
+            os.set_blocking(self.wake_reader, False)
+            os.set_blocking(self.wake_writer, False)
+            self.add_reader(self.wake_reader, self.drain_wake)
+
+    def wake(self) -> None:
+        """Makes the loop dispatch right away. Safe to call from a signal handler"""
+        if self.wake_writer is not None:
+            try:
+                os.write(self.wake_writer, b'\0')
+            except OSError:
+                pass
+
+    def drain_wake(self) -> None:
+        """Empties the wake pipe, however many times wake was called"""
+        try:
+            while os.read(self.wake_reader, 512):
+                pass
+        except OSError:
+            pass
+
+    def add_reader(self, fd: int, callback: Callable) -> None:
+        """Calls callback whenever fd is readable"""
+        self.selector.register(fd, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fd: int) -> None:
+        """Stops watching fd"""
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def call_later(self, delay: float, callback: Callable) -> Timer:
+        """Calls callback once after delay seconds"""
+        return self.schedule(Timer(time.monotonic() + delay, 0, callback))
+
+    def call_every(self, interval: float, callback: Callable) -> Timer:
+        """Calls callback every interval seconds without drifting"""
+        return self.schedule(Timer(time.monotonic() + interval, interval, callback))
+
+    def schedule(self, timer: Timer) -> Timer:
+        """Puts a timer on the heap"""
+        heapq.heappush(self.timers, (timer.deadline, next(self.counter), timer))
+        return timer
+
+    def add_after_dispatch(self, callback: Callable) -> None:
+        """Calls callback once after every batch of ready readers and timers, e.g. to paint a frame"""
+        self.after_dispatch.append(callback)
+
+    def timeout(self) -> float:
+        """Gets how long the loop may sleep before the next timer is due"""
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(0.0, self.timers[0][0] - time.monotonic())
+
+    def run_once(self) -> None:
+        """Waits for the next reader or timer and dispatches everything that is ready"""
+        timeout = self.timeout()
+        if self.selector.get_map():
+            ready = self.selector.select(timeout)
+        else:
+            time.sleep(timeout if timeout is not None else 0.1)
+            ready = []
+        for key, _ in ready:
+            key.data()
+
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if timer.cancelled:
+                continue
+            timer.callback()
+            if timer.interval and not timer.cancelled:
+                timer.deadline += timer.interval
+                if timer.deadline <= now:
+                    timer.deadline = now + timer.interval
+                self.schedule(timer)
+
+        for callback in self.after_dispatch:
+            callback()
+
+    def run(self) -> None:
+        """Runs until stop is called"""
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self) -> None:
+        """Makes run return after the current batch"""
+        self.running = False
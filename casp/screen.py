@@ -0,0 +1,57 @@
+from typing import TextIO
+
+from blessed import Terminal
+
+
+class ScreenBuffer:
+    """Frame buffer that remembers the last frame and only writes the rows that changed"""
+
+    def __init__(self, terminal: Terminal, stream: TextIO = None):
+        self.term = terminal
+        self.stream = stream if stream else terminal.stream
+        self.encoding = getattr(self.stream, 'encoding', None) or 'utf-8'
+        self.front = []
+        self.size = (0, 0)
+        self.frames = 0
+        self.frame_bytes = 0
+        self.total_bytes = 0
+        self.rows_written = 0
+
+    def invalidate(self) -> None:
+        """Forgets the previous frame so the next flush repaints the whole screen"""
+        self.front = []
+
+    def flush(self, screen: list[str]) -> int:
+        """Writes the rows of screen that differ from the last frame and returns the bytes written"""
+        size = (self.term.height, self.term.width)
+        out = []
+        if size != self.size or len(self.front) != len(screen):
+            self.size = size
+            self.front = [None] * len(screen)
+            out.append(self.term.normal + self.term.clear)
+
+        rows = 0
+        for row, line in enumerate(screen):
+            if self.front[row] != line:
+                out.append(self.term.move_yx(row, 0) + line + self.term.normal)
+                self.front[row] = line
+                rows += 1
+
+        data = ''.join(out)
+        if data:
+            self.stream.write(data)
+            self.stream.flush()
+
+        self.frames += 1
+        self.rows_written = rows
+        self.frame_bytes = len(data.encode(self.encoding, 'replace'))
+        self.total_bytes += self.frame_bytes
+        return self.frame_bytes
+
+    def stats(self) -> dict:
+        """Returns the bytes written for the last frame and over the session"""
+        return {'frames': self.frames,
+                'frame_bytes': self.frame_bytes,
+                'rows_written': self.rows_written,
+                'total_bytes': self.total_bytes,
+                'average_bytes': self.total_bytes / self.frames if self.frames else 0}
@@ -0,0 +1,138 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Callable
+
+GRAM_SIZE = 3
+MAX_POSTINGS = 256
+# Patching checks each updated entry against each remembered list, past this many checks per text rescanning is cheaper
+PATCH_LIMIT = 4
+
+
+def shifted(entries: list[int], index: int, delta: int) -> list[int]:
+    """Moves the entries from index on by delta, as a new list"""
+    start = bisect_left(entries, index)
+    return entries[:start] + [i + delta for i in entries[start:]]
+
+
+def patched(entries: list[int], added: set[int], dropped: set[int]) -> list[int]:
+    """Adds and drops indices in ascending entries as a new list, copying the runs between them in slices"""
+    result = []
+    start = 0
+    for index in sorted(added | dropped):
+        position = bisect_left(entries, index, start)
+        result.extend(entries[start:position])
+        if index in added:
+            result.append(index)
+            start = position
+        else:
+            start = position + 1
+    result.extend(entries[start:])
+    return result
+
+
+def place(entries: list[int], key: str, index: int, old: str, new: str) -> list[int]:
+    """Adds or drops index in the entries containing key after its text went from old to new"""
+    if (key in old) == (key in new):
+        return entries
+    start = bisect_left(entries, index)
+    if key in new:
+        return entries[:start] + [index] + entries[start:]
+    return entries[:start] + entries[start + 1:]
+
+
+class SearchIndex:
+    """Incremental substring search over menu labels
+
+    Each gram of up to three characters gets a posting list of the labels that contain it, built on first use
+    and kept in a small LRU. A query is answered from the posting list of its first gram, and typing more
+    characters only filters the previous result, which is kept on a stack so backspace is free. Changed entries
+    are patched into the posting lists and the stack at the next search rather than throwing them away. The
+    lists are replaced, never changed in place, since a menu may still be showing one.
+    """
+
+    def __init__(self, texts: list[str] = None):
+        self.texts = [text.lower() for text in texts] if texts else []
+        self.postings = OrderedDict()
+        self.history = []
+        self.stale = {}
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def update(self, index: int, text: str) -> None:
+        """Replaces the searchable text of one entry, e.g. once its tags are known"""
+        if index == len(self.texts):
+            self.insert(index, text)
+            return
+        # Only the text before the first change counts, that is what the remembered lists were built from
+        self.stale.setdefault(index, self.texts[index])
+        self.texts[index] = text.lower()
+
+    def insert(self, index: int, text: str) -> None:
+        """Adds the searchable text of a new entry before index"""
+        self.refresh()
+        text = text.lower()
+        self.texts.insert(index, text)
+        self.reindex(lambda entries, key: place(shifted(entries, index, 1), key, index, '', text))
+
+    def remove(self, index: int) -> None:
+        """Drops the searchable text of an entry, shifting the ones after it down"""
+        self.refresh()
+        old = self.texts.pop(index)
+        self.reindex(lambda entries, key: shifted(place(entries, key, index, old, ''), index + 1, -1))
+
+    def refresh(self) -> None:
+        """Patches the entries updated since the last search into the remembered lists"""
+        if not self.stale:
+            return
+        stale, self.stale = self.stale, {}
+        if len(stale) * (len(self.postings) + len(self.history)) > len(self.texts) * PATCH_LIMIT:
+            self.postings.clear()
+            self.history.clear()
+            return
+        texts = self.texts
+
+        def change(entries: list[int], key: str) -> list[int]:
+            added = {i for i, old in stale.items() if key in texts[i] and key not in old}
+            dropped = {i for i, old in stale.items() if key in old and key not in texts[i]}
+            return patched(entries, added, dropped) if added or dropped else entries
+        self.reindex(change)
+
+    def reindex(self, change: Callable[[list[int], str], list[int]]) -> None:
+        """Applies an entry change to every remembered posting list and refinement, without scanning the texts"""
+        for gram, entries in list(self.postings.items()):
+            self.postings[gram] = change(entries, gram)
+        self.history = [(query, change(results, query)) for query, results in self.history]
+
+    def posting(self, gram: str) -> list[int]:
+        """Gets the entries containing gram, scanning once and remembering the answer"""
+        self.refresh()
+        if gram in self.postings:
+            self.postings.move_to_end(gram)
+            return self.postings[gram]
+        found = [i for i, text in enumerate(self.texts) if gram in text]
+        self.postings[gram] = found
+        if len(self.postings) > MAX_POSTINGS:
+            self.postings.popitem(last=False)
+        return found
+
+    def search(self, query: str) -> list[int]:
+        """Gets the entries containing query in ascending order, or None for an empty query"""
+        self.refresh()
+        query = query.lower()
+        if not query:
+            self.history.clear()
+            return None
+        while self.history and not query.startswith(self.history[-1][0]):
+            self.history.pop()
+        if self.history and self.history[-1][0] == query:
+            return self.history[-1][1]
+        texts = self.texts
+        if self.history:
+            results = [i for i in self.history[-1][1] if query in texts[i]]
+        else:
+            results = self.posting(query[:GRAM_SIZE])
+            if len(query) > GRAM_SIZE:
+                results = [i for i in results if query in texts[i]]
+        self.history.append((query, results))
+        return results
@@ -0,0 +1,239 @@
+import os
+from array import array
+from bisect import bisect_left
+from itertools import accumulate, groupby, islice
+from operator import itemgetter
+from typing import Callable, Iterable, Iterator, Sequence
+
+from casp.Widgets import Option
+
+MIN_SLOTS = 8
+# Options of the rows drawn lately, a few screens' worth, are kept rather than made again on every frame
+MAX_CACHED_OPTIONS = 1024
+
+
+def split_path(path: str) -> tuple[str, str]:
+    """Splits a path into the directory and the file name a track table keeps"""
+    directory, sep, name = path.rpartition(os.sep)
+    if sep and not directory:
+        # A path at the root of the file system keeps its leading separator in the name
+        return '', path
+    return directory, name
+
+
+class TrackTable(Sequence):
+    """Packed, append only table of unique track paths, shared by index between the file handler, menu and queue
+
+    Each path is split into an interned directory and a file name. The names are kept utf-8 encoded in one
+    bytearray with an array of offsets, and a path is found again through an open addressing table of track
+    ids, so a track costs a few dozen bytes instead of several Python objects. A whole library is added in one
+    go with extend, which encodes the names together and fills the lookup table once.
+    """
+
+    def __init__(self, paths: Iterable[str] = ()):
+        self.dirs = []
+        self.dir_ids = {}
+        self.track_dirs = array('I')
+        self.offsets = array('Q', [0])
+        self.names = bytearray()
+        self.hashes = array('q')
+        self.slots = array('i', [-1]) * MIN_SLOTS
+        # Paths of one directory usually come together, so they are added as one group
+        groups = groupby(map(split_path, dict.fromkeys(paths)), itemgetter(0))
+        self.extend((directory, [name for _, name in pairs]) for directory, pairs in groups)
+
+    def __len__(self) -> int:
+        return len(self.track_dirs)
+
+    def __getitem__(self, index: int) -> str:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return self.path(index)
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def __contains__(self, path: str) -> bool:
+        return self.find(path) >= 0
+
+    def index(self, path: str, *args) -> int:
+        """Gets the id of a track, raising ValueError if it is not in the table"""
+        index = self.find(path)
+        if index < 0:
+            raise ValueError(f'{path} is not in the track table')
+        return index
+
+    def path(self, index: int) -> str:
+        """Gets the path of a track id, without the checks of indexing, for the menu and lookups"""
+        offsets = self.offsets
+        name = self.names[offsets[index]:offsets[index + 1]].decode('utf-8', 'surrogateescape')
+        directory = self.dirs[self.track_dirs[index]]
+        return directory + os.sep + name if directory else name
+
+    def name(self, index: int) -> str:
+        """Gets the file name of a track without its directory"""
+        return self.names[self.offsets[index]:self.offsets[index + 1]].decode('utf-8', 'surrogateescape')
+
+    def directory(self, index: int) -> str:
+        """Gets the directory of a track relative to the library root"""
+        return self.dirs[self.track_dirs[index]]
+
+    def find(self, path: str) -> int:
+        """Gets the id of a track, or -1 if it is not in the table"""
+        key = hash(path)
+        mask = len(self.slots) - 1
+        slot = key & mask
+        while True:
+            index = self.slots[slot]
+            if index < 0:
+                return -1
+            if self.hashes[index] == key and self.path(index) == path:
+                return index
+            slot = (slot + 1) & mask
+
+    def add(self, path: str) -> int:
+        """Adds a track if it is new and returns its id"""
+        key = hash(path)
+        slots, hashes = self.slots, self.hashes
+        mask = len(slots) - 1
+        slot = key & mask
+        while True:
+            index = slots[slot]
+            if index < 0:
+                break
+            if hashes[index] == key and self.path(index) == path:
+                return index
+            slot = (slot + 1) & mask
+
+        directory, name = split_path(path)
+        index = len(hashes)
+        self.track_dirs.append(self.dir_id(directory))
+        self.names += name.encode('utf-8', 'surrogateescape')
+        self.offsets.append(len(self.names))
+        hashes.append(key)
+        if len(hashes) * 2 > len(slots):
+            self.rehash(len(slots) * 2)
+        else:
+            slots[slot] = index
+        return index
+
+    def extend(self, listing: Iterable[tuple[str, list[str]]]) -> None:
+        """Adds the tracks of (directory, file names) pairs at once, which must all be new, e.g. a library index"""
+        track_dirs = []
+        names = []
+        hashes = []
+        for directory, files in listing:
+            prefix = directory + os.sep if directory else ''
+            track_dirs += [self.dir_id(directory)] * len(files)
+            names += files
+            hashes += [hash(prefix + name) for name in files]
+        if not names:
+            return
+        encoded = [name.encode('utf-8', 'surrogateescape') for name in names]
+        self.offsets.extend(islice(accumulate(map(len, encoded), initial=len(self.names)), 1, None))
+        self.names += b''.join(encoded)
+        self.track_dirs.extend(track_dirs)
+        self.hashes.extend(hashes)
+        size = len(self.slots)
+        while len(self.hashes) * 2 > size:
+            size *= 2
+        self.rehash(size)
+
+    def dir_id(self, directory: str) -> int:
+        """Gets the id of a directory, interning it if it is new"""
+        dir_id = self.dir_ids.get(directory)
+        if dir_id is None:
+            dir_id = self.dir_ids[directory] = len(self.dirs)
+            self.dirs.append(directory)
+        return dir_id
+
+    def rehash(self, size: int) -> None:
+        """Rebuilds the lookup table with size slots"""
+        slots = array('i', [-1]) * size
+        mask = size - 1
+        for index, key in enumerate(self.hashes):
+            slot = key & mask
+            while slots[slot] >= 0:
+                slot = (slot + 1) & mask
+            slots[slot] = index
+        self.slots = slots
+
+
+class TrackOptions(Sequence):
+    """Menu options made on demand from the tracks of a table, in track order
+
+    The rows hold ascending track ids, so a track is found by bisection and files that appear while casp runs
+    can be slotted in. Only the graphics that differ from the path are kept, along with the options of the
+    rows drawn lately.
+    """
+
+    def __init__(self, table: TrackTable):
+        self.table = table
+        self.rows = array('I', range(len(table)))
+        self.graphics = {}
+        self.cache = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, index: int) -> Option:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        track_id = self.rows[index]
+        option = self.cache.get(track_id)
+        if option is None:
+            if len(self.cache) >= MAX_CACHED_OPTIONS:
+                self.cache.clear()
+            path = self.table.path(track_id)
+            option = self.cache[track_id] = Option(self.graphics.get(track_id) or [path], path)
+        return option
+
+    def __setitem__(self, index: int, option: Option) -> None:
+        self.set_graphic(self.rows[index], option)
+
+    def __delitem__(self, index: int) -> None:
+        self.graphics.pop(self.rows[index], None)
+        self.cache.pop(self.rows[index], None)
+        del self.rows[index]
+
+    def insert(self, index: int, option: Option) -> None:
+        """Adds the track of an option as the row before index, which should be row_for of its id"""
+        track_id = self.table.add(option.choice)
+        self.rows.insert(index, track_id)
+        self.set_graphic(track_id, option)
+
+    def set_graphic(self, track_id: int, option: Option) -> None:
+        """Remembers the graphic of a track if it is more than its path"""
+        self.cache.pop(track_id, None)
+        if option.graphic == [option.choice]:
+            self.graphics.pop(track_id, None)
+        else:
+            self.graphics[track_id] = option.graphic
+
+    def measure(self, width: Callable[[str], int]) -> tuple[int, int]:
+        """Gets the (lines per option, widest line) of the rows without making an option for each of them"""
+        graphics = self.graphics
+        plain = [track_id for track_id in self.rows if track_id not in graphics]
+        maxlines = max([1 if plain else 0, *map(len, graphics.values())])
+        widest = max([width(line) for graphic in graphics.values() for line in graphic], default=0)
+        table = self.table
+        if not table.names.isascii() or b'\x1b' in table.names \
+                or not all(directory.isascii() and '\x1b' not in directory for directory in table.dirs):
+            return maxlines, max([widest, *(width(table.path(track_id)) for track_id in plain)])
+        # Plain ascii is as wide as it is long, which the offsets already say
+        offsets, track_dirs = table.offsets, table.track_dirs
+        dir_widths = [len(directory) + 1 if directory else 0 for directory in table.dirs]
+        return maxlines, max([widest, *(offsets[track_id + 1] - offsets[track_id] + dir_widths[track_dirs[track_id]]
+                                        for track_id in plain)])
+
+    def row_for(self, track_id: int) -> int:
+        """Gets the row a track has, or would have if it were shown"""
+        return bisect_left(self.rows, track_id)
+
+    def row_of(self, track_id: int) -> int:
+        """Gets the row of a track, or -1 if it is not shown"""
+        row = bisect_left(self.rows, track_id)
+        return row if row < len(self.rows) and self.rows[row] == track_id else -1
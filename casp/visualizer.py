@@ -0,0 +1,247 @@
+import io
+import os
+import threading
+import time
+from typing import Callable
+
+from casp.cache import cache_path, save_bytes
+from casp.coverart import CoverArt
+from casp.decode import PcmStream, numpy_available
+from casp.probe import file_key
+from casp.Widgets import ArtWidget
+
+MODES = ('off', 'cover', 'waveform', 'spectrum')
+OVERVIEW_POINTS = 1024
+VISUAL_FPS = 30
+FRAME_BUDGET = 0.004
+MAX_INTERVAL = 0.5
+FFT_SIZE = 2048
+FFT_BATCH = 16
+MIN_FREQUENCY = 40.0
+MAX_FREQUENCY = 16000.0
+FLOOR_DB = -60.0
+
+
+def overview_path(filename: str) -> str:
+    """Gets the cache file of a song's waveform overview, which changes with the song's size and mtime"""
+    return cache_path('waveform', '\0'.join(map(str, file_key(filename))), '.npy')
+
+
+def compute_overview(filename: str, points: int = OVERVIEW_POINTS) -> object:
+    """Gets the peak level of each of points equal slices of a song, in one pass over its samples"""
+    import numpy as np
+    stream = PcmStream(filename)
+    frames = stream.frames
+    points = max(1, min(points, frames))
+    peaks = np.zeros(points, np.float32)
+    start = 0
+    try:
+        for block in stream.blocks():
+            levels = np.abs(block).max(axis=1)
+            end = start + len(levels)
+            first = start * points // frames
+            last = min((end - 1) * points // frames, points - 1)
+            # Frame f belongs to slice f * points // frames, so slice s starts at frame ceil(s * frames / points)
+            slices = np.arange(first, last + 1)
+            offsets = np.maximum(-(-slices * frames // points) - start, 0)
+            peaks[first:last + 1] = np.maximum(peaks[first:last + 1], np.maximum.reduceat(levels, offsets))
+            start = end
+    finally:
+        stream.close()
+    return peaks
+
+
+def load_overview(filename: str) -> object:
+    """Gets a song's waveform overview from the cache, computing and caching it the first time"""
+    import numpy as np
+    path = overview_path(filename)
+    try:
+        return np.load(path)
+    except (OSError, ValueError):
+        pass
+    peaks = compute_overview(filename)
+    data = io.BytesIO()
+    np.save(data, peaks)
+    save_bytes(path, data.getvalue())
+    return peaks
+
+
+def fit_columns(peaks: object, columns: int) -> list[float]:
+    """Shrinks or stretches an overview to columns, keeping the loudest peak of each column"""
+    import numpy as np
+    edges = np.arange(columns) * len(peaks) // columns
+    return np.maximum.reduceat(peaks, edges).tolist()
+
+
+def band_edges(rate: int, bands: int) -> object:
+    """Gets the first FFT bin of each of bands log spaced bands"""
+    import numpy as np
+    top = min(MAX_FREQUENCY, rate / 2)
+    freqs = np.geomspace(MIN_FREQUENCY, top, bands + 1)
+    return np.minimum((freqs[:-1] * FFT_SIZE / rate).astype(np.intp), FFT_SIZE // 2)
+
+
+def spectra(samples: object, rate: int, hop: int, bands: int) -> object:
+    """Gets the band levels from 0 to 1 of windows every hop frames of mono samples, with one batched FFT"""
+    import numpy as np
+    count = max(0, (len(samples) - FFT_SIZE) // hop + 1)
+    if not count:
+        return np.zeros((0, bands), np.float32)
+    windows = np.lib.stride_tricks.sliding_window_view(samples, FFT_SIZE)[::hop][:count]
+    magnitudes = np.abs(np.fft.rfft(windows * np.hanning(FFT_SIZE).astype(np.float32), axis=1))
+    levels = np.maximum.reduceat(magnitudes, band_edges(rate, bands), axis=1) / (FFT_SIZE / 4)
+    db = 20 * np.log10(np.maximum(levels, 1e-9))
+    return np.clip((db - FLOOR_DB) / -FLOOR_DB, 0, 1).astype(np.float32)
+
+
+class Visualizer:
+    """Draws the cover art, a waveform overview or a live spectrum of the playing song into an art widget
+
+    The decoding, the FFTs and the cover art conversion run on a worker thread. The UI tick only picks the frame
+    for the current position, and backs off whenever drawing takes longer than its budget so input and audio
+    never wait on it.
+    """
+
+    def __init__(self, widget: ArtWidget, get_status: Callable[[], dict],
+                 get_art_size: Callable[[], tuple[int, int]] = None):
+        self.widget = widget
+        self.get_status = get_status
+        self.get_art_size = get_art_size if get_art_size else widget.get_size
+        self.covers = CoverArt(widget.term)
+        self.mode = 'off'
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.wanted = None
+        self.overview = None
+        self.frames = None
+        self.error = None
+        self.interval = 1 / VISUAL_FPS
+        self.next_frame = 0.0
+
+    def cycle(self) -> str:
+        """Switches to the next mode, returns it"""
+        if not numpy_available():
+            self.widget.show(not self.widget.shown)
+            self.widget.set_message('The visualizer needs numpy: pip install casp[visualizer]')
+            return self.mode
+        self.mode = MODES[(MODES.index(self.mode) + 1) % len(MODES)]
+        self.widget.show(self.mode != 'off')
+        self.widget.set_message('')
+        self.next_frame = 0.0
+        if self.mode != 'off' and self.thread is None:
+            self.thread = threading.Thread(target=self.work, name='casp-visualizer', daemon=True)
+            self.thread.start()
+        return self.mode
+
+    def request(self, wanted: tuple) -> None:
+        """Asks the worker for an overview or a batch of spectra"""
+        with self.lock:
+            if wanted == self.wanted:
+                return
+            self.wanted = wanted
+        self.wake.set()
+
+    def tick(self) -> bool:
+        """Updates the widget for the current position, returns True if it needs a repaint"""
+        if self.mode == 'off':
+            return False
+        now = time.monotonic()
+        if now < self.next_frame:
+            return False
+        started = time.perf_counter()
+        status = self.get_status()
+        song = status.get('song')
+        columns = max(1, self.widget.get_size()[1] - 4)
+        if not song:
+            changed = self.widget.set_message('Nothing is playing')
+        elif self.error and self.error[0] == song:
+            changed = self.widget.set_message(self.error[1])
+        elif self.mode == 'cover':
+            changed = self.draw_cover(song)
+        elif self.mode == 'waveform':
+            changed = self.draw_waveform(song, status, columns)
+        else:
+            changed = self.draw_spectrum(song, status, columns)
+        if changed:
+            # Rendering here counts the drawing against the budget, the frame then uses the cached lines
+            self.widget.lines()
+        spent = time.perf_counter() - started
+        if spent > FRAME_BUDGET:
+            self.interval = min(self.interval * 2, MAX_INTERVAL)
+        else:
+            self.interval = max(self.interval * 0.9, 1 / VISUAL_FPS)
+        self.next_frame = now + self.interval
+        return changed
+
+    def draw_cover(self, song: str) -> bool:
+        """Shows the cover art of the song, sized to the album art area"""
+        rows, width = self.get_art_size()
+        art = self.covers.get(song, rows, width)
+        if art is None:
+            self.request(('cover', song, rows, width))
+            return self.widget.set_message('Reading the cover art')
+        if not art[1]:
+            return self.widget.set_message('No cover art')
+        return self.widget.set_picture(*art)
+
+    def draw_waveform(self, song: str, status: dict, columns: int) -> bool:
+        """Shows the overview of the song with the part already played highlighted"""
+        overview = self.overview
+        if overview is None or overview[0] != song:
+            self.request(('waveform', song))
+            return self.widget.set_message('Reading the waveform')
+        if overview[1] != columns:
+            self.overview = overview = (song, columns, fit_columns(overview[3], columns), overview[3])
+        length = status.get('length') or 0
+        split = int(status.get('position', 0) / length * columns) if length else 0
+        return self.widget.set_levels(overview[2], centred=True, split=split)
+
+    def draw_spectrum(self, song: str, status: dict, columns: int) -> bool:
+        """Shows the spectrum of the window at the current position"""
+        position = status.get('position', 0)
+        frames = self.frames
+        if frames is None or frames[:2] != (song, columns):
+            self.request(('spectrum', song, columns, position))
+            return False
+        start, step, levels = frames[2:]
+        index = int((position - start) / step)
+        if not 0 <= index < len(levels) - FFT_BATCH // 4:
+            self.request(('spectrum', song, columns, position))
+        if not 0 <= index < len(levels):
+            return False
+        return self.widget.set_levels(levels[index].tolist(), split=columns)
+
+    def work(self) -> None:
+        """Worker loop that decodes songs and computes what the UI asks for"""
+        stream = None
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            with self.lock:
+                wanted = self.wanted
+            song = wanted[1]
+            try:
+                if wanted[0] == 'cover':
+                    self.covers.convert(*wanted[1:])
+                    continue
+                if wanted[0] == 'waveform':
+                    peaks = load_overview(song)
+                    self.overview = (song, None, None, peaks)
+                    continue
+                if stream is None or stream.filename != song:
+                    if stream is not None:
+                        stream.close()
+                    stream = PcmStream(song)
+                self.frames = self.analyse(stream, *wanted[2:])
+            except Exception as err:
+                # This is the only worker, a bad file must not end it
+                self.error = (song, f'Can not show {os.path.basename(song)}: {err}')
+
+    def analyse(self, stream: PcmStream, columns: int, position: float) -> tuple:
+        """Computes spectra for the windows from position on, a batch at a time"""
+        hop = max(1, int(stream.rate / VISUAL_FPS))
+        start = int(position * stream.rate)
+        samples = stream.read(start, FFT_SIZE + hop * (FFT_BATCH - 1))
+        levels = spectra(samples.mean(axis=1), stream.rate, hop, columns)
+        return stream.filename, columns, start / stream.rate, hop / stream.rate, levels
@@ -0,0 +1,192 @@
+import os
+import select
+import struct
+import sys
+import threading
+from os.path import join
+
+from casp.library import LibraryIndex
+
+POLL_INTERVAL = 2.0
+SETTLE_TIME = 0.2
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_ONLYDIR = 0x1000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF \
+    | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal inotify binding over ctypes that watches directories"""
+
+    def __init__(self):
+        # Imported here to keep it off the startup path
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+        self.watches = {}
+
+    @classmethod
+    def create(cls) -> 'Inotify':
+        """Gets an inotify instance, or None where the platform has none"""
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            return cls()
+        except (OSError, AttributeError):
+            return None
+
+    def watch(self, path: str, rel: str) -> None:
+        """Watches a directory, known to the caller as rel"""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(self.ctypes.get_errno(), f'can not watch {path}')
+        self.dirs[wd] = rel
+        self.watches[rel] = wd
+
+    def unwatch(self, rel: str) -> None:
+        """Stops watching a directory"""
+        wd = self.watches.pop(rel, None)
+        if wd is not None:
+            self.dirs.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self) -> tuple[set, bool]:
+        """Reads the pending events and gets the directories they touched, and whether the queue overflowed"""
+        touched = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos + EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+                pos += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                elif wd in self.dirs:
+                    touched.add(self.dirs[wd])
+        return touched, overflow
+
+    def close(self) -> None:
+        """Releases the inotify descriptor"""
+        os.close(self.fd)
+
+
+class LibraryWatcher:
+    """Thread that keeps a library index up to date and queues the file changes for the UI
+
+    Changes are tuples of ('add', path), ('remove', path), ('rename', old, new) and ('change', path), with
+    paths relative to the library root. inotify says which directories changed where it is available,
+    otherwise the watcher compares directory mtimes every few seconds. Either way only the directories that
+    changed are listed again, and a file that vanished from one place and appeared in another with the same
+    size and mtime counts as renamed.
+    """
+
+    def __init__(self, library: LibraryIndex, interval: float = POLL_INTERVAL):
+        self.library = library
+        self.interval = interval
+        self.changes = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.inotify = None
+        self.thread = None
+
+    def start(self) -> None:
+        """Starts watching on a background thread"""
+        self.thread = threading.Thread(target=self.run, name='casp-watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stops watching"""
+        self.stopped.set()
+
+    def drain(self) -> list[tuple]:
+        """Gets the changes since the last call"""
+        with self.lock:
+            changes, self.changes = self.changes, []
+        return changes
+
+    def run(self) -> None:
+        """Watcher loop"""
+        self.inotify = Inotify.create()
+        if self.inotify is not None:
+            try:
+                for rel in list(self.library.dirs):
+                    self.inotify.watch(join(self.library.root, rel), rel)
+            except OSError:
+                # Usually the limit on watches, polling copes with any number of directories
+                self.inotify.close()
+                self.inotify = None
+        # Anything that changed between the scan at startup and the first watch
+        self.update(self.library.changed_dirs())
+        # Songs rewritten while casp was not running, their tag and loudness caches would never be refreshed
+        rewritten = self.library.restat()
+        if rewritten:
+            self.library.save()
+            with self.lock:
+                self.changes.extend(('change', path) for path, _ in rewritten)
+        if self.inotify is None:
+            while not self.stopped.wait(self.interval):
+                self.update(self.library.changed_dirs())
+            return
+        while not self.stopped.is_set():
+            ready, _, _ = select.select([self.inotify.fd], [], [], self.interval)
+            if not ready:
+                continue
+            # Let a burst of events, e.g. a copy of a whole album, settle into one rescan
+            self.stopped.wait(SETTLE_TIME)
+            touched, overflow = self.inotify.read()
+            if overflow:
+                self.update(self.library.changed_dirs())
+            self.update(touched, force=True)
+        self.inotify.close()
+
+    def update(self, rels: set, force: bool = False) -> None:
+        """Rescans directories and queues what changed in them"""
+        if not rels:
+            return
+        known = set(self.library.dirs)
+        added, removed, changed = self.library.refresh(rels, force)
+        if self.inotify is not None:
+            for rel in known.difference(self.library.dirs):
+                self.inotify.unwatch(rel)
+            for rel in set(self.library.dirs).difference(known):
+                try:
+                    self.inotify.watch(join(self.library.root, rel), rel)
+                except OSError:
+                    pass
+        if not (added or removed or changed):
+            return
+        self.library.save()
+
+        vanished = {}
+        for path, stat in removed:
+            vanished.setdefault(stat, []).append(path)
+        changes = []
+        for path, stat in added:
+            if vanished.get(stat):
+                changes.append(('rename', vanished[stat].pop(0), path))
+            else:
+                changes.append(('add', path))
+        changes.extend(('remove', path) for paths in vanished.values() for path in paths)
+        changes.extend(('change', path) for path, _ in changed)
+        with self.lock:
+            self.changes.extend(changes)
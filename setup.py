@@ -7,8 +7,9 @@ setup(
     name="casp",
     version="0.1",
     description="Music file viewer and player",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks"]),
     entry_points={"console_scripts": ["casp = casp.main:run"]},
+    extras_require={"visualizer": ["numpy"]},
     include_package_data=True,
     python_requires=">=3.9",
     long_description=long_description,